@@ -0,0 +1,11 @@
+--
+-- Adds the `sync_state` table that stores the history checkpoint used by the incremental sync.
+--
+use `google_mail`;
+
+CREATE TABLE IF NOT EXISTS `sync_state` (
+  `name` varchar(100) NOT NULL,
+  `history_id` bigint unsigned DEFAULT NULL,
+  `refreshed_on` datetime NOT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB COMMENT="Last synchronized history checkpoint of the mailbox";
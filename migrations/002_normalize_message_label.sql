@@ -0,0 +1,24 @@
+--
+-- Replaces the JSON `labels` column of `message_label` with one (message_id, label_id) row per label,
+-- so that filtering messages by label is an index lookup.
+--
+use `google_mail`;
+
+ALTER TABLE `message_label` DROP FOREIGN KEY `fk_ml_lbl_email_id`;
+RENAME TABLE `message_label` TO `message_label_json`;
+
+CREATE TABLE `message_label` (
+  `message_id` bigint unsigned NOT NULL,
+  `label_id` varchar(255) NOT NULL,
+  `refreshed_on` datetime NOT NULL,
+  PRIMARY KEY (`message_id`,`label_id`),
+  KEY `idx_ml_label_id` (`label_id`,`message_id`),
+  CONSTRAINT `fk_ml_lbl_email_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
+) ENGINE=InnoDB;
+
+INSERT INTO `message_label` (`message_id`, `label_id`, `refreshed_on`)
+SELECT `ml`.`message_id`, `jt`.`label_id`, `ml`.`refreshed_on`
+FROM `message_label_json` `ml`,
+     JSON_TABLE(`ml`.`labels`, '$[*]' COLUMNS (`label_id` varchar(255) PATH '$')) `jt`;
+
+DROP TABLE `message_label_json`;
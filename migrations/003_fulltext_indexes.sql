@@ -0,0 +1,14 @@
+--
+-- Adds FULLTEXT indexes (built-in word parser) on the rule text fields and on the message bodies. Migration 010
+-- moves the indexes of `email_attributes` to `email_search`, and migration 011 rebuilds them all with the ngram
+-- parser, which serves the 'contains' and 'contains word' rule predicates.
+-- InnoDB builds one FULLTEXT index per statement.
+--
+use `google_mail`;
+
+ALTER TABLE `email_attributes` ADD FULLTEXT KEY `ft_ea_subject` (`subject`);
+ALTER TABLE `email_attributes` ADD FULLTEXT KEY `ft_ea_from` (`from`);
+ALTER TABLE `email_attributes` ADD FULLTEXT KEY `ft_ea_to` (`to`);
+ALTER TABLE `email_attributes` ADD FULLTEXT KEY `ft_ea_cc` (`cc`);
+ALTER TABLE `email_attributes` ADD FULLTEXT KEY `ft_ea_bcc` (`bcc`);
+ALTER TABLE `message_part` ADD FULLTEXT KEY `ft_mp_content` (`content`);
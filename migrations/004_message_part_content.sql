@@ -0,0 +1,10 @@
+--
+-- Prepares `message_part` for the MIME parts saved by the downloader:
+--  * `content` holds up to MESSAGE_PART_MAX_CONTENT_SIZE bytes of a text part (more than a `text` column allows)
+--  * part ids repeat across messages ('0', '0.1', ...), hence `parent_id` can not reference `part_id`
+--
+use `google_mail`;
+
+ALTER TABLE `message_part` DROP FOREIGN KEY `fk_part_parent_id`;
+ALTER TABLE `message_part` RENAME INDEX `fk_part_parent_id` TO `idx_mp_parent_id`;
+ALTER TABLE `message_part` MODIFY `content` mediumtext NOT NULL;
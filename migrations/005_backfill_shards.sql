@@ -0,0 +1,14 @@
+--
+-- Extends `sync_state` to track the shards of a parallel backfill (one row per shard, named 'backfill:<shard>'):
+--  * `parameters` holds the messages.list arguments of the shard (Eg. an after: / before: query or a label id)
+--  * `status` is one of pending, running, done or failed
+--
+use `google_mail`;
+
+ALTER TABLE `sync_state`
+  ADD COLUMN `parameters` json DEFAULT NULL AFTER `history_id`,
+  ADD COLUMN `status` varchar(20) DEFAULT NULL AFTER `parameters`,
+  ADD COLUMN `message_count` int unsigned NOT NULL DEFAULT 0 AFTER `status`,
+  ADD COLUMN `attempts` int unsigned NOT NULL DEFAULT 0 AFTER `message_count`,
+  ADD COLUMN `error` varchar(1000) DEFAULT NULL AFTER `attempts`,
+  COMMENT = "Last synchronized history checkpoint of the mailbox and the progress of the backfill shards";
@@ -0,0 +1,14 @@
+--
+-- Extends `sync_state` to checkpoint the progress of a download (the 'download' row and the backfill shards), so
+-- that an interrupted download resumes from its last checkpoint:
+--  * `page_token` is the messages.list page token following the last page saved (with all the pages before it)
+--  * `last_batch` is the number of pages saved till that page
+--  * `started_on` is the start of the download. Messages saved since then are not fetched again on resume.
+--
+use `google_mail`;
+
+ALTER TABLE `sync_state`
+  ADD COLUMN `page_token` varchar(255) DEFAULT NULL AFTER `parameters`,
+  ADD COLUMN `last_batch` int unsigned NOT NULL DEFAULT 0 AFTER `page_token`,
+  ADD COLUMN `started_on` datetime DEFAULT NULL AFTER `error`,
+  COMMENT = "Last synchronized history checkpoint of the mailbox and the progress of the downloads";
@@ -0,0 +1,7 @@
+--
+-- Indexes `email`.`refreshed_on`, which is touched whenever a message or its labels change. The in-memory rule
+-- snapshot (src/businesslogic/rule_snapshot.py) reads the messages changed since its last refresh with it.
+--
+use `google_mail`;
+
+ALTER TABLE `email` ADD KEY `idx_email_refreshed_on` (`refreshed_on`);
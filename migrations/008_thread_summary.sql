@@ -0,0 +1,35 @@
+--
+-- Adds `thread_summary`, the per thread aggregates of the stored messages (message count, first and last
+-- timestamps, senders and the union of the labels). It is maintained as messages are saved, relabelled and deleted
+-- (see src/models/thread_summary.py) and used by the thread rule fields (Eg. thread_last_date).
+-- `email`.`thread_id` is indexed to read the messages of a thread.
+--
+use `google_mail`;
+
+ALTER TABLE `email` ADD KEY `idx_email_thread_id` (`thread_id`);
+
+CREATE TABLE `thread_summary` (
+  `thread_id` bigint unsigned NOT NULL,
+  `message_count` int unsigned NOT NULL,
+  `first_timestamp` timestamp NULL DEFAULT NULL,
+  `last_timestamp` timestamp NULL DEFAULT NULL,
+  `participants` text,
+  `label_ids` text,
+  `refreshed_on` datetime NOT NULL,
+  PRIMARY KEY (`thread_id`),
+  KEY `idx_ts_last_timestamp` (`last_timestamp`),
+  KEY `idx_ts_first_timestamp` (`first_timestamp`)
+) ENGINE=InnoDB COMMENT="Aggregates of the stored messages of each thread";
+
+-- Summarizes the threads already stored. Should match THREAD_SUMMARY_MAX_TEXT_SIZE.
+SET SESSION group_concat_max_len = 16384;
+
+INSERT INTO `thread_summary`(`thread_id`, `message_count`, `first_timestamp`, `last_timestamp`, `participants`,
+                             `label_ids`, `refreshed_on`)
+SELECT email.thread_id, count(distinct email.id), min(email_attributes.internal_timestamp),
+       max(email_attributes.internal_timestamp),
+       group_concat(distinct email_attributes.`from` order by email_attributes.`from` separator ', '),
+       group_concat(distinct message_label.label_id order by message_label.label_id), now()
+FROM email JOIN email_attributes ON email_attributes.message_id = email.id
+LEFT JOIN message_label ON message_label.message_id = email.id
+GROUP BY email.thread_id;
@@ -0,0 +1,18 @@
+--
+-- Moves the bulky `payload_headers` of `email_attributes` to the cold table `email_headers` (compressed, read by
+-- message id only), so that the rows read by the rules hold only the queried columns and more of them fit in the
+-- buffer pool.
+--
+use `google_mail`;
+
+CREATE TABLE `email_headers` (
+  `message_id` bigint unsigned NOT NULL,
+  `payload_headers` json DEFAULT NULL,
+  PRIMARY KEY (`message_id`),
+  CONSTRAINT `fk_eh_email_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
+) ENGINE=InnoDB ROW_FORMAT=COMPRESSED COMMENT="Headers of the emails";
+
+INSERT INTO `email_headers`(`message_id`, `payload_headers`)
+SELECT `message_id`, `payload_headers` FROM `email_attributes`;
+
+ALTER TABLE `email_attributes` DROP COLUMN `payload_headers`;
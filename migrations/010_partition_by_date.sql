@@ -0,0 +1,68 @@
+--
+-- Partitions `email_attributes` and `message_label` by the date of the messages (range of
+-- UNIX_TIMESTAMP(`internal_timestamp`)), so that the date conditions of the rules prune the partitions:
+--  * partitioned tables can not have FULLTEXT indexes: the text columns are copied to `email_search`, which holds
+--    them instead
+--  * partitioned tables can not have foreign keys: the rows are deleted along with their emails by the application
+--  * the partitioning column is part of every unique key: `message_label` gets the `internal_timestamp` of its
+--    message (the oldest possible one when the message has no attributes)
+-- Both tables are created with a single partition; run src/scripts/archive_script.py afterwards (and then monthly) to
+-- split them into monthly partitions for the recent mail and yearly partitions for the older mail.
+-- InnoDB builds one FULLTEXT index per statement.
+--
+use `google_mail`;
+
+CREATE TABLE `email_search` (
+  `message_id` bigint unsigned NOT NULL,
+  `from` varchar(100) NOT NULL,
+  `to` varchar(5000) NOT NULL,
+  `subject` text NOT NULL,
+  `cc` varchar(5000) DEFAULT NULL,
+  `bcc` varchar(5000) DEFAULT NULL,
+  PRIMARY KEY (`message_id`),
+  CONSTRAINT `fk_es_email_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
+) ENGINE=InnoDB COMMENT="Text of the emails searched by the rules";
+
+INSERT INTO `email_search`(`message_id`, `from`, `to`, `subject`, `cc`, `bcc`)
+SELECT `message_id`, `from`, `to`, `subject`, `cc`, `bcc` FROM `email_attributes`;
+
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_subject` (`subject`);
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_from` (`from`);
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_to` (`to`);
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_cc` (`cc`);
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_bcc` (`bcc`);
+
+ALTER TABLE `email_attributes`
+  DROP FOREIGN KEY `fk_ea_lbl_email_id`,
+  DROP INDEX `ft_ea_subject`,
+  DROP INDEX `ft_ea_from`,
+  DROP INDEX `ft_ea_to`,
+  DROP INDEX `ft_ea_cc`,
+  DROP INDEX `ft_ea_bcc`,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`message_id`, `internal_timestamp`);
+
+ALTER TABLE `email_attributes`
+  PARTITION BY RANGE (UNIX_TIMESTAMP(`internal_timestamp`)) (PARTITION `pmax` VALUES LESS THAN MAXVALUE);
+
+ALTER TABLE `message_label` DROP FOREIGN KEY `fk_ml_lbl_email_id`;
+RENAME TABLE `message_label` TO `message_label_unpartitioned`;
+
+CREATE TABLE `message_label` (
+  `message_id` bigint unsigned NOT NULL,
+  `label_id` varchar(255) NOT NULL,
+  `internal_timestamp` timestamp NOT NULL,
+  `refreshed_on` datetime NOT NULL,
+  PRIMARY KEY (`message_id`,`label_id`,`internal_timestamp`),
+  KEY `idx_ml_label_id` (`label_id`,`message_id`)
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`internal_timestamp`)) (PARTITION `pmax` VALUES LESS THAN MAXVALUE);
+
+-- Should match UNKNOWN_INTERNAL_TIMESTAMP (src/models/email.py)
+INSERT INTO `message_label`(`message_id`, `label_id`, `internal_timestamp`, `refreshed_on`)
+SELECT `ml`.`message_id`, `ml`.`label_id`, COALESCE(`ea`.`internal_timestamp`, '1970-01-02 00:00:00'),
+       `ml`.`refreshed_on`
+FROM `message_label_unpartitioned` `ml`
+LEFT JOIN `email_attributes` `ea` ON `ea`.`message_id` = `ml`.`message_id`;
+
+DROP TABLE `message_label_unpartitioned`;
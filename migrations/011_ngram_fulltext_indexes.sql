@@ -0,0 +1,24 @@
+--
+-- Rebuilds the FULLTEXT indexes with the ngram parser, so that they serve substring searches: the 'contains' and
+-- 'contains word' rule predicates search the ngrams of their value (see FULLTEXT_NGRAM_TOKEN_SIZE, which should match
+-- the ngram_token_size setting of the server) and check the exact match on the rows found.
+-- The ngram parser leaves out the ngrams containing a stopword (Eg. 'a' or 'i'), hence the indexes are built without
+-- stopwords.
+-- InnoDB builds one FULLTEXT index per statement.
+--
+use `google_mail`;
+
+SET SESSION innodb_ft_enable_stopword = OFF;
+
+ALTER TABLE `email_search` DROP INDEX `ft_es_subject`;
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_subject` (`subject`) WITH PARSER ngram;
+ALTER TABLE `email_search` DROP INDEX `ft_es_from`;
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_from` (`from`) WITH PARSER ngram;
+ALTER TABLE `email_search` DROP INDEX `ft_es_to`;
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_to` (`to`) WITH PARSER ngram;
+ALTER TABLE `email_search` DROP INDEX `ft_es_cc`;
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_cc` (`cc`) WITH PARSER ngram;
+ALTER TABLE `email_search` DROP INDEX `ft_es_bcc`;
+ALTER TABLE `email_search` ADD FULLTEXT KEY `ft_es_bcc` (`bcc`) WITH PARSER ngram;
+ALTER TABLE `message_part` DROP INDEX `ft_mp_content`;
+ALTER TABLE `message_part` ADD FULLTEXT KEY `ft_mp_content` (`content`) WITH PARSER ngram;
@@ -0,0 +1,22 @@
+--
+-- Recomputes the `participants` of the thread summaries from the From, To and Cc headers of their messages (they were
+-- the senders only). Should match SUMMARY_QUERY (src/models/thread_summary.py).
+--
+use `google_mail`;
+
+-- Should match THREAD_SUMMARY_MAX_TEXT_SIZE.
+SET SESSION group_concat_max_len = 16384;
+
+UPDATE `thread_summary`
+JOIN (
+  SELECT email.thread_id,
+         group_concat(distinct nullif(elt(header.number, email_attributes.`from`, email_attributes.`to`,
+                                          email_attributes.`cc`), '')
+                      order by nullif(elt(header.number, email_attributes.`from`, email_attributes.`to`,
+                                          email_attributes.`cc`), '')
+                      separator ', ') AS participants
+  FROM email JOIN email_attributes ON email_attributes.message_id = email.id
+  JOIN (SELECT 1 AS number UNION ALL SELECT 2 UNION ALL SELECT 3) header
+  GROUP BY email.thread_id
+) `summary` ON `summary`.thread_id = `thread_summary`.thread_id
+SET `thread_summary`.`participants` = `summary`.participants;
@@ -3,6 +3,10 @@ CREATE DATABASE `google_mail`;
 
 use `google_mail`;
 
+-- The FULLTEXT indexes use the ngram parser, which indexes every substring of ngram_token_size characters (see
+-- FULLTEXT_NGRAM_TOKEN_SIZE), without stopwords
+SET SESSION innodb_ft_enable_stopword = OFF;
+
 --
 -- Table structure for table `email`
 --
@@ -12,11 +16,16 @@ CREATE TABLE `email` (
   `id` bigint unsigned NOT NULL,
   `thread_id` bigint unsigned NOT NULL,
   `refreshed_on` datetime NOT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `idx_email_refreshed_on` (`refreshed_on`),
+  KEY `idx_email_thread_id` (`thread_id`)
 ) ENGINE=InnoDB COMMENT="This table captures message id as ";
 
 --
 -- Table structure for table `email_attributes`
+-- Partitioned by date (see src/scripts/archive_script.py), so that the date conditions of the rules prune the
+-- partitions. Partitioned tables can have neither foreign keys nor FULLTEXT indexes: the rows are deleted along with
+-- their emails by the application, and the text columns are searched through `email_search`.
 --
 
 DROP TABLE IF EXISTS `email_attributes`;
@@ -30,15 +39,49 @@ CREATE TABLE `email_attributes` (
   `cc` varchar(5000) DEFAULT NULL,
   `bcc` varchar(5000) DEFAULT NULL,
   `size_estimate` int NOT NULL,
-  `payload_headers` json DEFAULT NULL,
   `refreshed_on` datetime NOT NULL,
-  PRIMARY KEY (`message_id`),
+  PRIMARY KEY (`message_id`,`internal_timestamp`),
   KEY `idx_email_timestamp` (`internal_timestamp`),
   KEY `idx_ea_from` (`from`),
   KEY `idx_ea_to` (`to`(100)),
-  KEY `idx_ea_subject` (`subject`(200)),
-  CONSTRAINT `fk_ea_lbl_email_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
-) ENGINE=InnoDB;
+  KEY `idx_ea_subject` (`subject`(200))
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`internal_timestamp`)) (PARTITION `pmax` VALUES LESS THAN MAXVALUE);
+
+--
+-- Table structure for table `email_search`
+-- Copy of the text columns of `email_attributes`, holding their FULLTEXT indexes
+--
+
+DROP TABLE IF EXISTS `email_search`;
+CREATE TABLE `email_search` (
+  `message_id` bigint unsigned NOT NULL,
+  `from` varchar(100) NOT NULL,
+  `to` varchar(5000) NOT NULL,
+  `subject` text NOT NULL,
+  `cc` varchar(5000) DEFAULT NULL,
+  `bcc` varchar(5000) DEFAULT NULL,
+  PRIMARY KEY (`message_id`),
+  FULLTEXT KEY `ft_es_subject` (`subject`) WITH PARSER ngram,
+  FULLTEXT KEY `ft_es_from` (`from`) WITH PARSER ngram,
+  FULLTEXT KEY `ft_es_to` (`to`) WITH PARSER ngram,
+  FULLTEXT KEY `ft_es_cc` (`cc`) WITH PARSER ngram,
+  FULLTEXT KEY `ft_es_bcc` (`bcc`) WITH PARSER ngram,
+  CONSTRAINT `fk_es_email_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
+) ENGINE=InnoDB COMMENT="Text of the emails searched by the rules";
+
+--
+-- Table structure for table `email_headers`
+-- Cold storage of the message headers, kept apart from the columns queried by the rules
+--
+
+DROP TABLE IF EXISTS `email_headers`;
+CREATE TABLE `email_headers` (
+  `message_id` bigint unsigned NOT NULL,
+  `payload_headers` json DEFAULT NULL,
+  PRIMARY KEY (`message_id`),
+  CONSTRAINT `fk_eh_email_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
+) ENGINE=InnoDB ROW_FORMAT=COMPRESSED COMMENT="Headers of the emails";
 
 --
 -- Table structure for table `label`
@@ -56,16 +99,19 @@ CREATE TABLE `label` (
 
 --
 -- Table structure for table `message_label`
+-- Partitioned by the date of the messages, as `email_attributes`
 --
 
 DROP TABLE IF EXISTS `message_label`;
 CREATE TABLE `message_label` (
   `message_id` bigint unsigned NOT NULL,
-  `labels` json NOT NULL,
+  `label_id` varchar(255) NOT NULL,
+  `internal_timestamp` timestamp NOT NULL,
   `refreshed_on` datetime NOT NULL,
-  PRIMARY KEY (`message_id`),
-  CONSTRAINT `fk_ml_lbl_email_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
-) ENGINE=InnoDB;
+  PRIMARY KEY (`message_id`,`label_id`,`internal_timestamp`),
+  KEY `idx_ml_label_id` (`label_id`,`message_id`)
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`internal_timestamp`)) (PARTITION `pmax` VALUES LESS THAN MAXVALUE);
 
 --
 -- Table structure for table `message_part`
@@ -76,7 +122,7 @@ CREATE TABLE `message_part` (
   `message_id` bigint unsigned NOT NULL,
   `part_id` varchar(20) NOT NULL,
   `parent_id` varchar(20) DEFAULT NULL,
-  `content` text NOT NULL,
+  `content` mediumtext NOT NULL,
   `mime_type` varchar(50) DEFAULT NULL,
   `filename` varchar(100) DEFAULT NULL,
   `refreshed_on` datetime NOT NULL,
@@ -85,7 +131,43 @@ CREATE TABLE `message_part` (
   KEY `idx_part_id` (`part_id`),
   KEY `idx_mp_message_id` (`message_id`),
   KEY `idx_mp_search_content` (`message_id`,`content`(500)),
-  KEY `fk_part_parent_id` (`parent_id`),
-  CONSTRAINT `fk_part_parent_id` FOREIGN KEY (`parent_id`) REFERENCES `message_part` (`part_id`),
+  FULLTEXT KEY `ft_mp_content` (`content`) WITH PARSER ngram,
+  KEY `idx_mp_parent_id` (`parent_id`),
   CONSTRAINT `fk_part_msg_id` FOREIGN KEY (`message_id`) REFERENCES `email` (`id`)
 ) ENGINE=InnoDB ;
+
+--
+-- Table structure for table `thread_summary`
+--
+DROP TABLE IF EXISTS `thread_summary`;
+CREATE TABLE `thread_summary` (
+  `thread_id` bigint unsigned NOT NULL,
+  `message_count` int unsigned NOT NULL,
+  `first_timestamp` timestamp NULL DEFAULT NULL,
+  `last_timestamp` timestamp NULL DEFAULT NULL,
+  `participants` text,
+  `label_ids` text,
+  `refreshed_on` datetime NOT NULL,
+  PRIMARY KEY (`thread_id`),
+  KEY `idx_ts_last_timestamp` (`last_timestamp`),
+  KEY `idx_ts_first_timestamp` (`first_timestamp`)
+) ENGINE=InnoDB COMMENT="Aggregates of the stored messages of each thread";
+
+--
+-- Table structure for table `sync_state`
+--
+DROP TABLE IF EXISTS `sync_state`;
+CREATE TABLE `sync_state` (
+  `name` varchar(100) NOT NULL,
+  `history_id` bigint unsigned DEFAULT NULL,
+  `parameters` json DEFAULT NULL,
+  `page_token` varchar(255) DEFAULT NULL,
+  `last_batch` int unsigned NOT NULL DEFAULT 0,
+  `status` varchar(20) DEFAULT NULL,
+  `message_count` int unsigned NOT NULL DEFAULT 0,
+  `attempts` int unsigned NOT NULL DEFAULT 0,
+  `error` varchar(1000) DEFAULT NULL,
+  `started_on` datetime DEFAULT NULL,
+  `refreshed_on` datetime NOT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB COMMENT="Last synchronized history checkpoint of the mailbox and the progress of the downloads";
@@ -0,0 +1,112 @@
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+from config.settings import ARCHIVE_HOT_MONTHS, ARCHIVE_MONTHS_AHEAD, ARCHIVE_PARTITIONED_TABLES
+from lib.db_utils import DBUtils
+from lib.logger_utils import get_logger
+from models.email import EmailDAO
+from models.partition import PartitionDAO, MAXVALUE_PARTITION
+
+LOGGER = get_logger(__name__)
+
+
+def get_partition_bounds(oldest, now, hot_months=ARCHIVE_HOT_MONTHS, months_ahead=ARCHIVE_MONTHS_AHEAD):
+    """
+    :brief: Returns the upper bounds of the partitions of a table, from the oldest email to now:
+             * one partition per year, for the mail older than hot_months (the first one holds all the older mail)
+             * one partition per month for the recent mail, and months_ahead months ahead of now
+            The last partition (MAXVALUE) is not included.
+    :param oldest: timestamp of the oldest stored email. None when there is none.
+    :return: sorted list of the bounds (datetime)
+    """
+    current_month = datetime(now.year, now.month, 1)
+    hot_start = current_month - relativedelta(months=hot_months)
+    bounds = [datetime(year, 1, 1) for year in range(oldest.year + 1, hot_start.year + 1)] if oldest else []
+    if not bounds or bounds[-1] != hot_start:
+        bounds.append(hot_start)
+    for months in range(1, hot_months + months_ahead + 1):
+        bounds.append(hot_start + relativedelta(months=months))
+    return bounds
+
+
+def get_partition_name(bound):
+    """
+    :return: name of the partition of the bound (epoch seconds, None for MAXVALUE)
+    """
+    return MAXVALUE_PARTITION if bound is None else f'p{datetime.fromtimestamp(bound):%Y%m%d}'
+
+
+def plan_reorganization(partitions, bounds):
+    """
+    :brief: Compares the partitions of a table with the wanted ones. The partitions are split at the boundaries
+            both share, and each range whose partitions differ is reorganized into the wanted ones.
+    :param partitions: the partitions of the table (see PartitionDAO.get_partitions)
+    :param bounds: bounds of the wanted partitions, in epoch seconds (the MAXVALUE partition is added)
+    :return: list of (names of the partitions to be reorganized, list of the (name, bound) of the new partitions)
+    """
+    wanted = [(get_partition_name(bound), bound) for bound in sorted(bounds)] + [(MAXVALUE_PARTITION, None)]
+    existing = [(partition['name'], partition['bound']) for partition in partitions]
+
+    def key(bound):
+        return float('inf') if bound is None else bound
+
+    shared_bounds = sorted({key(bound) for _, bound in existing} & {key(bound) for _, bound in wanted})
+    plan, lower = [], float('-inf')
+    for upper in shared_bounds:
+        current = [(name, bound) for name, bound in existing if lower < key(bound) <= upper]
+        target = [(name, bound) for name, bound in wanted if lower < key(bound) <= upper]
+        if [bound for _, bound in current] != [bound for _, bound in target]:
+            plan.append(([name for name, _ in current], target))
+        lower = upper
+    return plan
+
+
+class Archiver(object):
+    """
+    Maintains the partitions of the tables partitioned by date (ARCHIVE_PARTITIONED_TABLES). The recent mail is
+    kept in monthly partitions, created months_ahead months in advance. Once older than hot_months, the monthly
+    partitions are compacted into a single partition per year: reorganizing them rebuilds their rows compactly, and
+    the old mail is left out of the partitions the daily work reads and writes.
+    Meant to be run monthly. The first run splits the single partition of a new table.
+    """
+
+    def __init__(self, hot_months=ARCHIVE_HOT_MONTHS, months_ahead=ARCHIVE_MONTHS_AHEAD):
+        """
+        :param hot_months: months of mail kept in monthly partitions
+        :param months_ahead: months of monthly partitions created ahead of now
+        """
+        self.hot_months = hot_months
+        self.months_ahead = months_ahead
+
+    def plan(self, table):
+        """
+        :return: (current partitions, reorganizations) of the table - see plan_reorganization
+        """
+        with DBUtils.pooled_connection() as connection:
+            oldest = EmailDAO(connection).get_oldest_timestamp()
+            partitions = PartitionDAO(connection).get_partitions(table)
+        if not partitions or partitions[-1]['bound'] is not None:
+            raise ValueError(f"{table} is not partitioned by range with a MAXVALUE partition")
+        bounds = get_partition_bounds(oldest, datetime.now(), self.hot_months, self.months_ahead)
+        return partitions, plan_reorganization(partitions, [int(bound.timestamp()) for bound in bounds])
+
+    def run(self, tables=ARCHIVE_PARTITIONED_TABLES, dry_run=False):
+        """
+        :brief: Reorganizes the partitions of the tables as planned (see plan)
+        :param dry_run: True to only report the plan
+        :return: dict of table -> list of the reorganizations, as (names of the partitions reorganized, estimated
+                 number of rows moved, list of the (name, bound) of the new partitions)
+        """
+        reorganizations = {}
+        for table in tables:
+            partitions, plan = self.plan(table)
+            rows = {partition['name']: partition['rows'] for partition in partitions}
+            reorganizations[table] = [(partition_names, sum(rows[name] for name in partition_names), new_partitions)
+                                      for partition_names, new_partitions in plan]
+            if not dry_run:
+                for partition_names, new_partitions in plan:
+                    with DBUtils.pooled_connection() as connection:
+                        PartitionDAO(connection).reorganize_partitions(table, partition_names, new_partitions)
+            LOGGER.info(f"{'Planned' if dry_run else 'Ran'} {len(plan)} reorganizations of {table}")
+        return reorganizations
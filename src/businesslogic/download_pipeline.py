@@ -0,0 +1,144 @@
+import queue
+import threading
+
+from config.settings import DOWNLOAD_FETCH_WORKERS, DOWNLOAD_QUEUE_SIZE
+from lib import metrics
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+_END_OF_STREAM = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class DownloadPipeline(object):
+    """
+    Runs a download as three stages joined by bounded queues, so that listing, fetching and saving overlap:
+        1. Lister (the calling thread) iterates over the pages of message ids
+        2. Fetch workers (fetch_workers threads) get the message contents of a page
+        3. Writer (a single thread) saves the fetched messages to the database
+    When a queue is full the stage feeding it waits, which bounds the number of pages held in memory.
+    """
+
+    def __init__(self, fetch, persist, fetch_workers=DOWNLOAD_FETCH_WORKERS, queue_size=DOWNLOAD_QUEUE_SIZE,
+                 on_progress=None):
+        """
+        :param fetch: callable(messages) returning the fetched results for a page of message ids.
+                      Called from the fetch worker threads.
+        :param persist: callable(messages, results) saving a fetched page. Called from the writer thread only.
+        :param fetch_workers: number of pages fetched concurrently
+        :param queue_size: maximum number of pages waiting between two stages
+        :param on_progress: callable(page_count) called from the writer thread whenever the first page_count pages
+                            (in the order of the input) are all persisted. Pages may be persisted out of order.
+        """
+        self.fetch = fetch
+        self.persist = persist
+        self.on_progress = on_progress
+        self.fetch_workers = max(1, fetch_workers)
+        self.__fetch_queue = queue.Queue(maxsize=queue_size)
+        self.__write_queue = queue.Queue(maxsize=queue_size)
+        self.__stopped = threading.Event()
+        self.__error = None
+
+    def _put(self, target_queue, item):
+        # Gives up waiting for room in the queue once another stage has failed
+        while not self.__stopped.is_set():
+            try:
+                target_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise PipelineAborted()
+
+    def _get(self, source_queue):
+        while not self.__stopped.is_set():
+            try:
+                return source_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        raise PipelineAborted()
+
+    def _fail(self, ex):
+        if self.__error is None:
+            self.__error = ex
+            LOGGER.exception(f"Download pipeline stopped. Details: {ex}")
+        self.__stopped.set()
+
+    def _fetch_worker(self):
+        try:
+            while True:
+                item = self._get(self.__fetch_queue)
+                if item is _END_OF_STREAM:
+                    return
+                page_index, messages = item
+                with metrics.timed('download_stage_seconds', stage='fetch'):
+                    results = self.fetch(messages)
+                self._put(self.__write_queue, (page_index, messages, results))
+        except PipelineAborted:
+            pass
+        except Exception as ex:
+            self._fail(ex)
+
+    def _writer(self):
+        persisted_pages = set()
+        contiguous_count = 0  # Number of pages persisted from the start, without a gap
+        try:
+            while True:
+                item = self._get(self.__write_queue)
+                if item is _END_OF_STREAM:
+                    return
+                page_index, messages, results = item
+                with metrics.timed('download_stage_seconds', stage='save'):
+                    self.persist(messages, results)
+                metrics.increment('download_pages_total')
+                persisted_pages.add(page_index)
+                if contiguous_count in persisted_pages:
+                    while contiguous_count in persisted_pages:
+                        persisted_pages.remove(contiguous_count)
+                        contiguous_count += 1
+                    if self.on_progress:
+                        self.on_progress(contiguous_count)
+        except PipelineAborted:
+            pass
+        except Exception as ex:
+            self._fail(ex)
+
+    def run(self, pages):
+        """
+        :brief: Runs the pipeline till all the pages are fetched and saved
+        :param pages: iterable of message id lists (one item per page)
+        :return: number of pages processed
+        :raises: the first exception raised by any of the stages
+        """
+        workers = [threading.Thread(target=self._fetch_worker, name=f'fetch-worker-{index}', daemon=True)
+                   for index in range(self.fetch_workers)]
+        writer = threading.Thread(target=self._writer, name='db-writer', daemon=True)
+        for thread in workers + [writer]:
+            thread.start()
+        page_count = 0
+        try:
+            for messages in pages:
+                self._put(self.__fetch_queue, (page_count, messages))
+                page_count += 1
+            for _ in workers:
+                self._put(self.__fetch_queue, _END_OF_STREAM)
+            for thread in workers:
+                thread.join()
+            self._put(self.__write_queue, _END_OF_STREAM)
+            writer.join()
+        except PipelineAborted:
+            pass
+        except BaseException as ex:
+            self._fail(ex)
+            raise
+        finally:
+            self.__stopped.set()
+            for thread in workers + [writer]:
+                thread.join()
+        if self.__error is not None:
+            raise self.__error
+        LOGGER.info(f"Download pipeline completed. Pages processed: {page_count}")
+        return page_count
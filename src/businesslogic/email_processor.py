@@ -1,80 +1,323 @@
-from lib.google_api import GoogleAPIHelper
+import threading
+import time
+from functools import partial
+from itertools import islice
+
+from googleapiclient.errors import HttpError
+
+from lib.google_api import GoogleAPIHelper, LazyService
+from lib import metrics
 from lib.db_utils import DBUtils
 from lib.logger_utils import get_logger
-from config.settings import MESSAGE_FORMAT_MINIMAL, BATCH_FETCH_EMAIL_SIZE
+from lib.message_cache import MessageCache
+from lib.request_scheduler import GmailRequestScheduler, QUOTA_UNITS, is_retryable
+from config.settings import MESSAGE_FORMAT_FULL, MESSAGE_FORMAT_MINIMAL, MESSAGE_FORMAT_METADATA, QUERYABLE_HEADERS, \
+    MAX_LIST_PAGE_SIZE, MAILBOX_SYNC_NAME, HISTORY_TYPES, DOWNLOAD_FETCH_WORKERS, GMAIL_MAX_RETRIES, \
+    GMAIL_QUOTA_UNITS_PER_SECOND, DOWNLOAD_SYNC_NAME, DOWNLOAD_CHECKPOINT_INTERVAL
+from businesslogic.download_pipeline import DownloadPipeline
 from models.email import EmailDAO
+from models.sync_state import SyncStateDAO, SYNC_RUNNING, SYNC_DONE, SYNC_FAILED
 
 LOGGER = get_logger(__name__)
 
 
 class EmailProcessor(object):
-    def __init__(self):
-        self.service = GoogleAPIHelper().get_service_instance()
-        self.__connection = None
+    def __init__(self, fetch_workers=DOWNLOAD_FETCH_WORKERS, use_cache=False, service_factory=None,
+                 quota_units_per_second=GMAIL_QUOTA_UNITS_PER_SECOND):
+        """
+        :param fetch_workers: number of pages of messages fetched concurrently
+        :param use_cache: True to keep the fetched messages in the on-disk message cache
+        :param service_factory: callable returning a new Gmail service object. Defaults to the Gmail API
+                                (see lib/fake_gmail.py for a local stand-in)
+        :param quota_units_per_second: share of the per user Gmail quota used by this processor
+        """
+        self.service_factory = service_factory or (lambda: GoogleAPIHelper().get_service_instance())
+        self.service = LazyService(self.service_factory)
         self.__max_fetch_limit = None
+        self.__worker_services = {}  # Gmail service of each fetch worker, by thread name
         self.fetch_mode = None
+        self.fetch_workers = fetch_workers
+        self.scheduler = GmailRequestScheduler(max_concurrency=fetch_workers, units_per_second=quota_units_per_second)
+        self.message_count = 0  # Number of messages saved by the processor
+        self.cache = MessageCache() if use_cache else None
+        self.__checkpoint = None  # Progress of the checkpointed download in progress
+        # Ids of the messages added or relabelled by the last incremental sync. None after a full sync.
+        self.changed_message_ids = None
+        self.synced_history_id = None  # History checkpoint saved by the last sync
 
-    def _get_connection(self):
-        self.__connection = DBUtils.renew_or_get_new_connection(self.__connection)
-        return self.__connection
+    def download_and_save_labels(self):
+        labels = self.scheduler.execute(self.service.users().labels().list(userId='me'), 'labels.list')
+        with DBUtils.pooled_connection() as connection:
+            email_dao = EmailDAO(connection)
+            email_dao.remove_all_labels()
+            # insert labels into the database
+            for label in labels.get('labels'):
+                email_dao.insert_label(label)
+            connection.commit()
 
-    def _download_and_save_labels(self):
-        EmailDAO(self._get_connection()).remove_all_labels()
-        labels = self.service.users().labels().list(userId='me').execute()
-        # insert labels into the database
-        for label in labels.get('labels'):
-            EmailDAO(self._get_connection()).insert_label(label)
-        self.__connection.commit()
+    @staticmethod
+    def _get_checkpoint():
+        with DBUtils.pooled_connection() as connection:
+            return SyncStateDAO(connection).get_history_id(MAILBOX_SYNC_NAME)
 
-    def _batch_get_email_details(self, messages):
+    def _save_checkpoint(self, history_id):
+        with DBUtils.pooled_connection() as connection:
+            SyncStateDAO(connection).save_history_id(MAILBOX_SYNC_NAME, history_id)
+        self.synced_history_id = history_id
+
+    def _get_worker_service(self):
+        # Gmail service objects (httplib2) are not thread safe. Hence, each fetch worker builds its own.
+        # They are kept by worker name, so that the workers of the next downloads reuse them (and their connections).
+        name = threading.current_thread().name
+        if name not in self.__worker_services:
+            self.__worker_services[name] = self.service_factory()
+        return self.__worker_services[name]
+
+    @staticmethod
+    def _get_message_request(service, message_id, message_format):
+        """
+        :brief: Returns the GET message request for the format, asking only for the parts of the message it saves
+        """
+        kwargs = {'userId': 'me', 'id': message_id, 'format': message_format}
+        if message_format == MESSAGE_FORMAT_METADATA:
+            kwargs['metadataHeaders'] = list(QUERYABLE_HEADERS)
+        return service.users().messages().get(**kwargs)
+
+    def _execute_batch(self, service, messages, message_format, responses):
         """
-        Bulk fetches email contents in multiples of BATCH_FETCH_EMAIL_SIZE
+        :brief: Fetches the messages with a single batch request, within the quota and concurrency of the scheduler
+        :param messages: list of messages (id, threadId) to be fetched
+        :param message_format: One of full, metadata or minimal
+        :param responses: list to which the GET message responses are appended
+        :return: list of messages whose requests failed with a retryable error
         """
+        messages_by_id = {message['id']: message for message in messages}
+        failed_messages = []
 
-        def sync_emails(request_id, response, exception):
+        def collect_email(request_id, response, exception):
             """
-            :brief: Callback method that syncs the GET message response to the database
-            :param request_id: request id, if set in add() method can be accessed here.
+            :brief: Callback method that collects the GET message response of each request in the batch
+            :param request_id: request id, set to the message id in add() method.
             :param response: Response body containing the message information
             :param exception: When the GET call fails due to an exception, the same is available in this param
             """
-            LOGGER.debug(f"Request_id {request_id}")
+            LOGGER.debug("Request_id %s", request_id)
             if exception is None:
-                self._get_connection()
-                if self.fetch_mode == MESSAGE_FORMAT_MINIMAL:
-                    EmailDAO(self.__connection).upsert_labels(response)
-                else:
-                    EmailDAO(self.__connection).upsert_attributes_and_label(response)
+                responses.append(response)
+            elif is_retryable(exception):
+                failed_messages.append(messages_by_id[request_id])
             else:
-                LOGGER.error(f"Exception while getting message. Details: {exception}")
-
-        count = 0
-        message_len = len(messages)
-        batch = self.service.new_batch_http_request(callback=sync_emails)
-        # Outer for loop determines the number of batches needed
-        for batch_id in range(0, ((message_len - 1) // BATCH_FETCH_EMAIL_SIZE) + 1):
-            batch_count = 0
-            # The while loop queues up the GET requests till either the batch size is reached or
-            # all the message ids are processed
-            while True:
-                batch.add(self.service.users().messages().get(userId='me', id=messages[count]['id'], format='full'))
-                batch_count += 1
-                count += 1
-                if batch_count == BATCH_FETCH_EMAIL_SIZE or count == message_len:
+                LOGGER.error(f"Exception while getting message {request_id}. Details: {exception}")
+
+        with self.scheduler.batch_slot():
+            self.scheduler.quota.acquire(QUOTA_UNITS['messages.get'] * len(messages))
+            batch = service.new_batch_http_request(callback=collect_email)
+            for message in messages:
+                batch.add(self._get_message_request(service, message['id'], message_format), request_id=message['id'])
+            try:
+                with metrics.timed('gmail_request_seconds', method='batch'):
                     batch.execute()
+            except Exception as ex:
+                if not is_retryable(ex):
+                    raise
+                LOGGER.warning(f"Batch request failed. Details: {ex}")
+                # Messages collected before the failure are kept, the rest are retried
+                received_ids = {response['id'] for response in responses}
+                failed_messages = [message for message in messages if message['id'] not in received_ids]
+        self.scheduler.record_batch(len(messages), len(failed_messages))
+        metrics.increment('gmail_messages_fetched_total', len(messages) - len(failed_messages), format=message_format)
+        if failed_messages:
+            metrics.increment('gmail_retryable_failures_total', len(failed_messages))
+        return failed_messages
+
+    def _fetch_messages(self, messages, message_format):
+        """
+        :brief: Bulk fetches email contents in batches sized by the request scheduler.
+                Only the messages whose requests failed with a retryable error (rate limited / server errors) are
+                fetched again, after a backoff, up to GMAIL_MAX_RETRIES times.
+        :param messages: list of messages (id, threadId) as returned by the list API
+        :param message_format: One of full, metadata or minimal
+        :return: list of GET message responses. Messages failing with other errors are logged and skipped.
+        """
+        service = self._get_worker_service()
+        responses = []
+        pending_messages = messages
+        attempt = 0
+        while pending_messages:
+            retry_messages = []
+            start = 0
+            while start < len(pending_messages):
+                current_messages = pending_messages[start:start + self.scheduler.batch_size]
+                start += len(current_messages)
+                retry_messages.extend(self._execute_batch(service, current_messages, message_format, responses))
+                LOGGER.info(f"Processed batch of {len(current_messages)} messages")
+            pending_messages = retry_messages
+            if pending_messages:
+                attempt += 1
+                if attempt > GMAIL_MAX_RETRIES:
+                    LOGGER.error(f"Giving up on {len(pending_messages)} messages after {GMAIL_MAX_RETRIES} retries: "
+                                 f"{[message['id'] for message in pending_messages]}")
                     break
-            LOGGER.info(f"Processed batch # {batch_id}. Batch size: {BATCH_FETCH_EMAIL_SIZE}")
+                self.scheduler.backoff(attempt)
+        return responses
+
+    def _get_cached_response(self, message, cached_history_id):
+        """
+        :brief: Returns the cached GET message response of the message, with the labels of the message when it is
+                newer than the cached one. The cache entry is then updated.
+        :param message: a message holding its labels and history id (Eg. a minimal GET message response)
+        :param cached_history_id: history id of the cached message (see MessageCache.get_history_id)
+        """
+        response = self.cache.get(message['id'])
+        if int(message['historyId']) > cached_history_id:
+            response['labelIds'] = message.get('labelIds') or []
+            response['historyId'] = message['historyId']
+            self.cache.put(response)
+        return response
+
+    def _batch_get_email_details(self, messages):
+        """
+        :brief: Fetches the messages in the fetch mode. Runs on a fetch worker thread.
+                With the message cache, the content of the cached messages is read from it, since the content of a
+                message never changes:
+                 * the messages read from the history (see _sync_history) hold their labels as of their history id,
+                   hence they are not fetched at all
+                 * only the labels of the listed messages are fetched (minimal format): the request is still made,
+                   but the content is not transferred
+                The cache entries older than the labels are updated, and the messages fetched in full format are
+                added to the cache.
+        :param messages: list of messages (id, threadId) as returned by the list API, or with their labels and
+                         history id as read from the history
+        :return: list of GET message responses
+        """
+        if self.cache is None or self.fetch_mode == MESSAGE_FORMAT_MINIMAL:
+            return self._fetch_messages(messages, self.fetch_mode)
+        responses, listed_messages, uncached_messages = [], [], []
+        for message in messages:
+            cached_history_id = self.cache.get_history_id(message['id'])
+            if cached_history_id is None:
+                uncached_messages.append(message)
+            elif 'historyId' in message and 'labelIds' in message:
+                responses.append(self._get_cached_response(message, cached_history_id))
+            else:
+                listed_messages.append(message)
+        metrics.increment('message_cache_skipped_requests_total', len(responses))
+        for label_response in self._fetch_messages(listed_messages, MESSAGE_FORMAT_MINIMAL):
+            responses.append(self._get_cached_response(label_response,
+                                                       self.cache.get_history_id(label_response['id'])))
+        fetched_responses = self._fetch_messages(uncached_messages, self.fetch_mode)
+        if self.fetch_mode == MESSAGE_FORMAT_FULL:
+            for response in fetched_responses:
+                self.cache.put(response)
+        LOGGER.info(f"Fetched {len(messages) - len(uncached_messages)} of {len(messages)} messages from the cache "
+                    f"({len(listed_messages)} labels requested)")
+        return responses + fetched_responses
+
+    def _save_emails(self, email_dao, messages, responses):
+        """
+        :brief: Upserts the message ids of a page and buffers their fetched contents. Runs on the writer thread.
+        """
+        email_dao.bulk_insert_message_ids(messages)
+        self.message_count += len(messages)
+        for response in responses:
+            if self.fetch_mode == MESSAGE_FORMAT_MINIMAL:
+                email_dao.buffer_labels(response)
+            else:
+                email_dao.buffer_attributes_and_label(response,
+                                                      partial_headers=self.fetch_mode == MESSAGE_FORMAT_METADATA)
+                if self.fetch_mode == MESSAGE_FORMAT_FULL:
+                    email_dao.buffer_parts(response)
+
+    def _run_pipeline(self, pages, fetch=None):
+        # The connection is used by the writer thread only, till the pipeline completes
+        with DBUtils.pooled_connection() as connection:
+            email_dao = EmailDAO(connection)
+            on_progress = partial(self._save_download_progress, email_dao) if self.__checkpoint else None
+            DownloadPipeline(fetch or self._batch_get_email_details, partial(self._save_emails, email_dao),
+                             fetch_workers=self.fetch_workers, on_progress=on_progress).run(pages)
+            email_dao.flush()
+
+    def _save_download_progress(self, email_dao, page_count):
+        """
+        :brief: Saves the checkpoint of the download once the first page_count pages are saved, at most once every
+                DOWNLOAD_CHECKPOINT_INTERVAL seconds. Runs on the writer thread.
+                The buffered messages are flushed first, so that the checkpoint never gets ahead of the database.
+        """
+        checkpoint = self.__checkpoint
+        next_page_token, listed_count = checkpoint['pages'][page_count - 1]
+        if time.monotonic() - checkpoint['saved_at'] < DOWNLOAD_CHECKPOINT_INTERVAL and next_page_token is not None:
+            return
+        email_dao.flush()
+        SyncStateDAO(email_dao.connection).save_checkpoint(checkpoint['name'], next_page_token,
+                                                           checkpoint['last_batch'] + page_count,
+                                                           checkpoint['message_count'] + listed_count)
+        checkpoint['saved_at'] = time.monotonic()
+
+    def _skip_saved_messages(self, messages):
+        """
+        :brief: Removes the messages saved since the start of the resumed download from the page
+        """
+        with DBUtils.pooled_connection() as connection:
+            saved_ids = EmailDAO(connection).fetch_message_ids_saved_since([message['id'] for message in messages],
+                                                                           self.__checkpoint['started_on'])
+        if saved_ids:
+            LOGGER.info(f"Skipping {len(saved_ids)} messages saved before the download was interrupted")
+            metrics.increment('download_skipped_messages_total', len(saved_ids))
+        return [message for message in messages if message['id'] not in saved_ids]
+
+    def _list_messages(self, **kwargs):
+        """
+        :brief: Generator over the pages of messages (id, threadId) returned by the list API
+                Stops once max_fetch_limit messages are listed (when set).
+                For a checkpointed download, the page token following each page and the number of messages listed
+                till then are recorded, and the messages saved before a resumed download got interrupted are left
+                out (the page may be empty then).
+        :param kwargs: arguments supported by users.messages.list API
+        """
+        page_size = kwargs.get('maxResults') or MAX_LIST_PAGE_SIZE
+        remaining = self.__max_fetch_limit
+        while True:
+            kwargs['maxResults'] = page_size if remaining is None else min(page_size, remaining)
+            result = self.scheduler.execute(self.service.users().messages().list(**kwargs), 'messages.list')
+            if not result.get('messages'):
+                LOGGER.info("No more emails found with the matching filters")
+                break
+            messages = result['messages']
+            if remaining is not None:
+                messages = messages[:remaining]
+                remaining -= len(messages)
+            next_page_token = result.get('nextPageToken') if remaining != 0 else None
+            if self.__checkpoint:
+                pages = self.__checkpoint['pages']
+                pages.append((next_page_token, (pages[-1][1] if pages else 0) + len(messages)))
+                if self.__checkpoint['skip_saved']:
+                    messages = self._skip_saved_messages(messages)
+            yield messages
+            LOGGER.info(f"Next page token is {next_page_token}")
+            if remaining == 0:
+                LOGGER.info(f"Reached the maximum fetch limit of {self.__max_fetch_limit} messages")
+                break
+            if next_page_token:
+                kwargs['pageToken'] = next_page_token
+            else:
+                break
 
-    def _download_and_save_emails(self, fetch_mode, **kwargs):
+    def _download_and_save_emails(self, fetch_mode, checkpoint_name=None, **kwargs):
         """
         :brief: This method does the following operations with pagination till all the pages are processed.
                 1. Gets the message ids for all the messages (or for the given filter when supplied)
-                2. Upserts the message ids into the database
-                3. Bulk reads the email contents corresponding to the message ids and stores / syncs the same
-        :param fetch_mode:  One of full or minimal (Supported by Gmail messages.get API).
-                            Only labels and history id are fetched with minimal mode
+                2. Bulk reads the email contents corresponding to the message ids
+                3. Upserts the message ids into the database and stores / syncs the contents
+                The steps run concurrently on different pages (see DownloadPipeline).
+        :param fetch_mode:  One of full, metadata or minimal (Supported by Gmail messages.get API).
+                            Only labels and history id are fetched with minimal mode.
+                            Metadata mode fetches the QUERYABLE_HEADERS along with them, without the email body.
+        :param checkpoint_name: sync_state entry of the download (see SyncStateDAO.start_checkpoint), to checkpoint
+                                its progress. When the entry holds the checkpoint of an interrupted download, the
+                                listing continues from its page token.
         :param kwargs:  arguments supported by users.messages.list API.
                         Refer: https://developers.google.com/gmail/api/reference/rest/v1/users.messages/list#query-parameters
+        :return: number of emails saved by the download, including the ones saved before it got interrupted
         """
         defaults = {'userId': 'me'}
         self.fetch_mode = fetch_mode
@@ -82,21 +325,200 @@ class EmailProcessor(object):
             kwargs.update(defaults)
         else:
             kwargs = defaults
+        if checkpoint_name:
+            with DBUtils.pooled_connection() as connection:
+                saved_checkpoint = SyncStateDAO(connection).get_checkpoint(checkpoint_name)
+            self.__checkpoint = {'name': checkpoint_name, 'pages': [], 'saved_at': time.monotonic(),
+                                 'started_on': saved_checkpoint['started_on'],
+                                 'last_batch': saved_checkpoint['last_batch'],
+                                 'message_count': saved_checkpoint['message_count'],
+                                 # Pages after the last checkpoint may have been saved before the interruption
+                                 'skip_saved': bool(saved_checkpoint['last_batch'] or saved_checkpoint['page_token'])}
+            if saved_checkpoint['page_token']:
+                kwargs['pageToken'] = saved_checkpoint['page_token']
+                LOGGER.info(f"Resuming {checkpoint_name} after page {saved_checkpoint['last_batch']}")
+        message_count = self.message_count
+        try:
+            self._run_pipeline(self._list_messages(**kwargs))
+        finally:
+            checkpoint, self.__checkpoint = self.__checkpoint, None
+        if checkpoint:
+            return checkpoint['message_count'] + (checkpoint['pages'][-1][1] if checkpoint['pages'] else 0)
+        return self.message_count - message_count
+
+    def download_messages(self, fetch_mode, checkpoint_name=None, **kwargs):
+        """
+        :brief: Downloads the emails matching the list arguments, without the labels and the history checkpoint
+                (Eg. a shard of a backfill, see ShardedBackfill)
+        :param fetch_mode: One of full, metadata or minimal
+        :param checkpoint_name: sync_state entry checkpointing the progress of the download
+        :param kwargs: arguments supported by users.messages.list API
+        :return: number of emails saved
+        """
+        return self._download_and_save_emails(fetch_mode, checkpoint_name, **kwargs)
+
+    def get_current_history_id(self):
+        profile = self.scheduler.execute(self.service.users().getProfile(userId='me'), 'getProfile')
+        return int(profile['historyId'])
+
+    def _sync_history(self, fetch_mode, start_history_id):
+        """
+        :brief: Applies the mailbox changes recorded since start_history_id, as follows:
+                1. Reads all the history records (added, deleted messages and label changes) since the checkpoint
+                2. Removes the deleted messages from the database
+                3. Applies the label changes from the history records, without fetching the messages again
+                4. Fetches and saves the newly added messages (and the changed ones missing in the database)
+        :param fetch_mode: One of full, metadata or minimal. Applies to the newly added messages
+        :param start_history_id: history id saved at the end of the previous sync
+        :return: latest history id of the mailbox, to be saved as the next checkpoint
+        :raises: HttpError (404) when the checkpoint is too old to be served by the history API
+        """
+        self.fetch_mode = fetch_mode
+        added_messages, label_changes, deleted_ids = {}, {}, set()
+        kwargs = {'userId': 'me', 'startHistoryId': start_history_id, 'historyTypes': HISTORY_TYPES}
+        latest_history_id = start_history_id
         while True:
-            result = self.service.users().messages().list(**kwargs).execute()
-            if not result.get('messages'):
-                print("No emails found with the matching filters")
-                break
-            EmailDAO(self._get_connection()).bulk_insert_message_ids(result['messages'])
-            self._batch_get_email_details(result['messages'])
+            result = self.scheduler.execute(self.service.users().history().list(**kwargs), 'history.list')
+            for record in result.get('history', []):
+                # The message of a record carries all its labels as of that record, whose id is kept as its history
+                # id (see _batch_get_email_details)
+                for change in record.get('messagesAdded', []):
+                    added_messages[change['message']['id']] = dict(change['message'], historyId=record['id'])
+                for change in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                    label_changes[change['message']['id']] = dict(change['message'], historyId=record['id'])
+                for change in record.get('messagesDeleted', []):
+                    deleted_ids.add(change['message']['id'])
+            latest_history_id = int(result.get('historyId', latest_history_id))
             next_page_token = result.get('nextPageToken')
-            LOGGER.info(f"Next page token is {next_page_token}")
-            if next_page_token:
-                kwargs['pageToken'] = next_page_token
-            else:
+            if not next_page_token:
                 break
+            kwargs['pageToken'] = next_page_token
+        for message_id in deleted_ids:
+            added_messages.pop(message_id, None)
+            label_changes.pop(message_id, None)
+        for message_id in added_messages:
+            # Label changes of an added message come after its addition: it gets the labels of the latest one
+            if message_id in label_changes:
+                added_messages[message_id] = label_changes.pop(message_id)
+        LOGGER.info(f"History since {start_history_id}: {len(added_messages)} added, {len(deleted_ids)} deleted, "
+                    f"{len(label_changes)} relabelled")
+
+        with DBUtils.pooled_connection() as connection:
+            email_dao = EmailDAO(connection)
+            email_dao.delete_messages(list(deleted_ids))
+            # Label changes of messages that were never downloaded are treated as new messages
+            existing_ids = email_dao.fetch_existing_message_ids(list(label_changes))
+            for message_id in set(label_changes) - existing_ids:
+                added_messages[message_id] = label_changes.pop(message_id)
+            for message in label_changes.values():
+                email_dao.buffer_labels(message)
+            email_dao.flush()
+        self.changed_message_ids = set(added_messages) | set(label_changes)
+        messages = list(added_messages.values())
+        self._run_pipeline(messages[start:start + MAX_LIST_PAGE_SIZE]
+                           for start in range(0, len(messages), MAX_LIST_PAGE_SIZE))
+        return latest_history_id
+
+    @staticmethod
+    def _get_interrupted_download():
+        with DBUtils.pooled_connection() as connection:
+            checkpoint = SyncStateDAO(connection).get_checkpoint(DOWNLOAD_SYNC_NAME)
+        return checkpoint if checkpoint and checkpoint['status'] != SYNC_DONE else None
+
+    def _run_checkpointed_download(self, fetch_mode, history_id, **kwargs):
+        """
+        :brief: Runs the download recorded in the DOWNLOAD_SYNC_NAME entry. Saves the history checkpoint (when set)
+                once it completes.
+        """
+        try:
+            message_count = self._download_and_save_emails(fetch_mode, DOWNLOAD_SYNC_NAME, **kwargs)
+        except BaseException as ex:
+            with DBUtils.pooled_connection() as connection:
+                SyncStateDAO(connection).update_status(DOWNLOAD_SYNC_NAME, SYNC_FAILED, error=str(ex) or repr(ex))
+            raise
+        with DBUtils.pooled_connection() as connection:
+            SyncStateDAO(connection).update_status(DOWNLOAD_SYNC_NAME, SYNC_DONE, message_count)
+        if history_id:
+            self._save_checkpoint(history_id)
+
+    def resume_download(self):
+        """
+        :brief: Resumes the last full sync (or filtered download) when it was interrupted, with its original
+                arguments. Listing continues from the page token of its last checkpoint and the messages saved since
+                it started are not fetched again.
+        :return: False when there is no interrupted download
+        """
+        checkpoint = self._get_interrupted_download()
+        if not checkpoint:
+            return False
+        parameters = checkpoint['parameters']
+        LOGGER.info(f"Resuming the download started on {checkpoint['started_on']} after {checkpoint['last_batch']} "
+                    f"pages ({checkpoint['message_count']} messages)")
+        max_fetch_limit = parameters.get('max_fetch_limit')
+        self.__max_fetch_limit = max(0, max_fetch_limit - checkpoint['message_count']) \
+            if max_fetch_limit is not None else None
+        self.download_and_save_labels()
+        if self.__max_fetch_limit == 0:
+            with DBUtils.pooled_connection() as connection:
+                SyncStateDAO(connection).update_status(DOWNLOAD_SYNC_NAME, SYNC_DONE)
+            return True
+        with DBUtils.pooled_connection() as connection:
+            SyncStateDAO(connection).update_status(DOWNLOAD_SYNC_NAME, SYNC_RUNNING)
+        self._run_checkpointed_download(parameters['fetch_mode'], checkpoint['history_id'],
+                                        **parameters['list_arguments'])
+        return True
 
-    def download_emails_to_db(self, max_fetch_limit, fetch_mode, **kwargs):
+    def download_emails_to_db(self, max_fetch_limit, fetch_mode, incremental=False, **kwargs):
+        """
+        :brief: Downloads the labels and the emails to the database.
+                With incremental set, only the changes since the last saved history checkpoint are synchronized.
+                A full sync is run instead when there is no checkpoint yet or when it has expired.
+                The progress of a full sync is checkpointed, so that it can be resumed (see resume_download).
+        :param max_fetch_limit: maximum number of emails to be fetched with a full sync. None for no limit.
+        :param fetch_mode: One of full, metadata or minimal
+        :param incremental: True to synchronize from the last history checkpoint
+        :param kwargs: arguments supported by users.messages.list API (applies to a full sync)
+        """
         self.__max_fetch_limit = max_fetch_limit
-        self._download_and_save_labels()
-        self._download_and_save_emails(fetch_mode, **kwargs)
+        self.changed_message_ids = None
+        self.download_and_save_labels()
+        if incremental:
+            start_history_id = self._get_checkpoint()
+            if start_history_id:
+                try:
+                    history_id = self._sync_history(fetch_mode, start_history_id)
+                    self._save_checkpoint(history_id)
+                    return
+                except HttpError as ex:
+                    if ex.resp.status != 404:
+                        raise
+                    LOGGER.warning(f"History checkpoint {start_history_id} has expired. Running a full sync")
+            else:
+                LOGGER.info("No history checkpoint found. Running a full sync")
+        # The checkpoint is only valid when the whole mailbox gets synchronized
+        is_mailbox_sync = not (kwargs.get('q') or kwargs.get('labelIds') or max_fetch_limit)
+        # Taken before listing so that changes made while the sync runs are replayed by the next incremental sync
+        history_id = self.get_current_history_id() if is_mailbox_sync else None
+        with DBUtils.pooled_connection() as connection:
+            SyncStateDAO(connection).start_checkpoint(DOWNLOAD_SYNC_NAME,
+                                                      {'fetch_mode': fetch_mode, 'max_fetch_limit': max_fetch_limit,
+                                                       'list_arguments': kwargs}, history_id)
+        self._run_checkpointed_download(fetch_mode, history_id, **kwargs)
+
+    def close(self):
+        """
+        :brief: Closes the message cache (when used). Called once the processor is done downloading.
+        """
+        if self.cache is not None:
+            self.cache.close()
+
+    def rebuild_db_from_cache(self):
+        """
+        :brief: Saves all the messages of the message cache to the database, without calling the Gmail API.
+                Used to repopulate the database after a schema change or a restore.
+        """
+        self.fetch_mode = MESSAGE_FORMAT_FULL
+        messages = self.cache.iter_messages()
+        # Cached messages are complete GET message responses, hence the fetch stage passes them through
+        self._run_pipeline(iter(lambda: list(islice(messages, MAX_LIST_PAGE_SIZE)), []), fetch=lambda page: page)
+        LOGGER.info(f"Rebuilt the database from {len(self.cache)} cached messages")
@@ -0,0 +1,270 @@
+import re
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+from config.settings import FULLTEXT_NGRAM_TOKEN_SIZE
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+DATE_OPERATOR_MAPPING = {'less than': '>', 'more than': '<'}
+SENT_MESSAGES_FILTER = "exists (select 1 from message_label where message_label.message_id = " \
+                       "email_attributes.message_id and message_label.label_id = 'SENT')"
+COUNT_OPERATOR_MAPPING = {'less than': '<', 'more than': '>', 'equals': '='}
+TEXT_FIELDS = ('subject', 'from', 'to', 'cc', 'bcc')
+DATE_FIELDS = ('date_received', 'date_sent')
+BODY_FIELDS = ('body',)  # Text content of the message parts
+# Fields of the thread of the message (thread_summary columns). Eg. thread_last_date more than 30 days matches the
+# messages of the threads inactive for more than 30 days.
+THREAD_DATE_FIELDS = {'thread_first_date': 'first_timestamp', 'thread_last_date': 'last_timestamp'}
+THREAD_COUNT_FIELDS = {'thread_message_count': 'message_count'}
+THREAD_FIELDS = tuple(THREAD_DATE_FIELDS) + tuple(THREAD_COUNT_FIELDS)
+FIELDS = TEXT_FIELDS + DATE_FIELDS + BODY_FIELDS + THREAD_FIELDS
+BODY_PREDICATES = ('contains', 'contains word')
+JOIN_STRING = {'any': ' or ',
+               'all': ' and '
+               }
+# A rule of the 'thread' scope matches all the messages of the threads having a message that satisfies its conditions
+MESSAGE_SCOPE = 'message'
+THREAD_SCOPE = 'thread'
+SCOPES = (MESSAGE_SCOPE, THREAD_SCOPE)
+
+
+def get_ngram_terms(value):
+    """
+    :brief: Returns the ngrams (FULLTEXT_NGRAM_TOKEN_SIZE characters) of the words of the value, as indexed by the
+            ngram FULLTEXT indexes. Every text containing the value holds all of them, in any case.
+            Words shorter than FULLTEXT_NGRAM_TOKEN_SIZE have none.
+    """
+    terms = {}
+    for word in re.findall(r'\w+', value):
+        for start in range(len(word) - FULLTEXT_NGRAM_TOKEN_SIZE + 1):
+            term = word[start:start + FULLTEXT_NGRAM_TOKEN_SIZE]
+            terms.setdefault(term.casefold(), term)
+    return list(terms.values())
+
+
+def get_search_string(value):
+    """
+    :return: the boolean mode FULLTEXT search requiring all the ngrams of the value (see get_ngram_terms)
+    """
+    return ' '.join(f'+{term}' for term in get_ngram_terms(value))
+
+
+def get_word_start_pattern(value):
+    """
+    :return: the regular expression matching the value where it does not continue a word (Eg. "ork" in "Orkut",
+             not "voice" in "Invoice"). The same pattern is used by MySQL (ICU) and by Python (re).
+    """
+    pattern = re.escape(value)
+    return rf'(?<!\w){pattern}' if re.match(r'\w', value) else pattern
+
+
+def get_like_pattern(value):
+    escaped_value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped_value}%'
+
+
+def get_fulltext_condition(field):
+    """
+    :brief: Returns the condition matching the messages whose text field matches a boolean mode FULLTEXT search
+            (one parameter). The FULLTEXT indexes are on email_search, since email_attributes is partitioned.
+    """
+    return f'email_attributes.message_id in (select email_search.message_id from email_search ' \
+           f'where match(email_search.`{field}`) against(%s in boolean mode))'
+
+
+def get_filter_for_contains(column, indexed, fulltext_condition):
+    """
+    :brief: This method returns the filter condition for the 'contains' predicate: a substring match, anywhere in
+            the column (Eg. "voice" matches "Invoice"). The ngram FULLTEXT index of the column narrows down the rows
+            to the ones holding all the ngrams of the value, and the like condition keeps the exact match on those
+            rows. The like condition is used alone when the value has no ngram (see get_ngram_terms).
+    :param column: a text column
+    :param indexed: True when the value has ngrams
+    :param fulltext_condition: condition searching the FULLTEXT index of the column (one parameter, the search
+                               string in boolean mode)
+    :return: (condition, binder) - binder returns the parameters of the condition for a value
+    """
+    like_condition = f'{column} like %s'
+    if not indexed:
+        return like_condition, lambda value: [get_like_pattern(value)]
+    return f'({fulltext_condition} and {like_condition})', \
+        lambda value: [get_search_string(value), get_like_pattern(value)]
+
+
+def get_filter_for_contains_word(column, indexed, fulltext_condition):
+    """
+    :brief: This method returns the filter condition for the 'contains word' predicate: a substring match starting
+            a word of the column (Eg. "ork" matches "Orkut" but "voice" does not match "Invoice"), checked with a
+            regular expression (see get_word_start_pattern). As for 'contains', the ngram FULLTEXT index of the
+            column narrows down the rows first.
+    :param column: a text column
+    :param indexed: True when the value has ngrams (see get_ngram_terms)
+    :param fulltext_condition: condition searching the FULLTEXT index of the column (one parameter, the search
+                               string in boolean mode)
+    :return: (condition, binder) - binder returns the parameters of the condition for a value
+    """
+    regexp_condition = f'{column} regexp %s'
+    if not indexed:
+        return regexp_condition, lambda value: [get_word_start_pattern(value)]
+    return f'({fulltext_condition} and {regexp_condition})', \
+        lambda value: [get_search_string(value), get_word_start_pattern(value)]
+
+
+TEXT_PREDICATE_TO_SQL_CONDITION_MAPPING = {'contains': get_filter_for_contains,
+                                           'contains word': get_filter_for_contains_word,
+                                           'equals': lambda column, indexed, fulltext_condition: (
+                                               f'{column} = %s', lambda value: [value]),
+                                           'not equals': lambda column, indexed, fulltext_condition: (
+                                               f'{column} != %s', lambda value: [value])
+                                           }
+
+
+def get_filter_for_body_field(predicate, indexed):
+    """
+    :brief: This method returns the filter condition matching the messages with a part whose content
+            satisfies the predicate (only 'contains' and 'contains word' are supported)
+    :return: (condition, binder) - binder returns the parameters of the condition for a value
+    """
+    condition, binder = TEXT_PREDICATE_TO_SQL_CONDITION_MAPPING[predicate](
+        'message_part.`content`', indexed, 'match(message_part.`content`) against(%s in boolean mode)')
+    return f'email_attributes.message_id in (select message_part.message_id from message_part ' \
+           f'where {condition})', binder
+
+
+def get_date_cutoff(value):
+    """
+    :param value: a string that captures duration in days or months or years Eg. 1 day, 2 days, 2 months, etc,.
+    :return: the date time, that many days / months / years ago
+    """
+    values = value.split(' ')
+    unit_value = int(values[0])
+    time_unit = values[1].rstrip('s') + 's'
+    return datetime.now() - relativedelta(**{time_unit: unit_value})
+
+
+def get_filter_for_date_field(field, operator):
+    """
+    :brief: This method returns the required filter conditions to apply the passed date field based rule
+    :param field: a date field (date_sent / date_received)
+    :param operator: less than / greater than
+    :return: (condition, binder) - binder returns the date cutoff parameter for a value (see get_date_cutoff)
+    """
+    query_string = f'`internal_timestamp` {DATE_OPERATOR_MAPPING[operator]} %s'
+    if field == 'date_received':
+        query_string += f' and not {SENT_MESSAGES_FILTER}'
+    else:
+        query_string += f' and {SENT_MESSAGES_FILTER}'
+    return f'({query_string})', lambda value: [get_date_cutoff(value)]
+
+
+def get_filter_for_thread_field(field, predicate):
+    """
+    :brief: This method returns the filter condition matching the messages whose thread summary satisfies the
+            predicate (less than / more than a duration for the dates, less than / more than / equals a number for
+            the message count)
+    :return: (condition, binder) - binder returns the parameters of the condition for a value
+    """
+    if field in THREAD_DATE_FIELDS:
+        condition = f'thread_summary.`{THREAD_DATE_FIELDS[field]}` {DATE_OPERATOR_MAPPING[predicate]} %s'
+        binder = lambda value: [get_date_cutoff(value)]
+    else:
+        condition = f'thread_summary.`{THREAD_COUNT_FIELDS[field]}` {COUNT_OPERATOR_MAPPING[predicate]} %s'
+        binder = lambda value: [int(value)]
+    return f'email_attributes.message_id in (select email.id from email join thread_summary ' \
+           f'on thread_summary.thread_id = email.thread_id where {condition})', binder
+
+
+def get_thread_scope_filter(condition):
+    """
+    :brief: Extends the condition to all the messages of the threads having a message that satisfies it
+    """
+    return f'email_attributes.message_id in (select thread_email.id from email thread_email ' \
+           f'where thread_email.thread_id in (select email.thread_id from email join email_attributes ' \
+           f'on email_attributes.message_id = email.id where {condition}))'
+
+
+class CompiledRules(object):
+    """
+    Parameterized SQL condition of a rule, along with the binders that compute its parameters from the rule values
+    """
+
+    def __init__(self, condition, binders):
+        self.condition = condition
+        self.binders = binders
+
+    def bind(self, rules):
+        """
+        :param rules: a rule with the structure the condition was compiled from
+        :return: (condition, parameters) - the parameters of the condition for the values of the rule
+        """
+        parameters = []
+        for binder, rule in zip(self.binders, rules['rules']):
+            parameters.extend(binder(rule['value']))
+        return self.condition, tuple(parameters)
+
+
+class RuleCompiler(object):
+    """
+    Compiles rules into parameterized SQL conditions. The compiled conditions are cached by the structure of the
+    rules (group predicate, fields and predicates), so rules differing only in their values share the same condition
+    and the same SQL text is sent to the database on every evaluation.
+    """
+    __cache = {}
+
+    @staticmethod
+    def get_structure(rules):
+        structure = []
+        for rule in rules['rules']:
+            field, predicate = rule['field'], rule['predicate']
+            # The conditions of 'contains' and 'contains word' depend on whether the value can be searched with the
+            # FULLTEXT index
+            indexed = predicate in BODY_PREDICATES and bool(get_ngram_terms(rule['value']))
+            structure.append((field, predicate, indexed))
+        return (rules['predicate'], rules.get('scope', MESSAGE_SCOPE)), tuple(structure)
+
+    @staticmethod
+    def _compile_structure(structure):
+        (group_predicate, scope), rule_structures = structure
+        conditions_list, binders = [], []
+        for field, predicate, indexed in rule_structures:
+            # Fields are classified based the data type stored in the database
+            if field in TEXT_FIELDS:
+                condition, binder = TEXT_PREDICATE_TO_SQL_CONDITION_MAPPING[predicate](
+                    f'`{field}`', indexed, get_fulltext_condition(field))
+            elif field in DATE_FIELDS:
+                condition, binder = get_filter_for_date_field(field, predicate)
+            elif field in THREAD_FIELDS:
+                condition, binder = get_filter_for_thread_field(field, predicate)
+            else:
+                condition, binder = get_filter_for_body_field(predicate, indexed)
+            conditions_list.append(condition)
+            binders.append(binder)
+        # Finally apply the overall predicate - any or all
+        condition = JOIN_STRING[group_predicate].join(conditions_list)
+        if scope == THREAD_SCOPE:
+            condition = get_thread_scope_filter(condition)
+        return CompiledRules(condition, binders)
+
+    @classmethod
+    def compile(cls, rules):
+        """
+        :param rules: a validated rule (dict)
+        :return: CompiledRules for the structure of the rule (from the cache, when compiled earlier)
+        """
+        structure = cls.get_structure(rules)
+        compiled_rules = cls.__cache.get(structure)
+        if compiled_rules is None:
+            compiled_rules = cls._compile_structure(structure)
+            cls.__cache[structure] = compiled_rules
+            LOGGER.debug(f"Compiled rule structure {structure}")
+        return compiled_rules
+
+    @classmethod
+    def get_query_condition(cls, rules):
+        """
+        :return: (condition, parameters) of the rule
+        """
+        return cls.compile(rules).bind(rules)
@@ -0,0 +1,134 @@
+from config.settings import RULE_PLAN_SAMPLE_SIZE, RULE_PLAN_WARN_MATCH_SHARE, FULLTEXT_NGRAM_TOKEN_SIZE
+from businesslogic.rule_compiler import RuleCompiler, TEXT_FIELDS, BODY_FIELDS, BODY_PREDICATES
+from businesslogic.rules_processor import RulesProcessor, fetch_rule_matches
+from lib.db_utils import DBUtils
+from lib.logger_utils import get_logger
+from models.email import EmailDAO
+
+LOGGER = get_logger(__name__)
+
+# Fields with a B-tree index on email_attributes, usable by the 'equals' predicate
+EQUALS_INDEXED_FIELDS = ('from', 'to', 'subject')
+FULL_SCAN_ACCESS_TYPES = {'ALL': 'full table scan', 'index': 'full index scan'}
+
+
+def get_condition_warnings(rules):
+    """
+    :brief: Returns the warnings about the conditions of a rule that can not be served by an index
+    """
+    warnings = []
+    _, structure = RuleCompiler.get_structure(rules)
+    for rule, (field, predicate, indexed) in zip(rules['rules'], structure):
+        description = f"'{field} {predicate} {rule['value']}'"
+        table = 'message part' if field in BODY_FIELDS else 'email'
+        if predicate in BODY_PREDICATES and not indexed:
+            warnings.append(f"{description} has no word of {FULLTEXT_NGRAM_TOKEN_SIZE} characters or more to be "
+                            f"searched in the FULLTEXT index: scans every {table}")
+        elif predicate == 'not equals':
+            warnings.append(f"{description} can not use an index: scans every email")
+        elif predicate == 'equals' and field in TEXT_FIELDS and field not in EQUALS_INDEXED_FIELDS:
+            warnings.append(f"{description} can not use an index ({field} has none): scans every email")
+    return warnings
+
+
+def get_explain_warnings(explain_rows):
+    """
+    :brief: Returns the warnings about the full scans and the dependent subqueries of a query plan (EXPLAIN rows)
+    """
+    warnings = []
+    for row in explain_rows:
+        access_type = FULL_SCAN_ACCESS_TYPES.get(row.get('type'))
+        if access_type:
+            warnings.append(f"{access_type} of {row.get('table')} (about {row.get('rows')} rows)")
+        if row.get('select_type') == 'DEPENDENT SUBQUERY':
+            warnings.append(f"dependent subquery on {row.get('table')}, run for every candidate email")
+    return warnings
+
+
+class RulePlanner(object):
+    """
+    Dry run of a rule set: reports what processing it would do, without calling the Gmail API or modifying the
+    database. The report holds:
+     * the number of messages matched by each rule and a sample of their ids
+     * the number of messages per merged action, and their share of the mailbox
+     * the SQL of the rule query, along with its EXPLAIN output (for the rule set and for each rule)
+     * warnings on the conditions and query plans forcing full scans, and on rule sets modifying a large share of
+       the mailbox
+    """
+
+    def __init__(self, snapshot=None, sample_size=RULE_PLAN_SAMPLE_SIZE):
+        """
+        :param snapshot: MessageSnapshot to count the matches in memory (see RulesProcessor). The queries are
+                         explained on the database all the same.
+        :param sample_size: number of message ids listed per rule
+        """
+        self.snapshot = snapshot
+        self.sample_size = sample_size
+
+    def _count_matches(self, connection, rule_set, query_conditions):
+        """
+        :return: (match count and sample ids of each rule, message count of each merged action)
+        """
+        rule_counts = [0] * len(rule_set)
+        samples = [[] for _ in rule_set]
+        action_counts = {}
+        actions_by_flags = {}
+        for matches in fetch_rule_matches(connection, rule_set, query_conditions, self.snapshot):
+            for message_id, flags in matches:
+                for index, matched in enumerate(flags):
+                    if matched:
+                        rule_counts[index] += 1
+                        if len(samples[index]) < self.sample_size:
+                            samples[index].append(message_id)
+                if flags not in actions_by_flags:
+                    actions_by_flags[flags] = RulesProcessor._merge_actions(
+                        rules['action'] for rules, matched in zip(rule_set, flags) if matched)
+                action = actions_by_flags[flags]
+                action_counts[action] = action_counts.get(action, 0) + 1
+        return list(zip(rule_counts, samples)), action_counts
+
+    def plan(self, rule_set):
+        """
+        :param rule_set: list of rules, each in the format of resources/rules.json
+        :return: dict of the report (see the class documentation)
+        :raises: ValueError when any of the rules do not pass the validation checks
+        """
+        RulesProcessor.validate_rule_set(rule_set)
+        query_conditions = [RuleCompiler.get_query_condition(rules) for rules in rule_set]
+        with DBUtils.pooled_connection() as connection:
+            email_dao = EmailDAO(connection)
+            message_count, _ = email_dao.get_attributes_checksum()
+            rule_matches, action_counts = self._count_matches(connection, rule_set, query_conditions)
+            query, arguments, explain_rows = email_dao.explain_rule_matches(query_conditions)
+            rule_reports = []
+            for index, (rules, query_condition, (match_count, sample_ids)) in \
+                    enumerate(zip(rule_set, query_conditions, rule_matches)):
+                _, _, rule_explain_rows = email_dao.explain_rule_matches([query_condition])
+                rule_reports.append({'index': index,
+                                     'description': rules.get('description'),
+                                     'condition': query_condition[0],
+                                     'parameters': list(query_condition[1]),
+                                     'match_count': match_count,
+                                     'sample_ids': sample_ids,
+                                     'explain': rule_explain_rows,
+                                     'warnings': get_condition_warnings(rules) +
+                                                 get_explain_warnings(rule_explain_rows)})
+        actions = [{'addLabelIds': list(add_label_ids), 'removeLabelIds': list(remove_label_ids),
+                    'message_count': count}
+                   for (add_label_ids, remove_label_ids), count in sorted(action_counts.items(),
+                                                                          key=lambda item: -item[1])]
+        modified_count = sum(action['message_count'] for action in actions
+                             if action['addLabelIds'] or action['removeLabelIds'])
+        warnings = get_explain_warnings(explain_rows)
+        if message_count and modified_count / message_count > RULE_PLAN_WARN_MATCH_SHARE:
+            warnings.append(f"the rules would modify {modified_count} of the {message_count} emails "
+                            f"({modified_count / message_count:.0%})")
+        LOGGER.info(f"Planned {len(rule_set)} rules: {modified_count} of {message_count} messages modified")
+        return {'message_count': message_count,
+                'modified_count': modified_count,
+                'rules': rule_reports,
+                'actions': actions,
+                'query': query,
+                'arguments': arguments,
+                'explain': explain_rows,
+                'warnings': warnings}
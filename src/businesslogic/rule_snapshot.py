@@ -0,0 +1,323 @@
+import os
+import re
+from datetime import timedelta
+
+import numpy as np
+
+from config.settings import RULE_SNAPSHOT_REFRESH_OVERLAP, BULK_UPDATE_BATCH_SIZE
+from businesslogic.rule_compiler import TEXT_FIELDS, DATE_FIELDS, DATE_OPERATOR_MAPPING, MESSAGE_SCOPE, \
+    get_word_start_pattern, get_date_cutoff
+from lib import metrics
+from lib.logger_utils import get_logger
+from models.email import EmailDAO
+
+LOGGER = get_logger(__name__)
+
+SNAPSHOT_TEXT_FIELDS = ('from', 'to', 'subject', 'cc', 'bcc')  # In the order of EmailDAO.fetch_snapshot_rows
+SENT_LABEL_ID = 'SENT'
+NULL_CODE = -1
+BITSET_WORD_SIZE = 64
+
+
+def get_matcher_for_contains(value):
+    """
+    :brief: Matches the values containing the value anywhere, as the 'contains' SQL condition does
+    :return: callable(casefolded value) -> bool
+    """
+    folded_value = value.casefold()
+    return lambda text: folded_value in text
+
+
+def get_matcher_for_contains_word(value):
+    """
+    :brief: Matches the values containing the value at the start of a word, as the 'contains word' SQL condition
+            does (see RuleCompiler)
+    :return: callable(casefolded value) -> bool
+    """
+    pattern = re.compile(get_word_start_pattern(value.casefold()))
+    return lambda text: pattern.search(text) is not None
+
+
+# Comparisons are case insensitive, as with the collation of the database
+TEXT_PREDICATE_TO_MATCHER_MAPPING = {'contains': get_matcher_for_contains,
+                                     'contains word': get_matcher_for_contains_word,
+                                     'equals': lambda value: value.casefold().__eq__,
+                                     'not equals': lambda value: value.casefold().__ne__
+                                     }
+
+
+class StringColumn(object):
+    """
+    Column of interned strings: each row holds the code of its value in the table of distinct values (-1 for NULL).
+    Predicates are evaluated once per distinct value and mapped to the rows through the codes.
+    """
+
+    def __init__(self, values=(), codes=None):
+        self.values = list(values)
+        self.codes = codes if codes is not None else np.empty(0, dtype=np.int32)
+        self.__codes_by_value = {value: code for code, value in enumerate(self.values)}
+        self.__folded_values = None
+
+    def intern(self, value):
+        """
+        :return: the code of the value, added to the table of distinct values when new
+        """
+        if value is None:
+            return NULL_CODE
+        code = self.__codes_by_value.get(value)
+        if code is None:
+            code = self.__codes_by_value[value] = len(self.values)
+            self.values.append(value)
+            self.__folded_values = None
+        return code
+
+    def get_mask(self, matcher):
+        """
+        :param matcher: callable(casefolded value) -> bool
+        :return: boolean array of the rows whose value matches (False for NULL)
+        """
+        if self.__folded_values is None:
+            self.__folded_values = [value.casefold() for value in self.values]
+        value_mask = np.fromiter(map(matcher, self.__folded_values), dtype=bool, count=len(self.values))
+        # The NULL code (-1) picks the trailing False
+        return np.append(value_mask, False)[self.codes]
+
+    def to_arrays(self):
+        """
+        :return: (utf-8 bytes of the distinct values, offsets of each value in them)
+        """
+        encoded_values = [value.encode('utf-8', 'surrogatepass') for value in self.values]
+        offsets = np.zeros(len(encoded_values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded_values], out=offsets[1:])
+        return np.frombuffer(b''.join(encoded_values), dtype=np.uint8), offsets
+
+    @classmethod
+    def from_arrays(cls, data, offsets, codes):
+        data = data.tobytes()
+        offsets = offsets.tolist()
+        values = [data[offsets[index]:offsets[index + 1]].decode('utf-8', 'surrogatepass')
+                  for index in range(len(offsets) - 1)]
+        return cls(values, codes)
+
+
+class MessageSnapshot(object):
+    """
+    Compact columnar copy of the rule fields of the stored messages, to evaluate rules in memory as vectorized masks
+    instead of running a query on the database. Each row is a message, in message id order:
+     * from, to, subject, cc and bcc are interned strings (see StringColumn)
+     * internal_timestamp is an array of datetime64
+     * the labels are bitsets (one bit per label id)
+    The snapshot is refreshed incrementally: only the messages changed (email.refreshed_on) since the last refresh
+    are read again. It is reloaded in full when messages were deleted meanwhile. It can be saved to a file between
+    runs (see save and load).
+    Rules on the message body and on the threads are not supported, since the snapshot does not hold the message
+    parts nor the thread summaries.
+    """
+
+    def __init__(self):
+        self.message_ids = np.empty(0, dtype=np.uint64)
+        self.columns = {field: StringColumn() for field in SNAPSHOT_TEXT_FIELDS}
+        self.timestamps = np.empty(0, dtype='datetime64[s]')
+        self.label_ids = []  # Label id of each bit of the bitsets
+        self.label_bitsets = np.zeros((0, 1), dtype=np.uint64)
+        self.refreshed_on = None  # Database time at the start of the last refresh
+        self.__label_bits = {}
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    @staticmethod
+    def supports(rules):
+        # The snapshot holds neither the message bodies nor the threads
+        return rules.get('scope', MESSAGE_SCOPE) == MESSAGE_SCOPE and \
+            all(rule['field'] in TEXT_FIELDS + DATE_FIELDS for rule in rules['rules'])
+
+    def _get_label_bit(self, label_id):
+        bit = self.__label_bits.get(label_id)
+        if bit is None:
+            bit = self.__label_bits[label_id] = len(self.label_ids)
+            self.label_ids.append(label_id)
+        return bit
+
+    def _to_arrays(self, rows):
+        """
+        :param rows: list of rows, as returned by EmailDAO.fetch_snapshot_rows
+        :return: dict of the columns of the rows
+        """
+        row_count = len(rows)
+        arrays = {'message_ids': np.fromiter((row[0] for row in rows), dtype=np.uint64, count=row_count),
+                  'timestamps': np.array([row[6] for row in rows], dtype='datetime64[s]')}
+        for index, field in enumerate(SNAPSHOT_TEXT_FIELDS, 1):
+            arrays[field] = np.fromiter((self.columns[field].intern(row[index]) for row in rows), dtype=np.int32,
+                                        count=row_count)
+        bitsets = []
+        for row in rows:
+            bitset = 0
+            for label_id in row[7]:
+                bitset |= 1 << self._get_label_bit(label_id)
+            bitsets.append(bitset)
+        word_count = max(1, -(-len(self.label_ids) // BITSET_WORD_SIZE))
+        word_mask = (1 << BITSET_WORD_SIZE) - 1
+        arrays['label_bitsets'] = np.array([[(bitset >> (word * BITSET_WORD_SIZE)) & word_mask
+                                             for word in range(word_count)] for bitset in bitsets],
+                                           dtype=np.uint64).reshape(row_count, word_count)
+        return arrays
+
+    @staticmethod
+    def _widen_bitsets(bitsets, word_count):
+        if bitsets.shape[1] >= word_count:
+            return bitsets
+        return np.pad(bitsets, ((0, 0), (0, word_count - bitsets.shape[1])))
+
+    def _merge(self, batches):
+        """
+        :brief: Replaces the rows of the messages in the batches (see _to_arrays) and adds the new ones
+        """
+        if not batches:
+            return
+        word_count = max(batch['label_bitsets'].shape[1] for batch in batches)
+        changes = {'message_ids': np.concatenate([batch['message_ids'] for batch in batches]),
+                   'timestamps': np.concatenate([batch['timestamps'] for batch in batches]),
+                   'label_bitsets': np.concatenate([self._widen_bitsets(batch['label_bitsets'], word_count)
+                                                    for batch in batches])}
+        for field in SNAPSHOT_TEXT_FIELDS:
+            changes[field] = np.concatenate([batch[field] for batch in batches])
+        self.label_bitsets = self._widen_bitsets(self.label_bitsets, word_count)
+        positions = np.searchsorted(self.message_ids, changes['message_ids'])
+        existing = positions < len(self.message_ids)
+        existing[existing] = self.message_ids[positions[existing]] == changes['message_ids'][existing]
+        # The changed rows are updated in place
+        self.timestamps[positions[existing]] = changes['timestamps'][existing]
+        self.label_bitsets[positions[existing]] = changes['label_bitsets'][existing]
+        for field in SNAPSHOT_TEXT_FIELDS:
+            self.columns[field].codes[positions[existing]] = changes[field][existing]
+        if existing.all():
+            return
+        # The new rows are appended, and all the rows sorted again by message id
+        added = ~existing
+        message_ids = np.concatenate([self.message_ids, changes['message_ids'][added]])
+        order = np.argsort(message_ids, kind='stable')
+        self.message_ids = message_ids[order]
+        self.timestamps = np.concatenate([self.timestamps, changes['timestamps'][added]])[order]
+        self.label_bitsets = np.concatenate([self.label_bitsets, changes['label_bitsets'][added]])[order]
+        for field in SNAPSHOT_TEXT_FIELDS:
+            column = self.columns[field]
+            column.codes = np.concatenate([column.codes, changes[field][added]])[order]
+
+    def _load_rows(self, email_dao, changed_since=None):
+        """
+        :return: number of rows read
+        """
+        batches = [self._to_arrays(rows) for rows in email_dao.fetch_snapshot_rows(changed_since)]
+        self._merge(batches)
+        return sum(len(batch['message_ids']) for batch in batches)
+
+    def get_checksum(self):
+        """
+        :return: (count, xor of the message ids) - see EmailDAO.get_attributes_checksum
+        """
+        return len(self), int(np.bitwise_xor.reduce(self.message_ids)) if len(self) else 0
+
+    def refresh(self, connection):
+        """
+        :brief: Reads the messages changed since the last refresh (all the messages the first time)
+        """
+        email_dao = EmailDAO(connection)
+        refresh_started_on = email_dao.get_database_time()
+        changed_since = self.refreshed_on - timedelta(seconds=RULE_SNAPSHOT_REFRESH_OVERLAP) \
+            if self.refreshed_on else None
+        with metrics.timed('rule_snapshot_refresh_seconds'):
+            row_count = self._load_rows(email_dao, changed_since)
+            if changed_since and self.get_checksum() != email_dao.get_attributes_checksum():
+                LOGGER.info("Messages were deleted since the last refresh of the snapshot. Reloading it")
+                self.__init__()
+                row_count = self._load_rows(email_dao)
+        self.refreshed_on = refresh_started_on
+        LOGGER.info(f"Refreshed {row_count} rows of the snapshot of {len(self)} messages")
+
+    def get_label_mask(self, label_id):
+        """
+        :return: boolean array of the rows having the label
+        """
+        bit = self.__label_bits.get(label_id)
+        if bit is None:
+            return np.zeros(len(self), dtype=bool)
+        word = self.label_bitsets[:, bit // BITSET_WORD_SIZE]
+        return ((word >> np.uint64(bit % BITSET_WORD_SIZE)) & np.uint64(1)).astype(bool)
+
+    def _get_condition_mask(self, rule):
+        field, predicate, value = rule['field'], rule['predicate'], rule['value']
+        if field in TEXT_FIELDS:
+            return self.columns[field].get_mask(TEXT_PREDICATE_TO_MATCHER_MAPPING[predicate](value))
+        if field in DATE_FIELDS:
+            cutoff = np.datetime64(get_date_cutoff(value), 's')
+            mask = self.timestamps > cutoff if DATE_OPERATOR_MAPPING[predicate] == '>' else self.timestamps < cutoff
+            sent_mask = self.get_label_mask(SENT_LABEL_ID)
+            return mask & (sent_mask if field == 'date_sent' else ~sent_mask)
+        raise ValueError(f"Field {field} is not supported by the snapshot")
+
+    def get_rule_mask(self, rules):
+        """
+        :param rules: a validated rule (dict)
+        :return: boolean array of the rows matching the rule
+        """
+        masks = [self._get_condition_mask(rule) for rule in rules['rules']]
+        return np.logical_or.reduce(masks) if rules['predicate'] == 'any' else np.logical_and.reduce(masks)
+
+    def fetch_rule_matches(self, rule_set, batch_size=BULK_UPDATE_BATCH_SIZE, message_ids=None):
+        """
+        :brief: Generator over the messages matching at least one of the rules, in lists of up to batch_size
+                (hex message id, matched flags) tuples, in message id order (see EmailDAO.fetch_rule_matches)
+        :param rule_set: list of validated rules
+        :param message_ids: (hex) ids of the messages to be matched. None for all the messages.
+        """
+        with metrics.timed('rule_snapshot_evaluation_seconds'):
+            flags = np.stack([self.get_rule_mask(rules) for rules in rule_set], axis=1)
+            matched = flags.any(axis=1)
+            if message_ids is not None:
+                matched &= np.isin(self.message_ids,
+                                   np.array([int(item, 16) for item in message_ids], dtype=np.uint64))
+            matched_rows = np.flatnonzero(matched)
+        for start in range(0, len(matched_rows), batch_size):
+            rows = matched_rows[start:start + batch_size]
+            yield [(format(message_id, 'x'), tuple(row_flags))
+                   for message_id, row_flags in zip(self.message_ids[rows].tolist(), flags[rows].tolist())]
+
+    def save(self, path):
+        """
+        :brief: Saves the snapshot to a file (NumPy .npz format), replacing it atomically
+        """
+        arrays = {'message_ids': self.message_ids, 'timestamps': self.timestamps,
+                  'label_ids': np.array(self.label_ids, dtype=str), 'label_bitsets': self.label_bitsets,
+                  'refreshed_on': np.datetime64(self.refreshed_on or 'NaT', 's')}
+        for field, column in self.columns.items():
+            arrays[f'{field}_values'], arrays[f'{field}_offsets'] = column.to_arrays()
+            arrays[f'{field}_codes'] = column.codes
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'wb') as file_obj:
+            np.savez(file_obj, **arrays)
+        os.replace(temporary_path, path)
+        LOGGER.info(f"Saved the snapshot of {len(self)} messages to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: the snapshot saved to the path. An empty snapshot when there is none.
+        """
+        snapshot = cls()
+        if not os.path.exists(path):
+            return snapshot
+        with np.load(path, allow_pickle=False) as arrays:
+            snapshot.message_ids = arrays['message_ids']
+            snapshot.timestamps = arrays['timestamps']
+            snapshot.label_bitsets = arrays['label_bitsets']
+            for label_id in arrays['label_ids'].tolist():
+                snapshot._get_label_bit(label_id)
+            refreshed_on = arrays['refreshed_on']
+            snapshot.refreshed_on = None if np.isnat(refreshed_on) else refreshed_on.item()
+            for field in SNAPSHOT_TEXT_FIELDS:
+                snapshot.columns[field] = StringColumn.from_arrays(arrays[f'{field}_values'],
+                                                                   arrays[f'{field}_offsets'],
+                                                                   arrays[f'{field}_codes'])
+        return snapshot
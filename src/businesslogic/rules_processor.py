@@ -1,63 +1,50 @@
+from lib import metrics
 from lib.logger_utils import get_logger
 from lib.db_utils import DBUtils
 from models.email import EmailDAO
-from lib.google_api import GoogleAPIHelper
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from lib.google_api import GoogleAPIHelper, LazyService
+from lib.request_scheduler import GmailRequestScheduler
 from config.settings import BULK_UPDATE_BATCH_SIZE
+from businesslogic.rule_snapshot import MessageSnapshot
+from businesslogic.rule_compiler import RuleCompiler, TEXT_FIELDS, DATE_FIELDS, BODY_FIELDS, FIELDS, \
+    BODY_PREDICATES, DATE_OPERATOR_MAPPING, TEXT_PREDICATE_TO_SQL_CONDITION_MAPPING, THREAD_DATE_FIELDS, \
+    THREAD_COUNT_FIELDS, COUNT_OPERATOR_MAPPING, SCOPES
 
 LOGGER = get_logger(__name__)
 
-DATE_OPERATOR_MAPPING = {'less than': '>', 'more than': '<'}
-SENT_MESSAGES_FILTER = "json_search(`labels`, 'one', 'SENT')"
-TEXT_PREDICATE_TO_SQL_CONDITION_MAPPING = {'contains': lambda field, value: f'`{field}` like "%{value}%"',
-                                           'equals': lambda field, value: f'`{field}` = "{value}"',
-                                           'not equals': lambda field, value: f'`{field}` != "{value}"'
-                                           }
-TEXT_FIELDS = ('subject', 'from', 'to', 'cc', 'bcc')
-DATE_FIELDS = ('date_received', 'date_sent')
-FIELDS = TEXT_FIELDS + DATE_FIELDS
-JOIN_STRING = {'any': ' or ',
-               'all': ' and '
-               }
 
-
-def get_filter_for_date_field(field, operator, value):
+def fetch_rule_matches(connection, rule_set, query_conditions, snapshot=None, message_ids=None):
     """
-    :brief: This method returns the required filter conditions to apply the passed date field based rule
-    :param field: a date field (date_sent / date_received)
-    :param operator: less than / greater than
-    :param value: a string that captures duration in days or months or years Eg. 1 day, 2 days, 2 months, etc,.
-    :return:  a query filter condition that needs to be applied in the database to process the rule
+    :brief: Reads the messages matching the rule set from the snapshot, when given and supporting all the rules,
+            from the database otherwise. The snapshot is refreshed first.
+    :param query_conditions: the SQL conditions of the rules (see RuleCompiler)
+    :param message_ids: (hex) ids of the messages to be matched. None for all the messages.
+    :return: generator over the batches of (hex message id, matched flags) - see EmailDAO.fetch_rule_matches
     """
-    values = value.split(' ')
-    unit_value = int(values[0])
-    time_unit = values[1].rstrip('s') + 's'
-    date_time = datetime.now() - relativedelta(**{time_unit: unit_value})
-    query_string = f'`internal_timestamp` {DATE_OPERATOR_MAPPING[operator]} "{date_time}"'
-    query_string += f' and {SENT_MESSAGES_FILTER} '
-    if field == 'date_received':
-        query_string += 'is null'
-    return query_string
+    if snapshot is not None:
+        if all(MessageSnapshot.supports(rules) for rules in rule_set):
+            snapshot.refresh(connection)
+            return snapshot.fetch_rule_matches(rule_set, message_ids=message_ids)
+        LOGGER.warning("The snapshot does not hold the message bodies nor the threads. "
+                       "Evaluating the rules in the database")
+    return EmailDAO(connection).fetch_rule_matches(query_conditions, message_ids=message_ids)
 
 
 class RulesProcessor(object):
-    def __init__(self):
-        self.__connection = None
-        self.service = GoogleAPIHelper().get_service_instance()
-
-    def _get_connection(self):
-        self.__connection = DBUtils.renew_or_get_new_connection(self.__connection)
-        return self.__connection
-
-    def _close_connection(self):
-        connection_id = self.__connection.connection_id
-        try:
-            self.__connection.close()
-        finally:
-            LOGGER.debug(f"Closed connection: {connection_id}")
+    def __init__(self, service_factory=None, snapshot=None):
+        """
+        :param service_factory: callable returning a new Gmail service object. Defaults to the Gmail API
+        :param snapshot: MessageSnapshot to evaluate the rules in memory, instead of querying the database.
+                         It is refreshed before the evaluation.
+        """
+        # Built on the first API call. Runs without a matching message make none.
+        self.service = LazyService(service_factory or GoogleAPIHelper().get_service_instance)
+        self.scheduler = GmailRequestScheduler()
+        self.snapshot = snapshot
+        self.failed_count = 0  # Messages matched by the last run whose batch could not be modified
 
-    def _validate_rules(self, rules):
+    @staticmethod
+    def _validate_rules(rules):
         """
         This method validates the structure of the rules to eliminate bad fields, predicates, values and actions
         :param rules: a dictionary containing the input rules to be applied
@@ -66,6 +53,8 @@ class RulesProcessor(object):
         """
         if 'predicate' not in rules or rules['predicate'] not in ('any', 'all'):
             raise ValueError("Group predicate is invalid or missing. Should be one of 'any', 'all'.")
+        if rules.get('scope', SCOPES[0]) not in SCOPES:
+            raise ValueError(f"Invalid scope. Should be one of {', '.join(SCOPES)}.")
         for rule in rules.get('rules'):
             if 'field' not in rule or rule['field'] not in FIELDS:
                 raise ValueError(f"Invalid or missing field in rule {rule}")
@@ -76,8 +65,16 @@ class RulesProcessor(object):
                     raise ValueError(f"Unsupported predicate found in rule {rule}")
                 if rule['field'] in DATE_FIELDS and rule['predicate'] not in DATE_OPERATOR_MAPPING:
                     raise ValueError(f"Unsupported predicate found in rule {rule}")
+                if rule['field'] in BODY_FIELDS and rule['predicate'] not in BODY_PREDICATES:
+                    raise ValueError(f"Unsupported predicate found in rule {rule}")
+                if rule['field'] in THREAD_DATE_FIELDS and rule['predicate'] not in DATE_OPERATOR_MAPPING:
+                    raise ValueError(f"Unsupported predicate found in rule {rule}")
+                if rule['field'] in THREAD_COUNT_FIELDS and rule['predicate'] not in COUNT_OPERATOR_MAPPING:
+                    raise ValueError(f"Unsupported predicate found in rule {rule}")
             if 'value' not in rule or not isinstance(rule['value'], str):
                 raise ValueError(f"Invalid or missing value in rule {rule}")
+            if rule['field'] in THREAD_COUNT_FIELDS and not rule['value'].isdigit():
+                raise ValueError(f"The value of rule {rule} should be a number")
         if not rules.get('rules'):
             raise ValueError("At least one rule condition is required")
         if 'action' not in rules or not isinstance(rules['action'], dict):
@@ -86,72 +83,144 @@ class RulesProcessor(object):
         if not set(action.keys()).intersection(['addLabelIds', 'removeLabelIds']):
             raise ValueError("Action block should have at least one of 'set_labels' or 'unset_labels' array")
 
+    @classmethod
+    def validate_rule_set(cls, rule_set):
+        """
+        :raises: ValueError when the rule set is empty or when any of its rules is invalid (see _validate_rules)
+        """
+        if not rule_set:
+            raise ValueError("At least one rule is required")
+        for index, rules in enumerate(rule_set):
+            try:
+                cls._validate_rules(rules)
+            except ValueError as ex:
+                LOGGER.error(f"Validation failed for rule #{index}. Details: {ex}")
+                raise
+
     def _get_query_condition_for_rules(self, rules):
-        conditions_list = []
-        for rule in rules.get('rules'):
-            field, predicate, value = rule['field'], rule['predicate'], rule['value']
-            # Get the field property which contains predicate mapper.
-            # Predicate mapper maps to the function that should be applied for a given predicate
-            # Fields are classified based the data type stored in the database
-            if field in TEXT_FIELDS:
-                conditions_list.append(TEXT_PREDICATE_TO_SQL_CONDITION_MAPPING[predicate](field, value))
-            elif field in DATE_FIELDS:
-                conditions_list.append(get_filter_for_date_field(field, predicate, value))
-        group_predicate = rules['predicate']  # Finally apply the overall predicate - any or all
-        query_condition = JOIN_STRING[group_predicate].join(conditions_list)
-        return query_condition
+        """
+        :return: (condition, parameters) - the parameterized SQL condition of the rules (see RuleCompiler)
+        """
+        return RuleCompiler.get_query_condition(rules)
 
-    def _process_rule_actions(self, rules):
-        self.service.users().messages().batchModify(userId='me')
+    @staticmethod
+    def _merge_actions(actions):
+        """
+        :brief: Merges the actions of the rules matched by a message, in the order of the rules.
+                When rules disagree on a label, the later rule takes precedence.
+        :return: (add label ids, remove label ids) as sorted tuples
+        """
+        add_label_ids, remove_label_ids = set(), set()
+        for action in actions:
+            current_add_ids = set(action.get('addLabelIds') or [])
+            current_remove_ids = set(action.get('removeLabelIds') or [])
+            add_label_ids = (add_label_ids - current_remove_ids) | current_add_ids
+            remove_label_ids = (remove_label_ids - current_add_ids) | current_remove_ids
+        return tuple(sorted(add_label_ids)), tuple(sorted(remove_label_ids))
 
-    def process_rules(self, rules):
+    def _apply_action(self, connection, message_ids, add_label_ids, remove_label_ids):
+        """
+        :brief: Calls the Gmail bulk modify API with the batch of messages and action (labels).
+                When successful, updates the local database by applying the action.
+        :return: True when the batch was modified
         """
-        :brief: Rules are processed as follows:
-                1. Validate the JSON (dict)
-                2. Get the SQL condition for each filter in the rules
-                3. Apply the aggregate predicate (any / all)
-                4. Fetch the message ids by running the final filter query
-                5. For each batch of message ids (BULK_UPDATE_BATCH_SIZE)
-                    a. Call the Gmail bulk modify API with the batch of messages and action (labels)
+        request_body = {'ids': message_ids,
+                        'addLabelIds': list(add_label_ids),
+                        'removeLabelIds': list(remove_label_ids)
+                        }
+        LOGGER.debug(request_body)
+        # Call Gmail's batch modify API
+        response_body = self.scheduler.execute(self.service.users().messages().batchModify(userId='me',
+                                                                                         body=request_body),
+                                               'messages.batchModify')
+        if response_body:
+            LOGGER.error(f"Error in processing rules. Details: {response_body}")
+            metrics.increment('rules_messages_failed_total', len(message_ids))
+            return False
+        email_dao = EmailDAO(connection)
+        email_dao.update_labels(add_label_ids, remove_label_ids, message_ids)
+        with metrics.timed('db_commit_seconds'):
+            connection.commit()
+        email_dao.refresh_thread_summaries()
+        metrics.increment('rules_messages_modified_total', len(message_ids))
+        return True
+
+    def process_rule_set(self, rule_set, message_ids=None, quiet=False):
+        """
+        :brief: The rules of a set are processed together as follows:
+                1. Validate each rule (dict)
+                2. Get the SQL condition of each rule, applying its aggregate predicate (any / all)
+                3. Stream, with a single query, the messages matching any of the rules along with the rules they match
+                4. Merge the actions of the matched rules for each message (later rules take precedence)
+                5. Group the messages by their merged action. For each batch of BULK_UPDATE_BATCH_SIZE messages
+                   of a group:
+                    a. Call the Gmail bulk modify API with the batch of messages and the merged action (labels)
                     b. When successful, update the local database by applying the action
-        :param rules:
-        :raises: ValueError when the rules do not pass the validation checks
+                Each message is hence modified at most once per run.
+        :param rule_set: list of rules, each in the format of resources/rules.json
+        :param message_ids: (hex) ids of the messages the rules are applied to (Eg. the messages changed by an
+                            incremental sync). None for all the messages.
+        :param quiet: when set, the progress is only logged, not printed (Eg. when run by the sync daemon)
+        :return: number of messages modified. The number of the matched messages that could not be modified is
+                 set in failed_count.
+        :raises: ValueError when any of the rules do not pass the validation checks
         """
-        try:
-            self._validate_rules(rules)
-        except ValueError as ex:
-            LOGGER.error(f"Validation failed. Details: {ex}")
-            raise
-        query_condition = self._get_query_condition_for_rules(rules)
-        LOGGER.debug(f"final query condition is {query_condition}")
-        message_ids_list = EmailDAO(self._get_connection()).fetch_message_ids(query_condition)
-        self._close_connection()
-        if not message_ids_list:
-            print("\n\nOUTPUT\nNo messages in the database match the rule")
-            return
-        add_label_ids = rules['action'].get('addLabelIds') or []
-        remove_label_ids = rules['action'].get('removeLabelIds') or []
-        while True:
-            current_batch_messages_list = message_ids_list[:BULK_UPDATE_BATCH_SIZE]
-            # Process bulk update in batches (max batch size of Google's bulk update is 1000)
-            request_body = {'ids': current_batch_messages_list,
-                            'addLabelIds': add_label_ids,
-                            'removeLabelIds': remove_label_ids
-                            }
-            LOGGER.debug(request_body)
-            # Call Gmail's batch modify API
-            response_body = self.service.users().messages().batchModify(userId='me',
-                                                                        body=request_body).execute()
-            if response_body:
-                LOGGER.error(f"Error in processing rules. Details: {response_body}")
+        self.validate_rule_set(rule_set)
+        self.failed_count = 0
+        if message_ids is not None and not message_ids:
+            return 0
+        query_conditions = [self._get_query_condition_for_rules(rules) for rules in rule_set]
+        LOGGER.debug(f"final query conditions are {query_conditions}")
+        actions_by_flags = {}
+        pending_messages = {}
+        processed_count = 0
+
+        def apply_pending_action(connection, action):
+            nonlocal processed_count
+            message_ids = pending_messages.pop(action)
+            if self._apply_action(connection, message_ids, *action):
+                processed_count += len(message_ids)
+                LOGGER.info(f"Processed {len(message_ids)} messages. Total: {processed_count}")
+                if not quiet:
+                    print(f"Processed {len(message_ids)} messages. Total: {processed_count}")
             else:
-                EmailDAO(self._get_connection()).update_labels(add_label_ids,
-                                                               remove_label_ids,
-                                                               current_batch_messages_list)
-                self.__connection.commit()
-                LOGGER.info(f"Processed {len(current_batch_messages_list)} of {len(message_ids_list)}")
-                print(f"Processed {len(current_batch_messages_list)} of {len(message_ids_list)}")
-            message_ids_list = message_ids_list[BULK_UPDATE_BATCH_SIZE:]
-            if not message_ids_list:
-                break
-        print("\n\nOUTPUT\nDone")
+                self.failed_count += len(message_ids)
+
+        with DBUtils.pooled_connection() as connection:
+            for matches in fetch_rule_matches(connection, rule_set, query_conditions, self.snapshot, message_ids):
+                for message_id, flags in matches:
+                    if flags not in actions_by_flags:
+                        actions_by_flags[flags] = self._merge_actions(
+                            rules['action'] for rules, matched in zip(rule_set, flags) if matched)
+                    action = actions_by_flags[flags]
+                    if not any(action):
+                        continue
+                    pending_messages.setdefault(action, []).append(message_id)
+                    # Process bulk update in batches (max batch size of Google's bulk update is 1000)
+                    if len(pending_messages[action]) == BULK_UPDATE_BATCH_SIZE:
+                        apply_pending_action(connection, action)
+            for action in list(pending_messages):
+                apply_pending_action(connection, action)
+        if self.failed_count:
+            LOGGER.error(f"{self.failed_count} of {processed_count + self.failed_count} matched messages could not "
+                         f"be modified")
+            if not quiet:
+                print(f"\n\nOUTPUT\n{self.failed_count} of {processed_count + self.failed_count} matched messages "
+                      f"could not be modified. See the log for the errors")
+            return processed_count
+        if not processed_count:
+            LOGGER.info("No messages in the database match the rules")
+            if not quiet:
+                print("\n\nOUTPUT\nNo messages in the database match the rules")
+            return processed_count
+        if not quiet:
+            print("\n\nOUTPUT\nDone")
+        return processed_count
+
+    def process_rules(self, rules):
+        """
+        :brief: Processes a single rule. See process_rule_set.
+        :param rules: a dictionary in the format of resources/rules.json
+        :raises: ValueError when the rules do not pass the validation checks
+        """
+        self.process_rule_set([rules])
@@ -0,0 +1,168 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from config.settings import MESSAGE_FORMAT_FULL, DOWNLOAD_FETCH_WORKERS, GMAIL_QUOTA_UNITS_PER_SECOND, \
+    MAILBOX_SYNC_NAME, BACKFILL_SYNC_NAME, BACKFILL_START_DATE, BACKFILL_MAX_ATTEMPTS
+from businesslogic.email_processor import EmailProcessor
+from lib.db_utils import DBUtils
+from lib.logger_utils import get_logger
+from models.sync_state import SyncStateDAO, SYNC_RUNNING, SYNC_DONE, SYNC_FAILED
+
+LOGGER = get_logger(__name__)
+
+SHARD_PREFIX = f'{BACKFILL_SYNC_NAME}:'
+
+
+def get_date_shards(shard_count, start_date=BACKFILL_START_DATE, query=None):
+    """
+    :brief: Splits the mailbox into shard_count consecutive date windows (after: / before: queries in epoch seconds)
+            of equal length, from start_date to now. The first window has no lower bound and the last one no upper
+            bound, so that together they cover the whole mailbox.
+    :param start_date: date (YYYY/MM/DD) of the end of the first window
+    :param query: Gmail search query applied to all the shards
+    :return: list of (shard name, messages.list arguments)
+    """
+    start = int(datetime.strptime(start_date, '%Y/%m/%d').timestamp())
+    end = int(datetime.now().timestamp())
+    step = max(1, (end - start) // max(1, shard_count - 1))
+    boundaries = [start + index * step for index in range(shard_count - 1)]
+    shards = []
+    for index in range(len(boundaries) + 1):
+        # after: is exclusive, hence the window starts a second earlier
+        conditions = []
+        if index > 0:
+            conditions.append(f'after:{boundaries[index - 1] - 1}')
+        if index < len(boundaries):
+            conditions.append(f'before:{boundaries[index]}')
+        shard_query = ' '.join(conditions + ([query] if query else []))
+        shards.append((f'{SHARD_PREFIX}{index:04d} {" ".join(conditions)}'.rstrip(),
+                       {'q': shard_query} if shard_query else {}))
+    return shards
+
+
+def get_label_shards(label_ids, query=None):
+    """
+    :return: list of (shard name, messages.list arguments) - one shard per label id
+    """
+    shards = []
+    for index, label_id in enumerate(label_ids):
+        parameters = {'labelIds': [label_id]}
+        if query:
+            parameters['q'] = query
+        shards.append((f'{SHARD_PREFIX}{index:04d} {label_id}', parameters))
+    return shards
+
+
+def run_shard(name, parameters, fetch_mode, fetch_workers, quota_units_per_second):
+    """
+    :brief: Downloads the emails of a shard. Runs in a worker process, with its own Gmail service and database pool.
+            The worker only logs: the progress is reported by the coordinator (see ShardedBackfill.run).
+    :return: number of emails saved
+    """
+    with DBUtils.pooled_connection() as connection:
+        SyncStateDAO(connection).update_status(name, SYNC_RUNNING)
+    try:
+        email_processor = EmailProcessor(fetch_workers, quota_units_per_second=quota_units_per_second)
+        # A shard interrupted by a failure (or by the end of the previous run) resumes from its checkpoint
+        message_count = email_processor.download_messages(fetch_mode, name, **parameters)
+    except Exception as ex:
+        LOGGER.exception(f"Shard {name} failed. Details: {ex}")
+        with DBUtils.pooled_connection() as connection:
+            SyncStateDAO(connection).update_status(name, SYNC_FAILED, error=str(ex))
+        raise
+    with DBUtils.pooled_connection() as connection:
+        SyncStateDAO(connection).update_status(name, SYNC_DONE, message_count)
+    LOGGER.info(f"Shard {name} saved {message_count} messages")
+    return message_count
+
+
+class ShardedBackfill(object):
+    """
+    Downloads a mailbox as independent shards (date windows or labels), each in a worker process, so that a backfill
+    uses all the cores and the full API quota. The per user quota is split evenly among the processes.
+    The coordinator (the calling process) records the shards in the sync_state table, retries the failed ones up to
+    max_attempts times and reports the merged progress. An interrupted backfill is resumed by the next run: only
+    the shards that are not done yet are downloaded again, each from its last checkpoint.
+    """
+
+    def __init__(self, processes, fetch_mode=MESSAGE_FORMAT_FULL, fetch_workers=DOWNLOAD_FETCH_WORKERS,
+                 max_attempts=BACKFILL_MAX_ATTEMPTS):
+        self.processes = max(1, processes)
+        self.fetch_mode = fetch_mode
+        self.fetch_workers = fetch_workers
+        self.max_attempts = max_attempts
+        self.quota_units_per_second = GMAIL_QUOTA_UNITS_PER_SECOND / self.processes \
+            if GMAIL_QUOTA_UNITS_PER_SECOND else None
+
+    @staticmethod
+    def _plan(shards, history_id):
+        """
+        :return: the shards to be downloaded. The shards of an unfinished backfill are resumed, when there is one.
+        """
+        with DBUtils.pooled_connection() as connection:
+            sync_state_dao = SyncStateDAO(connection)
+            saved_shards = sync_state_dao.get_shards(SHARD_PREFIX)
+            if any(shard['status'] != SYNC_DONE for shard in saved_shards):
+                LOGGER.info(f"Resuming the unfinished backfill of {len(saved_shards)} shards")
+                print(f"Resuming the unfinished backfill of {len(saved_shards)} shards")
+                return saved_shards
+            sync_state_dao.replace_shards(SHARD_PREFIX, shards)
+            # Only set for a mailbox sync. Saved as the checkpoint of the incremental sync once all shards are done.
+            sync_state_dao.save_history_id(BACKFILL_SYNC_NAME, history_id)
+            return sync_state_dao.get_shards(SHARD_PREFIX)
+
+    def run(self, shards, is_mailbox_sync=False):
+        """
+        :brief: Runs the backfill as follows:
+                1. Downloads the labels and plans the shards (or resumes the unfinished backfill)
+                2. Downloads the pending shards in parallel, retrying the failed ones
+                3. When all the shards of a mailbox sync are done, saves the history id taken at the start of the
+                   backfill as the checkpoint of the incremental sync
+        :param shards: list of (shard name, messages.list arguments), see get_date_shards and get_label_shards.
+                       Ignored when an unfinished backfill is resumed.
+        :param is_mailbox_sync: True when the shards cover the whole mailbox
+        :return: True when all the shards are done
+        """
+        email_processor = EmailProcessor(self.fetch_workers)
+        email_processor.download_and_save_labels()
+        history_id = email_processor.get_current_history_id() if is_mailbox_sync else None
+        shards = [shard for shard in self._plan(shards, history_id) if shard['status'] != SYNC_DONE]
+        with DBUtils.pooled_connection() as connection:
+            history_id = SyncStateDAO(connection).get_history_id(BACKFILL_SYNC_NAME)
+        attempts = {shard['name']: 0 for shard in shards}  # Attempts of this run
+        done_count, failed_count, message_count = 0, 0, 0
+        # Spawned, so that the workers do not inherit the database connections and threads of the coordinator
+        with ProcessPoolExecutor(max_workers=self.processes,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            def submit(shard):
+                attempts[shard['name']] += 1
+                return executor.submit(run_shard, shard['name'], shard['parameters'], self.fetch_mode,
+                                       self.fetch_workers, self.quota_units_per_second)
+
+            pending = {submit(shard): shard for shard in shards}
+            while pending:
+                for future in as_completed(list(pending)):
+                    shard = pending.pop(future)
+                    try:
+                        message_count += future.result()
+                        done_count += 1
+                    except Exception as ex:
+                        if attempts[shard['name']] < self.max_attempts:
+                            LOGGER.warning(f"Retrying shard {shard['name']}. Details: {ex}")
+                            pending[submit(shard)] = shard
+                            break
+                        failed_count += 1
+                        LOGGER.error(f"Giving up on shard {shard['name']} after {attempts[shard['name']]} attempts")
+                    progress = f"Shards done: {done_count} of {len(shards)}, failed: {failed_count}. " \
+                               f"Messages saved: {message_count}"
+                    LOGGER.info(progress)
+                    print(progress)
+        if failed_count:
+            LOGGER.error(f"{failed_count} shards failed")
+            print(f"{failed_count} shards failed. Run the backfill again to resume them")
+            return False
+        if history_id:
+            with DBUtils.pooled_connection() as connection:
+                SyncStateDAO(connection).save_history_id(MAILBOX_SYNC_NAME, history_id)
+        return True
@@ -0,0 +1,117 @@
+import threading
+import time
+
+from config.settings import MESSAGE_FORMAT_FULL, DAEMON_POLL_INTERVAL, DAEMON_MAX_RETRY_DELAY
+from lib import metrics
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class SyncDaemon(object):
+    """
+    Resident process keeping the database (and the labels in Gmail) in sync with the mailbox. The Gmail services,
+    the database pool, the validated rules and the rule snapshot stay warm between the cycles. Each cycle:
+     1. Runs an incremental sync of the mailbox (a full sync on the first run, when there is no history checkpoint)
+     2. Applies the rules to the messages added or relabelled by the sync only (to all of them after a full sync)
+    A cycle is run when the history id of the mailbox changes. It is checked every poll_interval seconds, and right
+    away when notify is called (Eg. by a change notification, see FakeMailbox.add_listener).
+    The messages relabelled by the rules are synchronized by the next cycle and evaluated once more, which leaves
+    them unchanged.
+    """
+
+    def __init__(self, email_processor, rules_processor=None, rule_set=None, fetch_mode=MESSAGE_FORMAT_FULL,
+                 poll_interval=DAEMON_POLL_INTERVAL):
+        """
+        :param email_processor: EmailProcessor running the syncs
+        :param rules_processor: RulesProcessor applying the rule set. None to only synchronize the mailbox.
+        :param rule_set: list of rules, each in the format of resources/rules.json
+        :param fetch_mode: One of full, metadata or minimal. Applies to the new messages.
+        :param poll_interval: seconds between two checks of the mailbox for changes
+        :raises: ValueError when any of the rules do not pass the validation checks
+        """
+        if rules_processor:
+            rules_processor.validate_rule_set(rule_set)
+        self.email_processor = email_processor
+        self.rules_processor = rules_processor
+        self.rule_set = rule_set
+        self.fetch_mode = fetch_mode
+        self.poll_interval = poll_interval
+        self.cycle_count = 0
+        self.__wakeup = threading.Event()
+        self.__stopped = threading.Event()
+        self.__notified_at = None  # Time of the first notification not handled yet
+
+    def notify(self, history_id=None):
+        """
+        :brief: Wakes the daemon up to check the mailbox for changes. Safe to call from any thread.
+        :param history_id: history id of the change (ignored, the mailbox is checked all the same)
+        """
+        if self.__notified_at is None:
+            self.__notified_at = time.monotonic()
+        self.__wakeup.set()
+
+    def stop(self):
+        """
+        :brief: Stops the daemon once its current cycle is done. Safe to call from any thread (or signal handler).
+        """
+        self.__stopped.set()
+        self.__wakeup.set()
+
+    def run_cycle(self):
+        """
+        :brief: Synchronizes the mailbox and applies the rules to the changed messages
+        :return: number of messages changed by the sync. None after a full sync.
+        """
+        start = time.perf_counter()
+        self.email_processor.download_emails_to_db(None, self.fetch_mode, incremental=True)
+        changed_ids = self.email_processor.changed_message_ids
+        if changed_ids is not None:
+            metrics.increment('daemon_changed_messages_total', len(changed_ids))
+        if self.rules_processor:
+            with metrics.timed('daemon_rules_seconds'):
+                modified_count = self.rules_processor.process_rule_set(self.rule_set, changed_ids, quiet=True)
+            LOGGER.info(f"Cycle {self.cycle_count + 1} modified {modified_count} messages by the rules")
+            if self.rules_processor.failed_count:
+                LOGGER.warning(f"Cycle {self.cycle_count + 1} could not modify {self.rules_processor.failed_count} "
+                               f"messages matched by the rules")
+        self.cycle_count += 1
+        metrics.increment('daemon_cycles_total')
+        metrics.observe('daemon_cycle_seconds', time.perf_counter() - start)
+        LOGGER.info(f"Cycle {self.cycle_count} synchronized the mailbox to history id "
+                    f"{self.email_processor.synced_history_id}: "
+                    f"{'all' if changed_ids is None else len(changed_ids)} messages changed")
+        return None if changed_ids is None else len(changed_ids)
+
+    def _has_changes(self):
+        return self.email_processor.synced_history_id is None or \
+            self.email_processor.get_current_history_id() != self.email_processor.synced_history_id
+
+    def run(self):
+        """
+        :brief: Runs the cycles until stop is called. A failed cycle is retried after poll_interval seconds, doubled
+                after each consecutive failure (up to DAEMON_MAX_RETRY_DELAY seconds).
+        """
+        LOGGER.info(f"Sync daemon started. Polling the mailbox every {self.poll_interval} seconds")
+        failures = 0
+        while not self.__stopped.is_set():
+            notified_at, self.__notified_at = self.__notified_at, None
+            self.__wakeup.clear()
+            try:
+                with metrics.timed('daemon_poll_seconds'):
+                    has_changes = self._has_changes()
+                if has_changes:
+                    self.run_cycle()
+                    if notified_at is not None:
+                        metrics.observe('daemon_notification_latency_seconds', time.monotonic() - notified_at)
+                failures = 0
+                delay = self.poll_interval
+            except Exception as ex:
+                failures += 1
+                delay = min(self.poll_interval * 2 ** (failures - 1), DAEMON_MAX_RETRY_DELAY)
+                metrics.increment('daemon_failed_cycles_total')
+                LOGGER.exception(f"Sync cycle failed ({failures} in a row). Retrying in {delay} seconds. "
+                                 f"Details: {ex}")
+            # The notifications do not cut the retry delay short
+            (self.__stopped if failures else self.__wakeup).wait(delay)
+        LOGGER.info(f"Sync daemon stopped after {self.cycle_count} cycles")
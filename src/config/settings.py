@@ -5,12 +5,71 @@ SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googlea
 
 PYTHON_PATH = os.environ['PYTHONPATH']
 TOKEN_FILE_PATH = f'{PYTHON_PATH}/config/token.json'
+TOKEN_LOCK_FILE_PATH = f'{PYTHON_PATH}/config/token.json.lock'  # Serializes the token refreshes of the processes
 CREDENTIALS_FILE_PATH = f'{PYTHON_PATH}/config/credentials.json'
-MAX_EMAIL_LIMIT = 1000
+# Discovery document of the Gmail API. Downloaded only when google-api-python-client does not bundle it.
+GMAIL_DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+DISCOVERY_DOCUMENT_PATH = f'{PYTHON_PATH}/../cache/gmail.v1.json'
 MYSQL_DB_CREDENTIALS = dict(user='appuser', password='$ecr3tpas5w0rD', host='127.0.0.1', database='google_mail')
+DB_POOL_SIZE = 5  # Maximum number of open database connections shared by the processors
+DB_POOL_IDLE_CHECK_SECONDS = 60  # A pooled connection idle for longer is pinged before being handed out
+DB_POOL_CHECKOUT_TIMEOUT = 30  # Seconds to wait for a free connection when the pool is exhausted
+DB_DEADLOCK_MAX_ATTEMPTS = 3  # Attempts of a transaction chosen as the victim of a deadlock (where retried)
 QUERYABLE_HEADERS = ('From', 'Cc', 'Bcc', 'Subject', 'To')
-DEFAULT_HEADER_DICT = dict(cc=None, bcc=None)
+DEFAULT_HEADER_DICT = {'from': '', 'to': '', 'subject': '', 'cc': None, 'bcc': None}
 MESSAGE_FORMAT_FULL = 'full'  # Returns the full content of an email
 MESSAGE_FORMAT_MINIMAL = 'minimal'  # To fetch only label ids of a previously fetched email
-BATCH_FETCH_EMAIL_SIZE = 1000  # Google mail's batch processing limit
+MESSAGE_FORMAT_METADATA = 'metadata'  # To fetch the labels and the QUERYABLE_HEADERS, without the email body
+MESSAGE_FORMATS = (MESSAGE_FORMAT_FULL, MESSAGE_FORMAT_METADATA, MESSAGE_FORMAT_MINIMAL)
+MAX_LIST_PAGE_SIZE = 500  # Google mail's page size limit when listing messages
+# Upper bound of the adaptive batch size. Google mail accepts up to 1000 requests per batch,
+# but rate limits batches of more than 50 requests
+BATCH_FETCH_EMAIL_SIZE = 50
+GMAIL_MIN_BATCH_SIZE = 5  # Lower bound (and growth step) of the adaptive batch size
+GMAIL_QUOTA_UNITS_PER_SECOND = 250  # Google mail's per user quota. None to disable the client side rate limit
+GMAIL_MAX_RETRIES = 5  # Retries of a rate limited (429) or failed (5xx) request
+GMAIL_BACKOFF_BASE_SECONDS = 1  # Cap of the first retry delay, doubled on every retry
+GMAIL_BACKOFF_MAX_SECONDS = 64
 BULK_UPDATE_BATCH_SIZE = 1000
+MAILBOX_SYNC_NAME = 'mailbox'  # sync_state entry holding the history checkpoint of the whole mailbox
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+DOWNLOAD_FETCH_WORKERS = 4  # Number of pages of messages fetched concurrently
+DOWNLOAD_QUEUE_SIZE = 4  # Maximum number of pages waiting between two download stages
+DOWNLOAD_SYNC_NAME = 'download'  # sync_state entry checkpointing the progress of the last full sync
+DOWNLOAD_CHECKPOINT_INTERVAL = 30  # Minimum seconds between two checkpoints of a download
+BACKFILL_SYNC_NAME = 'backfill'  # sync_state entries of the sharded backfill ('backfill' and 'backfill:<shard>')
+BACKFILL_SHARDS_PER_PROCESS = 4  # Date shards per worker process, so that uneven shards balance out
+BACKFILL_START_DATE = '2004/04/01'  # End of the first date shard (which holds all the older emails)
+BACKFILL_MAX_ATTEMPTS = 3  # Attempts of a failed shard per backfill run
+DAEMON_POLL_INTERVAL = 30  # Seconds between two checks of the mailbox for changes by the sync daemon
+DAEMON_MAX_RETRY_DELAY = 600  # Maximum seconds the sync daemon waits after consecutive failed cycles
+WRITE_BUFFER_FLUSH_SIZE = 500  # Number of buffered messages saved per transaction
+WRITE_BUFFER_FLUSH_INTERVAL = 5  # Maximum seconds between two flushes of the write buffer (while messages arrive)
+FULLTEXT_NGRAM_TOKEN_SIZE = 2  # Should match the ngram_token_size setting of the MySQL server
+MESSAGE_PART_MAX_CONTENT_SIZE = 256 * 1024  # Bytes of a text part saved in message_part. Larger bodies are truncated
+MESSAGE_PART_MAX_BATCH_BYTES = 8 * 1024 * 1024  # Maximum size of a multi-row message_part insert (max_allowed_packet)
+MESSAGE_CACHE_DIR = f'{PYTHON_PATH}/../cache'  # On-disk cache of the downloaded messages (see lib/message_cache.py)
+MESSAGE_CACHE_SEGMENT_SIZE = 256 * 1024 * 1024  # Bytes per segment file of the message cache
+RULE_SNAPSHOT_PATH = f'{PYTHON_PATH}/../cache/rule_snapshot.npz'  # In-memory rule snapshot, saved between runs
+# Seconds re-read before the last refresh of the rule snapshot, for the transactions committed while it ran
+RULE_SNAPSHOT_REFRESH_OVERLAP = 60
+# Maximum characters of the participants and of the labels of a thread summary (group_concat_max_len)
+THREAD_SUMMARY_MAX_TEXT_SIZE = 16384
+ARCHIVE_HOT_MONTHS = 12  # Months of mail kept in monthly partitions. Older months are compacted into yearly ones
+ARCHIVE_MONTHS_AHEAD = 3  # Monthly partitions created ahead of time, so that new mail does not land in pmax
+ARCHIVE_PARTITIONED_TABLES = ('email_attributes', 'message_label')  # Tables partitioned by internal_timestamp
+RULE_PLAN_SAMPLE_SIZE = 10  # Message ids listed per rule by a dry run of the rules
+RULE_PLAN_WARN_MATCH_SHARE = 0.25  # Share of the mailbox modified by a rule set, above which a dry run warns
+# Upper bounds (seconds) of the buckets of the timing histograms (see lib/metrics.py)
+METRICS_HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_DUMP_INTERVAL = 60  # Seconds between two JSON dumps of the metrics
+FAKE_MAILBOX_SPAN_DAYS = 3650  # Period over which the messages of a synthetic mailbox are spread (lib/fake_gmail.py)
+FAKE_MAILBOX_BODY_SIZE = 2048  # Approximate bytes of text in the body of a synthetic message
+BENCHMARK_DB_NAME = 'google_mail_benchmark'  # Database used (and cleared) by the benchmark script
+BENCHMARK_SIZES = (10000, 100000, 1000000)  # Default mailbox sizes of the benchmark script
+# Logging. The levels are standard logging level names.
+LOG_LEVEL = os.environ.get('EMAILAPP_LOG_LEVEL', 'INFO')
+# Levels of individual loggers (module names), Eg. "models.email=DEBUG,lib.fake_gmail=WARNING"
+LOG_LEVELS = dict(item.split('=', 1) for item in os.environ.get('EMAILAPP_LOG_LEVELS', '').split(',') if '=' in item)
+# Only one in every LOG_DEBUG_SAMPLE_RATE debug records of a line of code is logged. 1 to log all of them.
+LOG_DEBUG_SAMPLE_RATE = int(os.environ.get('EMAILAPP_LOG_DEBUG_SAMPLE_RATE', '100'))
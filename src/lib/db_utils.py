@@ -1,12 +1,80 @@
+import queue
 import re
+import threading
+import time
+from contextlib import contextmanager
 
 import mysql.connector
 
-from config.settings import MYSQL_DB_CREDENTIALS
+from config.settings import MYSQL_DB_CREDENTIALS, DB_POOL_SIZE, DB_POOL_IDLE_CHECK_SECONDS, DB_POOL_CHECKOUT_TIMEOUT
 from lib.logger_utils import get_logger
 
 LOGGER = get_logger(__name__)
 
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of database connections shared by the DAOs and the processors (across threads).
+    Checked in connections are kept open, and the most recently used one is handed out first.
+    A connection is health checked (pinged) on checkout only when it has been idle for idle_check_seconds.
+    """
+
+    def __init__(self, size=DB_POOL_SIZE, idle_check_seconds=DB_POOL_IDLE_CHECK_SECONDS,
+                 checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT):
+        self.__idle_connections = queue.LifoQueue()
+        self.__slots = threading.BoundedSemaphore(size)
+        self.__idle_check_seconds = idle_check_seconds
+        self.__checkout_timeout = checkout_timeout
+
+    def get_connection(self):
+        """
+        :return: a connection (autocommit off). Should be returned with release().
+        :raises: mysql.connector.PoolError when no connection is available within the checkout timeout
+        """
+        if not self.__slots.acquire(timeout=self.__checkout_timeout):
+            raise mysql.connector.PoolError("No database connection available in the pool")
+        try:
+            connection, last_used = self.__idle_connections.get_nowait()
+            if time.monotonic() - last_used >= self.__idle_check_seconds:
+                connection.ping(reconnect=True, attempts=3, delay=1)
+        except queue.Empty:
+            connection = DBUtils.get_new_connection(autocommit=False)
+        except Exception:
+            self.__slots.release()
+            raise
+        if connection is None:
+            self.__slots.release()
+            raise mysql.connector.PoolError("Unable to open a database connection")
+        return connection
+
+    def release(self, connection):
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+            self.__idle_connections.put((connection, time.monotonic()))
+        except mysql.connector.Error as ex:
+            # A broken connection is dropped. The next checkout opens a new one in its place.
+            LOGGER.warning(f"Discarding database connection {connection.connection_id}. Details: {ex}")
+        finally:
+            self.__slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection = self.get_connection()
+        try:
+            yield connection
+        except Exception:
+            try:
+                connection.rollback()
+            except mysql.connector.Error:
+                pass
+            raise
+        finally:
+            self.release(connection)
+
 
 class DBUtils(object):
     @staticmethod
@@ -20,15 +88,26 @@ class DBUtils(object):
         except (mysql.connector.DatabaseError,
                 mysql.connector.OperationalError,
                 mysql.connector.PoolError) as ex:
-            LOGGER.exception("Exception while obtaining connection. Details %s", ex, exc_info=True)
+            LOGGER.exception("Exception while obtaining connection. Details %s", ex)
 
     @staticmethod
-    def renew_or_get_new_connection(connection):
-        if not connection:
-            connection = DBUtils.get_new_connection(autocommit=False)
-        if not connection.is_connected():
-            connection.ping(reconnect=True)
-        return connection
+    def get_pool():
+        global _POOL
+        if _POOL is None:
+            with _POOL_LOCK:
+                if _POOL is None:
+                    _POOL = ConnectionPool()
+        return _POOL
+
+    @staticmethod
+    @contextmanager
+    def pooled_connection():
+        """
+        :brief: Context manager that checks out a connection (autocommit off) from the shared pool and returns it
+                to the pool on exit. Uncommitted changes are rolled back when the block raises.
+        """
+        with DBUtils.get_pool().connection() as connection:
+            yield connection
 
     @staticmethod
     def _formatargs(query, arguments):
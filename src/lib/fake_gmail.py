@@ -0,0 +1,423 @@
+import base64
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+from email.parser import Parser
+
+import httplib2
+
+from config.settings import FAKE_MAILBOX_SPAN_DAYS, FAKE_MAILBOX_BODY_SIZE
+from lib.google_api import build_service
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+FAKE_USER_EMAIL = 'me@example.com'
+FAKE_MESSAGE_ID_BASE = 0x1800000000000000  # Keeps the generated ids 16 hex digits long, as Gmail's
+FAKE_INITIAL_HISTORY_ID = 100000
+FAKE_THREAD_SIZE = 3  # Number of consecutive generated messages sharing a thread
+SYSTEM_LABELS = ('INBOX', 'SENT', 'UNREAD', 'IMPORTANT', 'STARRED', 'TRASH', 'SPAM', 'DRAFT', 'CATEGORY_PERSONAL',
+                 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS')
+# Includes the labels used by resources/rule_set.json
+USER_LABELS = {'Label_6750378022126076362': 'Apptest1',
+               'Label_7242846678098072756': 'Apptest2',
+               'Label_1001': 'Receipts',
+               'Label_1002': 'Travel'
+               }
+SENDERS = ('Orkut <noreply@orkut.com>', 'Alice <alice@example.org>', 'Bob <bob@example.net>',
+           'Newsletter <news@shop.example.com>', 'Bank <alerts@bank.example.com>', 'Carol <carol@example.org>')
+SUBJECT_WORDS = ('Orkut', 'invoice', 'meeting', 'weekly', 'report', 'travel', 'newsletter', 'offer', 'account',
+                 'update', 'photos', 'reminder', 'project', 'scrap', 'friend', 'request', 'payment', 'holiday')
+BODY_WORDS = SUBJECT_WORDS + ('please', 'find', 'attached', 'regards', 'thanks', 'tomorrow', 'review', 'details')
+HISTORY_TYPE_KEYS = {'messageAdded': 'messagesAdded',
+                     'messageDeleted': 'messagesDeleted',
+                     'labelAdded': 'labelsAdded',
+                     'labelRemoved': 'labelsRemoved'
+                     }
+LIST_PAGE_SIZE = 100  # Default maxResults of messages.list and history.list
+QUERY_DATE_PATTERN = re.compile(r'\b(after|before):(\S+)')
+ROUTES = (('GET', re.compile(r'^/gmail/v1/users/[^/]+/labels$'), 'list_labels'),
+          ('GET', re.compile(r'^/gmail/v1/users/[^/]+/profile$'), 'get_profile'),
+          ('GET', re.compile(r'^/gmail/v1/users/[^/]+/history$'), 'list_history'),
+          ('GET', re.compile(r'^/gmail/v1/users/[^/]+/messages$'), 'list_messages'),
+          ('POST', re.compile(r'^/gmail/v1/users/[^/]+/messages/batchModify$'), 'batch_modify'),
+          ('GET', re.compile(r'^/gmail/v1/users/[^/]+/messages/([0-9a-f]+)$'), 'get_message'),
+          )
+
+
+class FakeGmailError(Exception):
+    def __init__(self, status, message, reason):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+    def to_json(self):
+        return {'error': {'code': self.status, 'message': str(self), 'errors': [{'reason': self.reason}]}}
+
+
+def encode_body(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def parse_query_date(value):
+    """
+    :return: epoch milliseconds of a date in a Gmail search query (YYYY/MM/DD or epoch seconds)
+    """
+    if value.isdigit():
+        return int(value) * 1000
+    return int(datetime.strptime(value.replace('-', '/'), '%Y/%m/%d').timestamp()) * 1000
+
+
+class FakeMailbox(object):
+    """
+    Synthetic Gmail mailbox of a configurable number of messages, generated lazily and deterministically from the
+    message index (so that a mailbox of a million messages costs no memory until its messages change).
+    Message #0 is the oldest; the internal dates are spread evenly over span_days up to the creation time.
+    The mailbox records a history of its changes (delivered, deleted and relabelled messages), served by the
+    history API of FakeGmailHttp. Listeners are notified of the changes, as with Gmail push notifications.
+    """
+
+    def __init__(self, size, seed=0, span_days=FAKE_MAILBOX_SPAN_DAYS, body_size=FAKE_MAILBOX_BODY_SIZE):
+        self.seed = seed
+        self.body_size = body_size
+        self.__count = size
+        self.__end_time = int(time.time() * 1000)
+        self.__interval = span_days * 86400 * 1000 // max(size, 1)
+        self.__delivered_times = {}  # message index -> internal date of the messages delivered after the creation
+        self.__label_overrides = {}  # message index -> labels set by batchModify
+        self.__deleted = set()
+        self.__history = []  # history records, oldest first
+        self.__history_id = FAKE_INITIAL_HISTORY_ID
+        self.__listeners = []
+        self.__notified_history_id = FAKE_INITIAL_HISTORY_ID
+        self.__lock = threading.Lock()
+
+    @property
+    def history_id(self):
+        return self.__history_id
+
+    def __len__(self):
+        return self.__count - len(self.__deleted)
+
+    @staticmethod
+    def get_message_id(index):
+        return format(FAKE_MESSAGE_ID_BASE + index, 'x')
+
+    def get_index(self, message_id):
+        """
+        :return: index of the (hex) message id, None when there is no such message in the mailbox
+        """
+        index = int(message_id, 16) - FAKE_MESSAGE_ID_BASE
+        if index < 0 or index >= self.__count or index in self.__deleted:
+            return None
+        return index
+
+    def get_internal_date(self, index):
+        if index in self.__delivered_times:
+            return self.__delivered_times[index]
+        return self.__end_time - (self.__count - 1 - index) * self.__interval
+
+    def _get_generated_labels(self, index, sent):
+        random_generator = random.Random(f'{self.seed}:labels:{index}')
+        labels = ['SENT'] if sent else ['INBOX', random_generator.choice(SYSTEM_LABELS[-5:])]
+        if not sent and random_generator.random() < 0.3:
+            labels.append('UNREAD')
+        if random_generator.random() < 0.1:
+            labels.append('IMPORTANT')
+        if random_generator.random() < 0.2:
+            labels.append(random_generator.choice(list(USER_LABELS)))
+        return labels
+
+    def _is_sent(self, index):
+        return random.Random(f'{self.seed}:sent:{index}').random() < 0.15
+
+    def get_labels(self, index):
+        labels = self.__label_overrides.get(index)
+        if labels is None:
+            labels = self._get_generated_labels(index, self._is_sent(index))
+        return list(labels)
+
+    def get_message(self, index):
+        """
+        :return: the message in the 'full' format of the GET message API
+        """
+        random_generator = random.Random(f'{self.seed}:message:{index}')
+        sent = self._is_sent(index)
+        subject = ' '.join(random_generator.choice(SUBJECT_WORDS) for _ in range(random_generator.randint(2, 6)))
+        other_party = random_generator.choice(SENDERS)
+        internal_date = self.get_internal_date(index)
+        words, text_size = [], 0
+        while text_size < self.body_size:
+            words.append(random_generator.choice(BODY_WORDS))
+            text_size += len(words[-1]) + 1
+        text = ' '.join(words)
+        html = f'<html><body><p>{text}</p></body></html>'
+        headers = [{'name': 'From', 'value': FAKE_USER_EMAIL if sent else other_party},
+                   {'name': 'To', 'value': other_party if sent else FAKE_USER_EMAIL},
+                   {'name': 'Subject', 'value': subject.capitalize()},
+                   {'name': 'Date', 'value': datetime.fromtimestamp(internal_date // 1000).strftime(
+                       '%a, %d %b %Y %H:%M:%S +0000')},
+                   {'name': 'Message-ID', 'value': f'<{index}.{self.seed}@example.com>'},
+                   {'name': 'Content-Type', 'value': 'multipart/alternative; boundary="000000000000fake"'}]
+        if random_generator.random() < 0.2:
+            headers.append({'name': 'Cc', 'value': random_generator.choice(SENDERS)})
+        return {'id': self.get_message_id(index),
+                'threadId': self.get_message_id(index - index % FAKE_THREAD_SIZE),
+                'labelIds': self.get_labels(index),
+                'snippet': text[:100],
+                'historyId': str(self.__history_id),
+                'internalDate': str(internal_date),
+                'sizeEstimate': len(text) + len(html) + 500,
+                'payload': {'partId': '', 'mimeType': 'multipart/alternative', 'filename': '', 'headers': headers,
+                            'body': {'size': 0},
+                            'parts': [{'partId': '0', 'mimeType': 'text/plain', 'filename': '',
+                                       'headers': [{'name': 'Content-Type',
+                                                    'value': 'text/plain; charset="UTF-8"'}],
+                                       'body': {'size': len(text), 'data': encode_body(text)}},
+                                      {'partId': '1', 'mimeType': 'text/html', 'filename': '',
+                                       'headers': [{'name': 'Content-Type',
+                                                    'value': 'text/html; charset="UTF-8"'}],
+                                       'body': {'size': len(html), 'data': encode_body(html)}}]}
+                }
+
+    def iter_indexes(self, label_ids=None, after=None, before=None, start=None):
+        """
+        :brief: Generator over the indexes of the messages matching the filters, newest first
+        :param label_ids: the messages should have all these labels
+        :param after: epoch milliseconds. The messages should be received after it.
+        :param before: epoch milliseconds. The messages should be received before it.
+        :param start: index to start from (inclusive)
+        """
+        index = self.__count - 1 if start is None else start
+        while index >= 0:
+            if index not in self.__deleted:
+                internal_date = self.get_internal_date(index)
+                if before is not None and internal_date >= before:
+                    index -= 1
+                    continue
+                if after is not None and internal_date < after:
+                    # Internal dates grow with the index
+                    break
+                if not label_ids or set(label_ids).issubset(self.get_labels(index)):
+                    yield index
+            index -= 1
+
+    def add_listener(self, listener):
+        """
+        :param listener: callable(history_id) called after every change of the mailbox (from the changing thread)
+        """
+        self.__listeners.append(listener)
+
+    def _notify(self, history_id):
+        # As with Gmail, only the changes recorded in the history are notified
+        if history_id == self.__notified_history_id:
+            return
+        self.__notified_history_id = history_id
+        for listener in self.__listeners:
+            listener(history_id)
+
+    def _add_history(self, change_type, index, **change):
+        self.__history_id += 1
+        message = {'id': self.get_message_id(index),
+                   'threadId': self.get_message_id(index - index % FAKE_THREAD_SIZE),
+                   'labelIds': self.get_labels(index)}
+        self.__history.append({'id': str(self.__history_id), 'messages': [message],
+                               change_type: [dict(change, message=message)]})
+
+    def deliver(self, count=1, label_ids=('INBOX', 'UNREAD')):
+        """
+        :brief: Adds new messages to the mailbox (received now), as the recipient of new emails would
+        :return: ids of the new messages
+        """
+        message_ids = []
+        with self.__lock:
+            for _ in range(count):
+                index = self.__count
+                self.__count += 1
+                self.__delivered_times[index] = int(time.time() * 1000)
+                self.__label_overrides[index] = list(label_ids)
+                self._add_history('messagesAdded', index)
+                message_ids.append(self.get_message_id(index))
+            history_id = self.__history_id
+        self._notify(history_id)
+        return message_ids
+
+    def delete(self, message_ids):
+        with self.__lock:
+            for message_id in message_ids:
+                index = self.get_index(message_id)
+                if index is not None:
+                    self._add_history('messagesDeleted', index)
+                    self.__deleted.add(index)
+            history_id = self.__history_id
+        self._notify(history_id)
+
+    def modify(self, message_ids, add_label_ids=(), remove_label_ids=()):
+        """
+        :brief: Applies a batchModify request to the messages. Unknown message ids are skipped.
+        """
+        with self.__lock:
+            for message_id in message_ids:
+                index = self.get_index(message_id)
+                if index is None:
+                    continue
+                labels = self.get_labels(index)
+                added = [label for label in add_label_ids if label not in labels]
+                removed = [label for label in remove_label_ids if label in labels and label not in add_label_ids]
+                self.__label_overrides[index] = [label for label in labels if label not in removed] + added
+                if added:
+                    self._add_history('labelsAdded', index, labelIds=added)
+                if removed:
+                    self._add_history('labelsRemoved', index, labelIds=removed)
+            history_id = self.__history_id
+        self._notify(history_id)
+
+    def get_history(self, start_history_id):
+        """
+        :return: the history records after start_history_id
+        :raises: FakeGmailError (404) when start_history_id is older than the history of the mailbox
+        """
+        if start_history_id < FAKE_INITIAL_HISTORY_ID:
+            raise FakeGmailError(404, 'Requested entity was not found.', 'notFound')
+        with self.__lock:
+            return [record for record in self.__history if int(record['id']) > start_history_id]
+
+
+class FakeGmailHttp(object):
+    """
+    Local stand-in for the Gmail REST API, serving a FakeMailbox. It is plugged into the Google API client as its
+    http object (httplib2.Http interface), so that the client builds, serializes and parses the requests and the
+    batch responses exactly as it does against Gmail.
+    Supported: labels.list, getProfile, history.list, messages.list (labelIds and after: / before: queries),
+    messages.get (full / metadata / minimal), messages.batchModify and batch requests.
+    :param latency: seconds added to every HTTP round trip
+    :param error_rate: fraction of the API calls (including the ones in a batch) failing with 429 rate limit errors
+    """
+
+    def __init__(self, mailbox, latency=0, error_rate=0, seed=0):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.error_rate = error_rate
+        self.__random = random.Random(seed)
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        parsed_uri = urllib.parse.urlparse(uri)
+        if parsed_uri.path.startswith('/batch'):
+            return self._batch(body, headers or {})
+        status, content = self._call(method, parsed_uri.path, parsed_uri.query, body)
+        return httplib2.Response({'status': status, 'content-type': 'application/json; charset=UTF-8'}), content
+
+    def _call(self, method, path, query, body):
+        """
+        :return: (HTTP status, JSON response body)
+        """
+        try:
+            if self.error_rate and self.__random.random() < self.error_rate:
+                raise FakeGmailError(429, 'Too many concurrent requests for user', 'rateLimitExceeded')
+            parameters = urllib.parse.parse_qs(query)
+            for route_method, pattern, handler in ROUTES:
+                match = pattern.match(path)
+                if match and route_method == method:
+                    response = getattr(self, handler)(parameters, json.loads(body) if body else None,
+                                                      *match.groups())
+                    if response is None:
+                        return 204, b''
+                    return 200, json.dumps(response).encode('utf-8')
+            raise FakeGmailError(404, f'Not found: {method} {path}', 'notFound')
+        except FakeGmailError as ex:
+            return ex.status, json.dumps(ex.to_json()).encode('utf-8')
+
+    def _batch(self, body, headers):
+        boundary = 'batch_fake_response'
+        batch_request = Parser().parsestr(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        response_parts = []
+        for part in batch_request.get_payload():
+            request_lines, _, request_body = part.get_payload().partition('\n\n')
+            method, request_uri, _ = request_lines.split('\n', 1)[0].split(' ')
+            parsed_uri = urllib.parse.urlparse(request_uri)
+            status, content = self._call(method, parsed_uri.path, parsed_uri.query, request_body.strip() or None)
+            response_parts.append(f"--{boundary}\r\nContent-Type: application/http\r\n"
+                                  f"Content-ID: <response-{part['Content-ID'][1:]}\r\n\r\n"
+                                  f"HTTP/1.1 {status} {'Error' if status >= 300 else 'OK'}\r\n"
+                                  f"Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                                  f"{content.decode('utf-8')}\r\n")
+        content = ''.join(response_parts) + f'--{boundary}--\r\n'
+        return httplib2.Response({'status': 200, 'content-type': f'multipart/mixed; boundary={boundary}'}), \
+            content.encode('utf-8')
+
+    def list_labels(self, parameters, body):
+        labels = [{'id': label, 'name': label, 'type': 'system'} for label in SYSTEM_LABELS]
+        labels += [{'id': label, 'name': name, 'type': 'user'} for label, name in USER_LABELS.items()]
+        return {'labels': labels}
+
+    def get_profile(self, parameters, body):
+        return {'emailAddress': FAKE_USER_EMAIL, 'messagesTotal': len(self.mailbox),
+                'historyId': str(self.mailbox.history_id)}
+
+    def list_history(self, parameters, body):
+        history = self.mailbox.get_history(int(parameters['startHistoryId'][0]))
+        history_types = parameters.get('historyTypes')
+        if history_types:
+            history_types = {HISTORY_TYPE_KEYS[history_type] for history_type in history_types}
+            history = [record for record in history if history_types.intersection(record)]
+        start = int(parameters.get('pageToken', ['0'])[0])
+        page_size = int(parameters.get('maxResults', [LIST_PAGE_SIZE])[0])
+        response = {'history': history[start:start + page_size], 'historyId': str(self.mailbox.history_id)}
+        if start + page_size < len(history):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def list_messages(self, parameters, body):
+        filters = {'label_ids': parameters.get('labelIds')}
+        for operator, value in QUERY_DATE_PATTERN.findall(parameters.get('q', [''])[0]):
+            filters[operator] = parse_query_date(value)
+        if 'pageToken' in parameters:
+            filters['start'] = int(parameters['pageToken'][0])
+        page_size = min(int(parameters.get('maxResults', [LIST_PAGE_SIZE])[0]), 500)
+        indexes = self.mailbox.iter_indexes(**filters)
+        messages = [{'id': self.mailbox.get_message_id(index),
+                     'threadId': self.mailbox.get_message_id(index - index % FAKE_THREAD_SIZE)}
+                    for _, index in zip(range(page_size), indexes)]
+        response = {'messages': messages, 'resultSizeEstimate': len(messages)}
+        next_index = next(indexes, None)
+        if next_index is not None:
+            response['nextPageToken'] = str(next_index)
+        return response
+
+    def get_message(self, parameters, body, message_id):
+        index = self.mailbox.get_index(message_id)
+        if index is None:
+            raise FakeGmailError(404, 'Requested entity was not found.', 'notFound')
+        message = self.mailbox.get_message(index)
+        message_format = parameters.get('format', ['full'])[0]
+        if message_format == 'minimal':
+            message.pop('payload')
+        elif message_format == 'metadata':
+            metadata_headers = {header.lower() for header in parameters.get('metadataHeaders', [])}
+            message['payload'] = {'partId': '', 'mimeType': message['payload']['mimeType'], 'filename': '',
+                                  'headers': [header for header in message['payload']['headers']
+                                              if not metadata_headers or header['name'].lower() in metadata_headers]}
+        return message
+
+    def batch_modify(self, parameters, body):
+        if len(body.get('ids', [])) > 1000:
+            raise FakeGmailError(400, 'Too many ids in the request', 'invalidArgument')
+        self.mailbox.modify(body.get('ids', []), body.get('addLabelIds') or [], body.get('removeLabelIds') or [])
+        return None
+
+
+def get_fake_service_factory(mailbox, latency=0, error_rate=0):
+    """
+    :return: a service factory (see EmailProcessor) building Gmail service objects served by the mailbox
+    """
+
+    def get_service_instance():
+        return build_service(http=FakeGmailHttp(mailbox, latency, error_rate))
+
+    return get_service_instance
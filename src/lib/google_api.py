@@ -2,19 +2,138 @@ from __future__ import print_function
 
 import os.path
 import json
+import threading
+from contextlib import contextmanager
+
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+
+try:
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError:  # google-api-python-client < 2.0 does not bundle the discovery documents
+    get_static_doc = None
+try:
+    import fcntl
+except ImportError:  # Windows. The token file is not locked.
+    fcntl = None
+
+from lib import metrics
 
 from lib.logger_utils import get_logger
-from config.settings import TOKEN_FILE_PATH, CREDENTIALS_FILE_PATH, SCOPES
+from config.settings import TOKEN_FILE_PATH, TOKEN_LOCK_FILE_PATH, CREDENTIALS_FILE_PATH, SCOPES, \
+    DISCOVERY_DOCUMENT_PATH, GMAIL_DISCOVERY_URL
 
 LOGGER = get_logger(__name__)
 
 
+class TimedJsonModel(JsonModel):
+    """
+    JSON model of the Gmail service that records the time taken to parse each response (including the responses
+    of a batch request)
+    """
+
+    def deserialize(self, content):
+        with metrics.timed('gmail_json_parse_seconds'):
+            return super().deserialize(content)
+
+
+_discovery_document = None
+_discovery_document_lock = threading.Lock()
+
+
+def _load_discovery_document():
+    """
+    :return: the Gmail discovery document bundled with google-api-python-client. Older versions do not bundle it,
+             and the document is then downloaded once and cached in DISCOVERY_DOCUMENT_PATH.
+    """
+    content = get_static_doc('gmail', 'v1') if get_static_doc else None
+    if content is not None:
+        return content
+    if os.path.exists(DISCOVERY_DOCUMENT_PATH):
+        with open(DISCOVERY_DOCUMENT_PATH, 'r') as file_obj:
+            return file_obj.read()
+    LOGGER.info(f"Downloading the discovery document from {GMAIL_DISCOVERY_URL}")
+    response, content = httplib2.Http().request(GMAIL_DISCOVERY_URL)
+    if response.status != 200:
+        raise HttpError(response, content, uri=GMAIL_DISCOVERY_URL)
+    content = content.decode('utf-8')
+    os.makedirs(os.path.dirname(DISCOVERY_DOCUMENT_PATH), exist_ok=True)
+    temporary_path = f'{DISCOVERY_DOCUMENT_PATH}.tmp'
+    with open(temporary_path, 'w') as file_obj:
+        file_obj.write(content)
+    os.replace(temporary_path, DISCOVERY_DOCUMENT_PATH)
+    return content
+
+
+def get_discovery_document():
+    """
+    :return: the parsed Gmail discovery document, loaded once per process and shared by all the service objects
+    """
+    global _discovery_document
+    with _discovery_document_lock:
+        if _discovery_document is None:
+            _discovery_document = json.loads(_load_discovery_document())
+        return _discovery_document
+
+
+def build_service(**kwargs):
+    """
+    :brief: Builds a Gmail service object from the discovery document (see get_discovery_document)
+    :param kwargs: arguments supported by googleapiclient.discovery.build_from_document (Eg. credentials, http)
+    """
+    return build_from_document(get_discovery_document(), model=TimedJsonModel(), **kwargs)
+
+
+@contextmanager
+def locked_file(path):
+    """
+    :brief: Context manager holding an exclusive lock on the file (created when missing) while its block runs.
+            Serializes the block across the processes of the host. No-op on Windows.
+    """
+    with open(path, 'a') as file_obj:
+        if fcntl:
+            fcntl.flock(file_obj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(file_obj, fcntl.LOCK_UN)
+
+
+class LazyService(object):
+    """
+    Proxy of a Gmail service object, built by the factory on first use. Runs that make no API call (Eg. no
+    matching message) skip the OAuth token setup and the build of the service.
+    """
+
+    def __init__(self, factory):
+        self.__factory = factory
+        self.__service = None
+        self.__lock = threading.Lock()
+
+    def get_service(self):
+        with self.__lock:
+            if self.__service is None:
+                self.__service = self.__factory()
+            return self.__service
+
+    def __getattr__(self, name):
+        return getattr(self.get_service(), name)
+
+
 class GoogleAPIHelper(object):
+    """
+    Gmail service objects authorized with the user's OAuth token (token.json). The credentials are loaded once per
+    process and shared by its service objects. Token refreshes are serialized across processes with a lock file,
+    so that a token refreshed by one process is reused by the others instead of being refreshed again.
+    """
+    __credentials = None
+    __credentials_lock = threading.Lock()
 
     def __init__(self):
         self.credentials = None
@@ -24,30 +143,53 @@ class GoogleAPIHelper(object):
         with open(TOKEN_FILE_PATH, "r") as file_obj:
             return json.load(file_obj)['token']
 
-    def __setup_token(self):
-        # The file token.json stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
+    @staticmethod
+    def _load_credentials():
         if os.path.exists(TOKEN_FILE_PATH):
-            self.credentials = Credentials.from_authorized_user_file(TOKEN_FILE_PATH, SCOPES)
-        # If there are no (valid) credentials available, let the user log in.
-        if not self.credentials or not self.credentials.valid:
-            if self.credentials and self.credentials.expired and self.credentials.refresh_token:
-                LOGGER.info('Creating / refreshing token')
-                self.credentials.refresh(Request())
-            else:
-                LOGGER.debug('Using existing token')
-                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE_PATH, SCOPES)
-                self.credentials = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open(TOKEN_FILE_PATH, 'w') as token:
-                token.write(self.credentials.to_json())
+            return Credentials.from_authorized_user_file(TOKEN_FILE_PATH, SCOPES)
+        return None
+
+    @staticmethod
+    def _save_credentials(credentials):
+        # Replaced atomically, as the other processes read the file without the lock
+        temporary_path = f'{TOKEN_FILE_PATH}.tmp'
+        with open(temporary_path, 'w') as token:
+            token.write(credentials.to_json())
+        os.replace(temporary_path, TOKEN_FILE_PATH)
+
+    def __setup_token(self):
+        cls = GoogleAPIHelper
+        with cls.__credentials_lock:
+            credentials = cls.__credentials
+            if credentials and credentials.valid:
+                self.credentials = credentials
+                return
+            # The file token.json stores the user's access and refresh tokens, and is
+            # created automatically when the authorization flow completes for the first
+            # time.
+            credentials = self._load_credentials()
+            if not credentials or not credentials.valid:
+                with locked_file(TOKEN_LOCK_FILE_PATH):
+                    # Another process may have refreshed the token while this one waited for the lock
+                    credentials = self._load_credentials()
+                    # If there are no (valid) credentials available, let the user log in.
+                    if not credentials or not credentials.valid:
+                        if credentials and credentials.expired and credentials.refresh_token:
+                            LOGGER.info('Creating / refreshing token')
+                            credentials.refresh(Request())
+                        else:
+                            LOGGER.debug('Using existing token')
+                            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE_PATH, SCOPES)
+                            credentials = flow.run_local_server(port=0)
+                        # Save the credentials for the next run
+                        self._save_credentials(credentials)
+            cls.__credentials = self.credentials = credentials
 
     def get_service_instance(self):
         try:
             self.__setup_token()
             # Call the Gmail API
-            service = build('gmail', 'v1', credentials=self.credentials)
+            service = build_service(credentials=self.credentials)
             return service
         except HttpError as error:
             # TODO(developer) - Handle errors from gmail API.
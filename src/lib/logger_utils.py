@@ -1,9 +1,43 @@
+import atexit
+import itertools
 import logging
 import os
+import queue
+import sys
+import threading
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.util import Finalize, register_after_fork
+
+from config.settings import LOG_LEVEL, LOG_LEVELS, LOG_DEBUG_SAMPLE_RATE
 
 LOG_PATH = os.path.dirname(os.path.realpath(__file__)) + '/../../logs/combined_log'
 
+
+class DebugSamplingFilter(logging.Filter):
+    """
+    Lets through one in every sample_rate debug records of each line of code (the first one included), so that
+    per message debug lines do not flood the log. Records of the other levels are not sampled.
+    """
+
+    def __init__(self, sample_rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.sample_rate = max(1, sample_rate)
+        self.__counters = {}
+        self.__lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.sample_rate == 1:
+            return True
+        key = (record.pathname, record.lineno)
+        counter = self.__counters.get(key)
+        if counter is None:
+            with self.__lock:
+                counter = self.__counters.setdefault(key, itertools.count())
+        # itertools.count is incremented atomically
+        return next(counter) % self.sample_rate == 0
+
+
 LOG_SETTINGS = {'version': 1,
                 'disable_existing_loggers': False,
 
@@ -13,25 +47,50 @@ LOG_SETTINGS = {'version': 1,
                     },
                 },
 
-                'handlers': {
-                    'default': {
-                        'level': 'DEBUG',
-                        'class': 'logging.FileHandler',
-                        'formatter': 'standard',
-                        'filename': LOG_PATH
-
-                    }
-                },
-                'loggers': {
-
-                },
+                'loggers': {name: {'level': level} for name, level in LOG_LEVELS.items()},
                 'root': {
-                    'level': 'DEBUG',
-                    'handlers': ['default']
+                    'level': LOG_LEVEL,
                 }
                 }
 dictConfig(LOG_SETTINGS)
 
+# The records are queued by the logging threads and written to LOG_PATH by a background thread (see _start_listener).
+# The queue handler is set up here rather than in LOG_SETTINGS: dictConfig rejects a SimpleQueue from Python 3.12 on.
+_queue_handler = QueueHandler(queue.SimpleQueue())
+_queue_handler.setLevel(logging.DEBUG)
+_queue_handler.addFilter(DebugSamplingFilter())
+logging.getLogger().addHandler(_queue_handler)
+
+
+def _start_listener():
+    """
+    :brief: Starts the background thread writing the queued records to the file handler.
+            The queue is flushed when the process exits.
+    """
+    global _listener
+    file_handler = logging.FileHandler(LOG_PATH)
+    file_handler.setFormatter(logging.Formatter(LOG_SETTINGS['formatters']['standard']['format']))
+    _listener = QueueListener(_queue_handler.queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def _restart_listener_in_child():
+    # The listener thread does not survive a fork. A child process gets its own queue and listener.
+    _queue_handler.queue = queue.SimpleQueue()
+    _start_listener()
+
+
+def _stop_listener_at_process_exit(module):
+    # multiprocessing children exit without running the atexit handlers
+    Finalize(None, _listener.stop, exitpriority=0)
+
+
+_listener = None
+_start_listener()
+os.register_at_fork(after_in_child=_restart_listener_in_child)
+register_after_fork(sys.modules[__name__], _stop_listener_at_process_exit)
+
 
 def get_logger(logger_val):
     return logging.getLogger(logger_val)
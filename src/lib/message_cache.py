@@ -0,0 +1,125 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from config.settings import MESSAGE_CACHE_DIR, MESSAGE_CACHE_SEGMENT_SIZE
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+INDEX_FILE_NAME = 'index.dat'
+SEGMENT_FILE_NAME = 'segment_{:05d}.dat'
+# message id, history id, segment number, offset in the segment, length of the compressed message
+INDEX_RECORD = struct.Struct('<QQIQI')
+
+
+class MessageCache(object):
+    """
+    Append-only on-disk store of GET message responses (format 'full'), keyed by message id and history id.
+    Files under cache_dir:
+        segment_NNNNN.dat: zlib compressed JSON messages, appended one after the other. A new segment is started
+                           once the current one reaches segment_size bytes.
+        index.dat: one fixed size record (see INDEX_RECORD) per appended message. The index is memory mapped and
+                   loaded on open; a later record of a message id supersedes the earlier ones.
+    A message is always written to its segment before its index record, so the index never points to partial data.
+    """
+
+    def __init__(self, cache_dir=MESSAGE_CACHE_DIR, segment_size=MESSAGE_CACHE_SEGMENT_SIZE):
+        self.cache_dir = cache_dir
+        self.segment_size = segment_size
+        self.__entries = {}  # message id -> (history id, segment, offset, length)
+        self.__read_files = {}
+        self.__lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+        self.__segment = max([entry[1] for entry in self.__entries.values()], default=0)
+        self.__segment_file = open(self._get_segment_path(self.__segment), 'ab')
+        self.__index_file = open(os.path.join(cache_dir, INDEX_FILE_NAME), 'ab')
+
+    def _get_segment_path(self, segment):
+        return os.path.join(self.cache_dir, SEGMENT_FILE_NAME.format(segment))
+
+    def _load_index(self):
+        index_path = os.path.join(self.cache_dir, INDEX_FILE_NAME)
+        if not os.path.exists(index_path) or not os.path.getsize(index_path):
+            return
+        with open(index_path, 'rb') as index_file, \
+                mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index_map:
+            record_count = len(index_map) // INDEX_RECORD.size
+            for message_id, history_id, segment, offset, length in INDEX_RECORD.iter_unpack(
+                    index_map[:record_count * INDEX_RECORD.size]):
+                self.__entries[message_id] = (history_id, segment, offset, length)
+        # A partially written record at the end (after a crash) is cut off, so that the records appended next are
+        # aligned
+        if os.path.getsize(index_path) != record_count * INDEX_RECORD.size:
+            LOGGER.warning(f"Truncating the partially written record at the end of {index_path}")
+            os.truncate(index_path, record_count * INDEX_RECORD.size)
+        LOGGER.info(f"Loaded {len(self.__entries)} cached messages from {self.cache_dir}")
+
+    def __contains__(self, message_id):
+        return int(message_id, 16) in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get_history_id(self, message_id):
+        entry = self.__entries.get(int(message_id, 16))
+        return entry[0] if entry else None
+
+    def _read(self, segment, offset, length):
+        read_file = self.__read_files.get(segment)
+        if read_file is None:
+            with self.__lock:
+                read_file = self.__read_files.get(segment)
+                if read_file is None:
+                    read_file = open(self._get_segment_path(segment), 'rb')
+                    self.__read_files[segment] = read_file
+        # pread does not move the file position, hence a file can be read from many threads
+        return json.loads(zlib.decompress(os.pread(read_file.fileno(), length, offset)))
+
+    def get(self, message_id):
+        """
+        :return: the cached GET message response of the (hex) message id, None when it is not cached
+        """
+        entry = self.__entries.get(int(message_id, 16))
+        if entry is None:
+            return None
+        _, segment, offset, length = entry
+        return self._read(segment, offset, length)
+
+    def put(self, message):
+        """
+        :brief: Appends the GET message response (format 'full') to the cache
+        """
+        data = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+        message_id, history_id = int(message['id'], 16), int(message['historyId'])
+        with self.__lock:
+            offset = self.__segment_file.tell()
+            if offset and offset + len(data) > self.segment_size:
+                self.__segment_file.close()
+                self.__segment += 1
+                self.__segment_file = open(self._get_segment_path(self.__segment), 'ab')
+                offset = 0
+            self.__segment_file.write(data)
+            self.__segment_file.flush()
+            self.__index_file.write(INDEX_RECORD.pack(message_id, history_id, self.__segment, offset, len(data)))
+            self.__index_file.flush()
+            self.__entries[message_id] = (history_id, self.__segment, offset, len(data))
+
+    def iter_messages(self):
+        """
+        :brief: Generator over the latest cached response of every message, in segment order
+        """
+        for _, segment, offset, length in sorted(self.__entries.values(), key=lambda entry: entry[1:3]):
+            yield self._read(segment, offset, length)
+
+    def close(self):
+        with self.__lock:
+            self.__segment_file.close()
+            self.__index_file.close()
+            for read_file in self.__read_files.values():
+                read_file.close()
+            self.__read_files = {}
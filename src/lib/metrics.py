@@ -0,0 +1,265 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config.settings import METRICS_HISTOGRAM_BUCKETS, METRICS_DUMP_INTERVAL
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class Histogram(object):
+    """
+    Distribution of observed values (seconds) in cumulative buckets, as in Prometheus histograms
+    """
+
+    def __init__(self, buckets=METRICS_HISTOGRAM_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[index] += 1
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6),
+                'buckets': dict(zip(map(str, self.buckets), self.bucket_counts))}
+
+
+class MetricsRegistry(object):
+    """
+    Thread safe registry of counters and histograms, identified by a name and a set of labels
+    (Eg. gmail_request_seconds{method="messages.list"})
+    """
+
+    def __init__(self):
+        self.__counters = {}
+        self.__histograms = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self._get_key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._get_key(name, labels)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """
+        :brief: Context manager that observes the seconds taken by its block in the histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.__lock:
+            self.__counters = {}
+            self.__histograms = {}
+
+    def snapshot(self):
+        """
+        :return: dict of the counters and the histograms, JSON serializable
+        """
+        with self.__lock:
+            return {'timestamp': time.time(),
+                    'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in sorted(self.__counters.items())],
+                    'histograms': [dict(histogram.to_dict(), name=name, labels=dict(labels))
+                                   for (name, labels), histogram in sorted(self.__histograms.items())]}
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+
+        def format_labels(labels, **extra_labels):
+            labels = list(labels) + list(extra_labels.items())
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+        lines = []
+        with self.__lock:
+            for name in sorted({name for name, _ in self.__counters}):
+                lines.append(f'# TYPE {name} counter')
+                lines.extend(f'{name}{format_labels(labels)} {value}'
+                             for (counter_name, labels), value in sorted(self.__counters.items())
+                             if counter_name == name)
+            for name in sorted({name for name, _ in self.__histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (histogram_name, labels), histogram in sorted(self.__histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for upper_bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                        lines.append(f'{name}_bucket{format_labels(labels, le=upper_bound)} {bucket_count}')
+                    lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {histogram.count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+_REGISTRY = MetricsRegistry()
+
+
+def get_registry():
+    return _REGISTRY
+
+
+def increment(name, value=1, **labels):
+    _REGISTRY.increment(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _REGISTRY.observe(name, value, **labels)
+
+
+def timed(name, **labels):
+    return _REGISTRY.timed(name, **labels)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        content = _REGISTRY.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+
+def start_http_server(port):
+    """
+    :brief: Serves the metrics at http://<host>:<port>/metrics (Prometheus text format) from a background thread
+    :return: the server. Call shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer(('', port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    LOGGER.info(f"Serving metrics on port {port}")
+    return server
+
+
+class MetricsDumper(object):
+    """
+    Writes a JSON snapshot of the metrics to a file every `interval` seconds, and once more on stop()
+    """
+
+    def __init__(self, path, interval=METRICS_DUMP_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self._run, name='metrics-dumper', daemon=True)
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def _run(self):
+        while not self.__stopped.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        # Written to a temporary file first, so that readers never see a partial snapshot
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as file_obj:
+            json.dump(_REGISTRY.snapshot(), file_obj, indent=2)
+        os.replace(temporary_path, self.path)
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+        self.dump()
+
+
+@contextmanager
+def exported_metrics(port=None, dump_path=None):
+    """
+    :brief: Context manager that exports the metrics while its block runs: over HTTP when a port is given and / or
+            to a JSON file when a dump path is given
+    """
+    server = start_http_server(port) if port else None
+    dumper = MetricsDumper(dump_path).start() if dump_path else None
+    try:
+        yield
+    finally:
+        if dumper:
+            dumper.stop()
+        if server:
+            server.shutdown()
+
+
+@contextmanager
+def profiled(path=None):
+    """
+    :brief: Context manager that profiles its block with cProfile, along with the threads started while it runs
+            (Eg. the download pipeline stages), and saves the merged stats to the path (see pstats).
+            No-op when the path is not set.
+    """
+    if not path:
+        yield
+        return
+    profiles = [cProfile.Profile()]
+    lock = threading.Lock()
+    # From Python 3.12 on, a profiler covers all the threads and no other one can be enabled while it runs
+    profile_threads = sys.version_info < (3, 12)
+
+    def enable_thread_profile(*args):
+        # Runs on the first profiler event of every new thread
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as ex:
+            # The thread runs unprofiled rather than dying at startup
+            LOGGER.warning(f"Could not profile thread {threading.current_thread().name}. Details: {ex}")
+            return
+        with lock:
+            profiles.append(profile)
+
+    if profile_threads:
+        threading.setprofile(enable_thread_profile)
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        if profile_threads:
+            threading.setprofile(None)
+        with lock:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+        stats.dump_stats(path)
+        LOGGER.info(f"Saved the profile of {len(profiles)} threads to {path}")
@@ -0,0 +1,79 @@
+import base64
+import binascii
+import codecs
+import re
+
+from config.settings import MESSAGE_PART_MAX_CONTENT_SIZE
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([\w.:-]+)"?', re.IGNORECASE)
+DEFAULT_CHARSET = 'utf-8'
+
+
+def iter_message_parts(payload):
+    """
+    :brief: Generator over the MIME parts of a message payload (format 'full'), parents before their children
+    :param payload: payload of the GET message response
+    :return: tuples of (part, parent part id). The parent part id of the payload itself is None.
+    """
+    stack = [(payload, None)]
+    while stack:
+        part, parent_id = stack.pop()
+        yield part, parent_id
+        # Reversed, so that the sibling parts are yielded in their order
+        stack.extend((child, part.get('partId', '')) for child in reversed(part.get('parts') or []))
+
+
+def get_charset(part):
+    for header in part.get('headers') or []:
+        if header['name'].lower() == 'content-type':
+            match = CHARSET_PATTERN.search(header['value'])
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    break
+    return DEFAULT_CHARSET
+
+
+def decode_body(data, max_size=MESSAGE_PART_MAX_CONTENT_SIZE):
+    """
+    :brief: Decodes the base64url encoded body of a part, up to max_size bytes.
+            Only the prefix of the encoded data needed for max_size bytes is decoded, so the memory used does not
+            depend on the size of the body.
+    :param data: base64url encoded body (body.data of a part)
+    :param max_size: maximum number of bytes to be decoded
+    :return: (decoded bytes, True when the body was truncated)
+    """
+    encoded_size = -(-max_size // 3) * 4
+    encoded_data = data[:encoded_size]
+    encoded_data += '=' * (-len(encoded_data) % 4)
+    try:
+        decoded_data = base64.urlsafe_b64decode(encoded_data)
+    except (binascii.Error, ValueError):
+        return b'', False
+    return decoded_data[:max_size], len(data) > encoded_size or len(decoded_data) > max_size
+
+
+def get_part_rows(message, max_size=MESSAGE_PART_MAX_CONTENT_SIZE):
+    """
+    :brief: Returns the message_part rows of a message (format 'full').
+            The content of text parts is decoded up to max_size bytes. Other parts (attachments, images, etc.) and
+            the multipart containers are saved without content.
+    :return: list of (part id, parent part id, content, mime type, filename)
+    """
+    rows = []
+    for part, parent_id in iter_message_parts(message['payload']):
+        mime_type = part.get('mimeType') or ''
+        content = ''
+        data = (part.get('body') or {}).get('data')
+        if data and mime_type.startswith('text/'):
+            content_bytes, truncated = decode_body(data, max_size)
+            content = content_bytes.decode(get_charset(part), errors='replace')
+            if truncated:
+                LOGGER.debug(f"Truncated part {part.get('partId')} of message {message['id']} to {max_size} bytes")
+        rows.append((part.get('partId', ''), parent_id, content, mime_type[:50] or None,
+                     (part.get('filename') or '')[:100] or None))
+    return rows
@@ -0,0 +1,162 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from googleapiclient.errors import HttpError
+
+from config.settings import GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_MIN_BATCH_SIZE, BATCH_FETCH_EMAIL_SIZE, \
+    GMAIL_MAX_RETRIES, GMAIL_BACKOFF_BASE_SECONDS, GMAIL_BACKOFF_MAX_SECONDS, DOWNLOAD_FETCH_WORKERS
+from lib import metrics
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+# Quota units charged by Gmail per method. Refer: https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {'messages.get': 5,
+               'messages.list': 5,
+               'messages.batchModify': 50,
+               'history.list': 2,
+               'labels.list': 1,
+               'getProfile': 1
+               }
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+CLEAN_BATCHES_BEFORE_INCREASE = 5  # Number of batches without errors after which the batch size and concurrency grow
+
+
+def is_retryable(exception):
+    """
+    :return: True when the failed request is worth retrying (rate limited or a transient server error)
+    """
+    if not isinstance(exception, HttpError):
+        # Connection errors, timeouts, etc.
+        return isinstance(exception, (OSError, TimeoutError))
+    if exception.resp.status in RETRYABLE_STATUSES:
+        return True
+    return exception.resp.status == 403 and any(reason in str(exception) for reason in RATE_LIMIT_REASONS)
+
+
+class QuotaLimiter(object):
+    """
+    Token bucket of Gmail quota units, refilled at units_per_second. Allows bursts of up to a second of quota.
+    """
+
+    def __init__(self, units_per_second=GMAIL_QUOTA_UNITS_PER_SECOND):
+        self.__units_per_second = units_per_second
+        self.__available_units = units_per_second or 0
+        self.__last_refill = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self, units):
+        """
+        :brief: Waits till the given quota units are available and consumes them. No-op when the quota is not set.
+        """
+        if not self.__units_per_second:
+            return
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__available_units = min(self.__units_per_second, self.__available_units +
+                                             (now - self.__last_refill) * self.__units_per_second)
+                self.__last_refill = now
+                # A request larger than the bucket is let through once the bucket is full
+                if self.__available_units >= min(units, self.__units_per_second):
+                    self.__available_units -= units
+                    return
+                wait_time = (min(units, self.__units_per_second) - self.__available_units) / self.__units_per_second
+            time.sleep(wait_time)
+
+
+class GmailRequestScheduler(object):
+    """
+    Schedules the Gmail API requests of a process:
+        1. Every request waits for its quota units (see QuotaLimiter)
+        2. Batches are sized adaptively between GMAIL_MIN_BATCH_SIZE and max_batch_size
+        3. The number of batches in flight is limited adaptively between 1 and max_concurrency
+        4. Rate limited (429) and failed (5xx) requests are retried with jittered exponential backoff
+    The batch size and the concurrency are halved when a batch has retryable failures, and grow by one step after
+    CLEAN_BATCHES_BEFORE_INCREASE batches without any.
+    """
+
+    def __init__(self, max_concurrency=DOWNLOAD_FETCH_WORKERS, max_batch_size=BATCH_FETCH_EMAIL_SIZE,
+                 units_per_second=GMAIL_QUOTA_UNITS_PER_SECOND):
+        self.quota = QuotaLimiter(units_per_second)
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max(1, max_concurrency)
+        self.batch_size = max_batch_size
+        self.concurrency = self.max_concurrency
+        self.__in_flight = 0
+        self.__clean_batches = 0
+        self.__condition = threading.Condition()
+
+    @contextmanager
+    def batch_slot(self):
+        """
+        :brief: Context manager that waits till fewer than `concurrency` batches are in flight
+        """
+        with self.__condition:
+            while self.__in_flight >= self.concurrency:
+                self.__condition.wait()
+            self.__in_flight += 1
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__in_flight -= 1
+                self.__condition.notify_all()
+
+    def record_batch(self, request_count, retryable_count):
+        """
+        :brief: Adjusts the batch size and the concurrency from the outcome of a batch
+        :param request_count: number of requests in the batch
+        :param retryable_count: number of requests that failed with a retryable error
+        """
+        with self.__condition:
+            if retryable_count:
+                self.__clean_batches = 0
+                self.batch_size = max(GMAIL_MIN_BATCH_SIZE, self.batch_size // 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                LOGGER.warning(f"{retryable_count} of {request_count} requests failed. Reduced the batch size to "
+                               f"{self.batch_size} and the concurrency to {self.concurrency}")
+                return
+            self.__clean_batches += 1
+            if self.__clean_batches >= CLEAN_BATCHES_BEFORE_INCREASE:
+                self.__clean_batches = 0
+                self.batch_size = min(self.max_batch_size, self.batch_size + GMAIL_MIN_BATCH_SIZE)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self.__condition.notify_all()
+
+    @staticmethod
+    def backoff(attempt):
+        """
+        :brief: Sleeps before a retry. The delay is drawn at random below an exponentially growing cap (full jitter).
+        :param attempt: retry number, starting at 1
+        """
+        delay = random.uniform(0, min(GMAIL_BACKOFF_MAX_SECONDS, GMAIL_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1)))
+        LOGGER.info(f"Retry #{attempt} in {delay:.2f} seconds")
+        time.sleep(delay)
+
+    def execute(self, request, method):
+        """
+        :brief: Executes a single request, retrying it on retryable errors up to GMAIL_MAX_RETRIES times
+        :param request: googleapiclient HttpRequest
+        :param method: Gmail method name, as in QUOTA_UNITS
+        :return: the response of the request
+        :raises: HttpError when the request fails with a non retryable error or when the retries are exhausted
+        """
+        attempt = 0
+        while True:
+            with metrics.timed('gmail_quota_wait_seconds'):
+                self.quota.acquire(QUOTA_UNITS[method])
+            try:
+                with metrics.timed('gmail_request_seconds', method=method):
+                    return request.execute()
+            except Exception as ex:
+                attempt += 1
+                if not is_retryable(ex) or attempt > GMAIL_MAX_RETRIES:
+                    metrics.increment('gmail_errors_total', method=method)
+                    raise
+                metrics.increment('gmail_retries_total', method=method)
+                LOGGER.warning(f"Request {method} failed. Details: {ex}")
+                self.backoff(attempt)
@@ -1,16 +1,39 @@
-from config.settings import DEFAULT_HEADER_DICT, QUERYABLE_HEADERS, MESSAGE_FORMAT_MINIMAL
+from config.settings import DEFAULT_HEADER_DICT, QUERYABLE_HEADERS, WRITE_BUFFER_FLUSH_SIZE, \
+    WRITE_BUFFER_FLUSH_INTERVAL, BULK_UPDATE_BATCH_SIZE, MESSAGE_PART_MAX_BATCH_BYTES
 import json
+import time
 from datetime import datetime
+from lib import metrics
 from lib.logger_utils import get_logger
 from lib.db_utils import DBUtils
+from lib.mime_utils import get_part_rows
+from models.thread_summary import ThreadSummaryDAO
 import mysql.connector
 
 LOGGER = get_logger(__name__)
 
+# Partitioning date of the labels of the messages whose date is not known (Eg. a label change of a message without
+# attributes). Falls in the oldest partition.
+UNKNOWN_INTERNAL_TIMESTAMP = datetime(1970, 1, 2)
+
 
 class EmailDAO(object):
-    def __init__(self, connection):
+    def __init__(self, connection, flush_size=WRITE_BUFFER_FLUSH_SIZE, flush_interval=WRITE_BUFFER_FLUSH_INTERVAL):
+        """
+        :param connection: database connection
+        :param flush_size: number of buffered messages that triggers a flush
+        :param flush_interval: seconds since the last flush after which the next buffered message triggers a flush
+        """
         self.connection = connection
+        self.__flush_size = flush_size
+        self.__flush_interval = flush_interval
+        self.__label_rows = {}
+        self.__attribute_rows = {}
+        self.__partial_header_ids = set()  # Buffered messages fetched in metadata format (with some headers only)
+        self.__part_rows = {}
+        self.__part_bytes = 0
+        self.__last_flush = time.monotonic()
+        self.__changed_thread_ids = set()  # Threads whose summaries are refreshed by refresh_thread_summaries
 
     def remove_all_labels(self):
         cursor = self.connection.cursor()
@@ -22,6 +45,8 @@ class EmailDAO(object):
                        f"'{label['name']}', '{label['type']}', now())")
 
     def bulk_insert_message_ids(self, messages):
+        if not messages:
+            return
         cursor = self.connection.cursor()
         values_clause = ""
         for message in messages:
@@ -29,76 +54,410 @@ class EmailDAO(object):
         values_clause = values_clause.rstrip(',')
         query = f"insert into email (`id`, `thread_id`, `refreshed_on`) " \
                 f"values {values_clause} on duplicate key update refreshed_on=now()"
-        cursor.execute(query)
-        self.connection.commit()
+        with metrics.timed('db_statement_seconds', statement='upsert_message_ids'):
+            cursor.execute(query)
+        with metrics.timed('db_commit_seconds'):
+            self.connection.commit()
         LOGGER.info("Saved message ids")
 
-    def upsert_labels(self, body):
-        try:
-            cursor = self.connection.cursor()
-            # Need to remove existing labels in the database to sync with the server
-            if 'labelIds' not in body:
-                cursor.execute(f"delete from message_label where `message_id` = {int(body['id'], 16)}")
-            labels_json = json.dumps(body['labelIds'])
-            labels_query = f"insert into message_label(`message_id`, `labels`, `refreshed_on`) " \
-                           f"values ({int(body['id'], 16)}, '{labels_json}', now()) " \
-                           f"on duplicate key update `labels`='{labels_json}', refreshed_on=now()"
-            cursor.execute(labels_query)
-        except mysql.connector.errors.Error as ex:
-            LOGGER.exception(f"Exception while syncing labels. Details: {ex}", exc_info=True)
-        self.connection.commit()
-        LOGGER.info("Synchronized message labels")
+    @staticmethod
+    def _get_internal_timestamp(message):
+        """
+        :return: the internal date of the message (GET message response), None when the response does not hold it
+        """
+        if 'internalDate' not in message:
+            return None
+        return datetime.fromtimestamp(int(message['internalDate']) // 1000)
 
-    def upsert_attributes_and_label(self, message):
-        self.upsert_labels(message)
-        cursor = self.connection.cursor()
+    @staticmethod
+    def _get_attribute_row(message):
         attributes = dict(DEFAULT_HEADER_DICT)
         for header in message['payload']['headers']:
             if header['name'] in QUERYABLE_HEADERS:
                 attributes[header['name'].lower()] = header['value']
         attributes.update({'size_estimate': message['sizeEstimate'], 'history_id': message['historyId'],
-                           'internal_date': datetime.fromtimestamp(int(message['internalDate']) // 1000),
+                           'internal_date': EmailDAO._get_internal_timestamp(message),
                            'payload_headers': json.dumps(message['payload']['headers'])})
-        arguments = (int(message['id'], 16), attributes['history_id'], attributes['internal_date'],
-                     attributes['from'], attributes['to'], attributes['subject'],
-                     attributes['cc'], attributes['bcc'], attributes['size_estimate'],
-                     attributes['payload_headers'], attributes['history_id'])
-        query = f"insert into email_attributes(`message_id`, `history_id`, `internal_timestamp`, `from`, `to`, " \
-                f"`subject`, `cc`, `bcc`, `size_estimate`, `payload_headers`, `refreshed_on`) values " \
-                f"(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, now()) " \
-                f"on duplicate key update history_id = %s, refreshed_on=now()"
-        cursor.execute(query, arguments)
-        self.connection.commit()
-        LOGGER.info("Saved message data")
+        return (int(message['id'], 16), attributes['history_id'], attributes['internal_date'],
+                attributes['from'], attributes['to'], attributes['subject'],
+                attributes['cc'], attributes['bcc'], attributes['size_estimate'],
+                attributes['payload_headers'])
+
+    def buffer_labels(self, body):
+        """
+        :brief: Queues the labels of the message (GET message response) to be synced with the next flush
+        """
+        # The stored labels are replaced with the ones on the server. A message without labels has none left.
+        self.__label_rows[int(body['id'], 16)] = (body.get('labelIds') or [], self._get_internal_timestamp(body))
+        self._flush_if_due()
+
+    def buffer_attributes_and_label(self, message, partial_headers=False):
+        """
+        :brief: Queues the attributes and the labels of the message (GET message response) to be saved with
+                the next flush
+        :param partial_headers: True when the response holds some of the headers only (metadata format): the stored
+                                headers of the message are then kept
+        """
+        with metrics.timed('message_parse_seconds', step='attributes'):
+            row = self._get_attribute_row(message)
+        self.__attribute_rows[row[0]] = row
+        if partial_headers:
+            self.__partial_header_ids.add(row[0])
+        else:
+            self.__partial_header_ids.discard(row[0])
+        self.buffer_labels(message)
+
+    def buffer_parts(self, message):
+        """
+        :brief: Queues the MIME parts of the message (GET message response in 'full' format) to be saved with the
+                next flush. The stored parts of the message are replaced.
+        """
+        with metrics.timed('message_parse_seconds', step='parts'):
+            rows = get_part_rows(message)
+        self.__part_rows[int(message['id'], 16)] = rows
+        self.__part_bytes += sum(len(row[2]) for row in rows)
+        self._flush_if_due()
 
-    def fetch_message_ids(self, query_condition):
+    def _insert_part_rows(self, cursor):
         """
-        TODO: Google's batch modify API's limit is only 1000 message ids. Need to paginate with page_size = 1000.
-        :param query_condition:
-        :return:
+        :brief: Inserts the buffered parts with multi-row inserts of up to MESSAGE_PART_MAX_BATCH_BYTES of content
         """
+        columns = "insert into message_part(`message_id`, `part_id`, `parent_id`, `content`, `mime_type`, " \
+                  "`filename`, `refreshed_on`) values "
+        rows, batch_bytes = [], 0
+        for message_id, part_rows in self.__part_rows.items():
+            for row in part_rows:
+                rows.append((message_id,) + row)
+                batch_bytes += len(row[2])
+                if batch_bytes >= MESSAGE_PART_MAX_BATCH_BYTES:
+                    with metrics.timed('db_statement_seconds', statement='insert_parts'):
+                        cursor.execute(columns + ", ".join(["(%s, %s, %s, %s, %s, %s, now())"] * len(rows)),
+                                       [value for part_row in rows for value in part_row])
+                    rows, batch_bytes = [], 0
+        if rows:
+            with metrics.timed('db_statement_seconds', statement='insert_parts'):
+                cursor.execute(columns + ", ".join(["(%s, %s, %s, %s, %s, %s, now())"] * len(rows)),
+                               [value for part_row in rows for value in part_row])
+
+    @staticmethod
+    def _get_internal_timestamps(cursor, message_ids):
+        """
+        :brief: Reads the stored internal timestamps of the messages (the partitioning column of message_label),
+                from their attributes or else from their labels
+        :param message_ids: list of message ids (integers)
+        :return: dict of message id -> internal timestamp. Messages without attributes nor labels are left out.
+        """
+        timestamps = {}
+        if not message_ids:
+            return timestamps
+        DBUtils.process_statement(cursor, "select message_id, internal_timestamp from email_attributes "
+                                          "where message_id in (%s)", (message_ids,))
+        timestamps.update(cursor.fetchall())
+        missing_ids = [message_id for message_id in message_ids if message_id not in timestamps]
+        if missing_ids:
+            DBUtils.process_statement(cursor, "select message_id, min(internal_timestamp) from message_label "
+                                              "where message_id in (%s) group by message_id", (missing_ids,))
+            timestamps.update(cursor.fetchall())
+        return timestamps
+
+    def _upsert_headers(self, cursor):
+        """
+        :brief: Saves the headers (the last value of the buffered attribute rows) in the email_headers table.
+                The complete headers replace the stored ones, while the partial ones (metadata format) are only
+                saved for the messages without stored headers, so that a metadata run does not truncate the headers
+                saved by a full run.
+        """
+        for overwrite in (True, False):
+            rows = [row for message_id, row in self.__attribute_rows.items()
+                    if (message_id in self.__partial_header_ids) != overwrite]
+            if not rows:
+                continue
+            query = "insert into email_headers(`message_id`, `payload_headers`) values " + \
+                    ", ".join(["(%s, %s)"] * len(rows)) + " on duplicate key update " + \
+                    ("payload_headers = values(payload_headers)" if overwrite else "message_id = message_id")
+            with metrics.timed('db_statement_seconds', statement='upsert_headers'):
+                cursor.execute(query, [value for row in rows for value in (row[0], row[-1])])
+
+    def _flush_if_due(self):
+        if len(self.__label_rows) >= self.__flush_size or self.__part_bytes >= MESSAGE_PART_MAX_BATCH_BYTES or \
+                time.monotonic() - self.__last_flush >= self.__flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        :brief: Saves the buffered labels and attributes with multi-row upserts, in a single transaction.
+                The summaries of their threads are refreshed once it is committed.
+        :raises: mysql.connector.errors.Error when the upserts fail. The transaction is rolled back.
+        """
+        self.__last_flush = time.monotonic()
+        if not self.__label_rows and not self.__attribute_rows and not self.__part_rows:
+            return
         cursor = self.connection.cursor()
-        query = f"select message_id from email_attributes left join message_label using(message_id) " \
-                f"where {query_condition}"
-        cursor.execute(query)
-        results = cursor.fetchall()
-        results = [hex(value[0]).strip('0x') for value in results]
-        return results
+        try:
+            # Label changes read from the history do not hold the date of their messages: it is read from the database
+            timestamps = self._get_internal_timestamps(cursor, [message_id for message_id, (_, timestamp)
+                                                                in self.__label_rows.items() if timestamp is None])
+            label_rows = [(message_id, label_id,
+                           timestamp or timestamps.get(message_id, UNKNOWN_INTERNAL_TIMESTAMP))
+                          for message_id, (label_ids, timestamp) in self.__label_rows.items()
+                          for label_id in label_ids]
+            if self.__label_rows:
+                with metrics.timed('db_statement_seconds', statement='delete_labels'):
+                    DBUtils.process_statement(cursor, "delete from message_label where `message_id` in (%s)",
+                                              (list(self.__label_rows),))
+                self._touch_messages(cursor, list(self.__label_rows))
+            if label_rows:
+                query = "insert into message_label(`message_id`, `label_id`, `internal_timestamp`, `refreshed_on`) " \
+                        "values " + ", ".join(["(%s, %s, %s, now())"] * len(label_rows))
+                with metrics.timed('db_statement_seconds', statement='insert_labels'):
+                    cursor.execute(query, [value for row in label_rows for value in row])
+            if self.__attribute_rows:
+                # The headers (the last value of the rows) are kept apart, in the cold email_headers table
+                query = "insert into email_attributes(`message_id`, `history_id`, `internal_timestamp`, `from`, " \
+                        "`to`, `subject`, `cc`, `bcc`, `size_estimate`, `refreshed_on`) values " + \
+                        ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, now())"] * len(self.__attribute_rows)) + \
+                        " on duplicate key update history_id = values(history_id), refreshed_on = now()"
+                with metrics.timed('db_statement_seconds', statement='upsert_attributes'):
+                    cursor.execute(query, [value for row in self.__attribute_rows.values() for value in row[:-1]])
+                # The text of a message never changes: only new messages are added to the search table
+                query = "insert into email_search(`message_id`, `from`, `to`, `subject`, `cc`, `bcc`) values " + \
+                        ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(self.__attribute_rows)) + \
+                        " on duplicate key update message_id = message_id"
+                with metrics.timed('db_statement_seconds', statement='upsert_search'):
+                    cursor.execute(query, [value for row in self.__attribute_rows.values()
+                                           for value in (row[0],) + row[3:8]])
+                self._upsert_headers(cursor)
+            if self.__part_rows:
+                with metrics.timed('db_statement_seconds', statement='delete_parts'):
+                    DBUtils.process_statement(cursor, "delete from message_part where `message_id` in (%s)",
+                                              (list(self.__part_rows),))
+                self._insert_part_rows(cursor)
+            changed_thread_ids = ThreadSummaryDAO(self.connection).get_thread_ids(
+                list(self.__label_rows.keys() | self.__attribute_rows.keys()))
+            with metrics.timed('db_commit_seconds'):
+                self.connection.commit()
+        except mysql.connector.errors.Error as ex:
+            self.connection.rollback()
+            LOGGER.exception(f"Exception while saving buffered messages. Details: {ex}")
+            raise
+        self.__changed_thread_ids.update(changed_thread_ids)
+        metrics.increment('db_messages_saved_total', len(self.__label_rows))
+        LOGGER.info(f"Saved {len(self.__label_rows)} message labels, {len(self.__attribute_rows)} message data and "
+                    f"{len(self.__part_rows)} message parts")
+        self.__label_rows = {}
+        self.__attribute_rows = {}
+        self.__partial_header_ids = set()
+        self.__part_rows = {}
+        self.__part_bytes = 0
+        self.refresh_thread_summaries()
+
+    @staticmethod
+    def _get_rule_match_query(query_conditions, message_filter="message_id > %s"):
+        """
+        :return: (query, parameters) - the query reading a page of the matches of the conditions among the messages
+                 of message_filter, and the parameters of the conditions. The query takes the parameters, the
+                 arguments of message_filter (by default, the last message id of the previous page), the parameters
+                 again and the page size.
+        """
+        flag_columns = ", ".join(f"({condition}) is true" for condition, _ in query_conditions)
+        any_condition = " or ".join(f"({condition})" for condition, _ in query_conditions)
+        parameters = [value for _, condition_parameters in query_conditions for value in condition_parameters]
+        query = f"select message_id, {flag_columns} from email_attributes where {message_filter} " \
+                f"and ({any_condition}) order by message_id limit %s"
+        return query, parameters
+
+    def explain_rule_matches(self, query_conditions, batch_size=BULK_UPDATE_BATCH_SIZE):
+        """
+        :brief: Runs EXPLAIN on the query reading the first page of the matches (see fetch_rule_matches)
+        :return: (query, arguments, list of the EXPLAIN rows as dicts)
+        """
+        query, parameters = self._get_rule_match_query(query_conditions)
+        arguments = parameters + [0] + parameters + [int(batch_size)]
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute(f"explain {query}", arguments)
+        return query, arguments, cursor.fetchall()
+
+    def fetch_rule_matches(self, query_conditions, batch_size=BULK_UPDATE_BATCH_SIZE, message_ids=None):
+        """
+        :brief: Generator over the messages matching at least one of the conditions, in lists of up to batch_size
+                (hex message id, matched flags) tuples. The matched flags tell which of the conditions the message
+                satisfies, in the order of query_conditions. All the conditions are evaluated in a single query.
+                The matches are read page by page in message id order (keyset pagination), so that only one batch
+                is held in memory and the connection can be used to update each batch before the next one is read.
+                The query runs as a server side prepared statement, prepared once for all the pages.
+        :param query_conditions: list of (condition, parameters) - parameterized filter conditions on email_attributes
+        :param batch_size: number of messages per batch
+        :param message_ids: (hex) ids of the messages to be matched. None for all the messages.
+        """
+        if message_ids is not None:
+            yield from self._fetch_rule_matches_of_messages(query_conditions, message_ids, batch_size)
+            return
+        cursor = self.connection.cursor(prepared=True)
+        query, parameters = self._get_rule_match_query(query_conditions)
+        last_message_id = 0
+        while True:
+            with metrics.timed('db_statement_seconds', statement='select_rule_matches'):
+                cursor.execute(query, parameters + [last_message_id] + parameters + [int(batch_size)])
+                results = cursor.fetchall()
+            if not results:
+                return
+            last_message_id = int(results[-1][0])
+            yield [(format(row[0], 'x'), tuple(bool(flag) for flag in row[1:])) for row in results]
+            if len(results) < batch_size:
+                return
+
+    def _fetch_rule_matches_of_messages(self, query_conditions, message_ids, batch_size):
+        """
+        :brief: fetch_rule_matches restricted to the given (hex) message ids, looked up batch_size ids at a time by
+                primary key
+        """
+        cursor = self.connection.cursor()
+        message_ids = sorted({int(item, 16) for item in message_ids})
+        for start in range(0, len(message_ids), batch_size):
+            batch = message_ids[start:start + batch_size]
+            query, parameters = self._get_rule_match_query(query_conditions,
+                                                           f"message_id in ({', '.join(['%s'] * len(batch))})")
+            with metrics.timed('db_statement_seconds', statement='select_rule_matches'):
+                cursor.execute(query, parameters + batch + parameters + [len(batch)])
+                results = cursor.fetchall()
+            if results:
+                yield [(format(row[0], 'x'), tuple(bool(flag) for flag in row[1:])) for row in results]
+
+    @staticmethod
+    def _touch_messages(cursor, message_ids):
+        """
+        :brief: Marks the messages as changed (refreshed_on), for the readers of the changes (see MessageSnapshot)
+        """
+        with metrics.timed('db_statement_seconds', statement='touch_messages'):
+            DBUtils.process_statement(cursor, "update email set refreshed_on = now() where id in (%s)",
+                                      (message_ids,))
 
     def update_labels(self, add_label_ids, remove_label_ids, message_ids):
         """
         Add / remove message labels to the message_ids where applicable.
         That is, add label only when it doesn't exist and remove only when it does.
+        The caller commits, and then calls refresh_thread_summaries.
         """
         cursor = self.connection.cursor()
         message_ids = [int(item, 16) for item in message_ids]
-        for label in remove_label_ids:
-            query = f'''update message_label join email on message_label.message_id=email.id 
-            set labels = json_remove(labels, json_unquote(json_search(labels, 'one', '{label}'))) 
-            where email.id in (%s) and json_contains(labels, '"{label}"')'''
-            DBUtils.process_statement(cursor, query, (message_ids,))
-        for label in add_label_ids:
-            query = f'''update message_label join email on message_label.message_id=email.id 
-            set labels=json_array_append(labels, '$', '{label}') 
-            where email.id in (%s) and not json_contains(labels, '"{label}"')'''
-            DBUtils.process_statement(cursor, query, (message_ids,))
+        self._touch_messages(cursor, message_ids)
+        if remove_label_ids:
+            query = "delete from message_label where `message_id` in (%s) and `label_id` in (%s)"
+            with metrics.timed('db_statement_seconds', statement='remove_labels'):
+                DBUtils.process_statement(cursor, query, (message_ids, list(remove_label_ids)))
+        if add_label_ids:
+            timestamps = self._get_internal_timestamps(cursor, message_ids)
+            rows = [(message_id, label_id, timestamps.get(message_id, UNKNOWN_INTERNAL_TIMESTAMP))
+                    for message_id in message_ids for label_id in add_label_ids]
+            query = "insert into message_label(`message_id`, `label_id`, `internal_timestamp`, `refreshed_on`) " \
+                    "values " + ", ".join(["(%s, %s, %s, now())"] * len(rows)) + \
+                    " on duplicate key update refreshed_on = now()"
+            with metrics.timed('db_statement_seconds', statement='add_labels'):
+                cursor.execute(query, [value for row in rows for value in row])
+        self.__changed_thread_ids.update(ThreadSummaryDAO(self.connection).get_thread_ids(message_ids))
+
+    def refresh_thread_summaries(self):
+        """
+        :brief: Refreshes the summaries of the threads of the messages changed by the DAO, in a transaction of its
+                own. Called once the changes of the messages are committed.
+                The threads are kept pending till their summaries are saved: when the refresh fails, the next call
+                (Eg. by the next flush) refreshes them again.
+        :raises: mysql.connector.errors.Error when the summaries can not be saved
+        """
+        thread_ids = list(self.__changed_thread_ids)
+        ThreadSummaryDAO(self.connection).refresh_threads(thread_ids)
+        self.__changed_thread_ids.difference_update(thread_ids)
+
+    def fetch_existing_message_ids(self, message_ids):
+        """
+        :brief: Returns the subset of the given (hex) message ids that are already stored in the database
+        """
+        if not message_ids:
+            return set()
+        cursor = self.connection.cursor()
+        query = "select id from email where id in (%s)"
+        DBUtils.process_statement(cursor, query, ([int(item, 16) for item in message_ids],))
+        return {format(value[0], 'x') for value in cursor.fetchall()}
+
+    def fetch_message_ids_saved_since(self, message_ids, since):
+        """
+        :brief: Returns the subset of the given (hex) message ids whose data was saved at or after the given time
+        """
+        if not message_ids:
+            return set()
+        cursor = self.connection.cursor()
+        query = "select message_id from email_attributes where message_id in (%s) and refreshed_on >= %s"
+        DBUtils.process_statement(cursor, query, ([int(item, 16) for item in message_ids], since))
+        return {format(value[0], 'x') for value in cursor.fetchall()}
+
+    def get_database_time(self):
+        cursor = self.connection.cursor()
+        cursor.execute("select now()")
+        return cursor.fetchone()[0]
+
+    def get_oldest_timestamp(self):
+        """
+        :return: internal timestamp of the oldest stored email. None when there is none.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("select min(internal_timestamp) from email_attributes")
+        return cursor.fetchone()[0]
+
+    def get_attributes_checksum(self):
+        """
+        :return: (count, xor of the message ids) of the email_attributes table, to tell whether a copy of its
+                 message ids is complete
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("select count(*), coalesce(bit_xor(message_id), 0) from email_attributes")
+        count, checksum = cursor.fetchone()
+        return int(count), int(checksum)
+
+    def fetch_snapshot_rows(self, changed_since=None, batch_size=BULK_UPDATE_BATCH_SIZE):
+        """
+        :brief: Generator over the rule fields of the messages, in lists of up to batch_size rows in message id
+                order (keyset pagination). Each row is (message id, from, to, subject, cc, bcc, internal_timestamp,
+                list of label ids).
+        :param changed_since: when set, only the messages changed at or after this time are read
+        :param batch_size: number of messages per batch
+        """
+        cursor = self.connection.cursor()
+        change_condition = "and message_id in (select id from email where refreshed_on >= %s) " \
+            if changed_since else ""
+        query = "select message_id, `from`, `to`, `subject`, `cc`, `bcc`, `internal_timestamp` " \
+                f"from email_attributes where message_id > %s {change_condition}order by message_id limit %s"
+        last_message_id = 0
+        while True:
+            parameters = [last_message_id] + ([changed_since] if changed_since else []) + [int(batch_size)]
+            with metrics.timed('db_statement_seconds', statement='select_snapshot_rows'):
+                cursor.execute(query, parameters)
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            last_message_id = int(rows[-1][0])
+            label_ids = {}
+            with metrics.timed('db_statement_seconds', statement='select_snapshot_labels'):
+                DBUtils.process_statement(cursor, "select message_id, label_id from message_label "
+                                                  "where message_id in (%s)", ([row[0] for row in rows],))
+                for message_id, label_id in cursor.fetchall():
+                    label_ids.setdefault(message_id, []).append(label_id)
+            yield [tuple(row) + (label_ids.get(row[0], []),) for row in rows]
+            if len(rows) < batch_size:
+                return
+
+    def delete_messages(self, message_ids):
+        """
+        :brief: Removes the given (hex) message ids and everything stored against them
+        """
+        if not message_ids:
+            return
+        cursor = self.connection.cursor()
+        message_ids = [int(item, 16) for item in message_ids]
+        self.__changed_thread_ids.update(ThreadSummaryDAO(self.connection).get_thread_ids(message_ids))
+        for table, column in (('message_part', 'message_id'), ('message_label', 'message_id'),
+                              ('email_headers', 'message_id'), ('email_search', 'message_id'),
+                              ('email_attributes', 'message_id'), ('email', 'id')):
+            DBUtils.process_statement(cursor, f"delete from {table} where `{column}` in (%s)", (message_ids,))
+        self.connection.commit()
+        self.refresh_thread_summaries()
+        LOGGER.info(f"Deleted {len(message_ids)} messages")
@@ -0,0 +1,44 @@
+from lib import metrics
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+MAXVALUE_PARTITION = 'pmax'
+
+
+class PartitionDAO(object):
+    """
+    Reads and reorganizes the partitions of the tables partitioned by range of UNIX_TIMESTAMP(internal_timestamp)
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_partitions(self, table):
+        """
+        :return: list of the partitions of the table in order, as dicts of name, bound (exclusive upper bound in
+                 epoch seconds, None for MAXVALUE), rows (estimate) and data_length (bytes)
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("select partition_name, partition_description, table_rows, data_length "
+                       "from information_schema.partitions where table_schema = database() and table_name = %s "
+                       "order by partition_ordinal_position", (table,))
+        return [{'name': name, 'bound': None if description == 'MAXVALUE' else int(description),
+                 'rows': int(rows or 0), 'data_length': int(data_length or 0)}
+                for name, description, rows, data_length in cursor.fetchall()]
+
+    def reorganize_partitions(self, table, partition_names, partitions):
+        """
+        :brief: Replaces the (adjacent) partitions with the given ones, covering the same range. The rows are copied
+                into the new partitions, which are hence rebuilt compactly.
+        :param partitions: list of (name, bound) - bound in epoch seconds, None for MAXVALUE
+        """
+        definitions = ", ".join(f"partition `{name}` values less than "
+                                f"{'maxvalue' if bound is None else f'({int(bound)})'}" for name, bound in partitions)
+        query = f"alter table `{table}` reorganize partition {', '.join(f'`{name}`' for name in partition_names)} " \
+                f"into ({definitions})"
+        cursor = self.connection.cursor()
+        with metrics.timed('db_statement_seconds', statement='reorganize_partitions'):
+            cursor.execute(query)
+        LOGGER.info(f"Reorganized partitions {', '.join(partition_names)} of {table} into "
+                    f"{', '.join(name for name, _ in partitions)}")
@@ -0,0 +1,112 @@
+import json
+
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+SYNC_PENDING = 'pending'
+SYNC_RUNNING = 'running'
+SYNC_DONE = 'done'
+SYNC_FAILED = 'failed'
+
+
+class SyncStateDAO(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_history_id(self, name):
+        cursor = self.connection.cursor()
+        cursor.execute("select history_id from sync_state where `name` = %s", (name,))
+        result = cursor.fetchone()
+        return int(result[0]) if result and result[0] is not None else None
+
+    def save_history_id(self, name, history_id):
+        cursor = self.connection.cursor()
+        query = "insert into sync_state(`name`, `history_id`, `refreshed_on`) values (%s, %s, now()) " \
+                "on duplicate key update history_id = %s, refreshed_on = now()"
+        cursor.execute(query, (name, history_id, history_id))
+        self.connection.commit()
+        LOGGER.info(f"Saved history checkpoint {history_id} for {name}")
+
+    def get_shards(self, prefix):
+        """
+        :return: list of the shards whose name starts with the prefix, as dicts of name, parameters, status,
+                 message_count, attempts and history_id
+        """
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute("select `name`, `parameters`, `status`, `message_count`, `attempts`, `history_id` "
+                       "from sync_state where `name` like %s order by `name`", (f'{prefix}%',))
+        shards = cursor.fetchall()
+        for shard in shards:
+            shard['parameters'] = json.loads(shard['parameters']) if shard['parameters'] else {}
+        return shards
+
+    def replace_shards(self, prefix, shards):
+        """
+        :brief: Replaces the shards whose name starts with the prefix with the given (pending) shards
+        :param shards: list of (name, parameters) - parameters are the messages.list arguments of the shard
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("delete from sync_state where `name` like %s", (f'{prefix}%',))
+        if shards:
+            query = "insert into sync_state(`name`, `parameters`, `status`, `refreshed_on`) values " + \
+                    ", ".join(["(%s, %s, %s, now())"] * len(shards))
+            cursor.execute(query, [value for name, parameters in shards
+                                   for value in (name, json.dumps(parameters), SYNC_PENDING)])
+        self.connection.commit()
+
+    def update_status(self, name, status, message_count=None, error=None):
+        """
+        :brief: Saves the status of a download or a shard. Each transition to running counts as an attempt.
+                The first one sets the start of the download.
+        """
+        cursor = self.connection.cursor()
+        query = "update sync_state set `status` = %s, `message_count` = coalesce(%s, `message_count`), " \
+                "`attempts` = `attempts` + %s, `error` = %s, " \
+                "`started_on` = if(%s, coalesce(`started_on`, now()), `started_on`), `refreshed_on` = now() " \
+                "where `name` = %s"
+        is_running = int(status == SYNC_RUNNING)
+        cursor.execute(query, (status, message_count, is_running, error[:1000] if error else None, is_running, name))
+        self.connection.commit()
+
+    def get_checkpoint(self, name):
+        """
+        :return: dict of the name, parameters, status, page_token, last_batch, message_count, history_id and
+                 started_on of the download. None when there is no such download.
+        """
+        cursor = self.connection.cursor(dictionary=True)
+        cursor.execute("select `name`, `parameters`, `status`, `page_token`, `last_batch`, `message_count`, "
+                       "`history_id`, `started_on` from sync_state where `name` = %s", (name,))
+        checkpoint = cursor.fetchone()
+        if checkpoint:
+            checkpoint['parameters'] = json.loads(checkpoint['parameters']) if checkpoint['parameters'] else {}
+        return checkpoint
+
+    def start_checkpoint(self, name, parameters, history_id=None):
+        """
+        :brief: Records a new (running) download, replacing the previous one of the same name
+        :param parameters: arguments of the download, to be used when it gets resumed
+        :param history_id: history id of the mailbox taken at the start of the download
+        """
+        cursor = self.connection.cursor()
+        query = "insert into sync_state(`name`, `history_id`, `parameters`, `status`, `attempts`, `started_on`, " \
+                "`refreshed_on`) values (%s, %s, %s, %s, 1, now(), now()) on duplicate key update " \
+                "history_id = values(history_id), parameters = values(parameters), status = values(status), " \
+                "page_token = null, last_batch = 0, message_count = 0, attempts = 1, error = null, " \
+                "started_on = now(), refreshed_on = now()"
+        cursor.execute(query, (name, history_id, json.dumps(parameters), SYNC_RUNNING))
+        self.connection.commit()
+
+    def save_checkpoint(self, name, page_token, last_batch, message_count):
+        """
+        :brief: Saves the progress of a download
+        :param page_token: page token following the last saved page. None when the listing is complete.
+        :param last_batch: number of pages saved, from the first one
+        :param message_count: number of messages saved
+        """
+        cursor = self.connection.cursor()
+        query = "update sync_state set `page_token` = %s, `last_batch` = %s, `message_count` = %s, " \
+                "`refreshed_on` = now() where `name` = %s"
+        cursor.execute(query, (page_token, last_batch, message_count, name))
+        self.connection.commit()
+        LOGGER.info(f"Saved the checkpoint of {name} at page {last_batch} ({message_count} messages)")
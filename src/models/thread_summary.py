@@ -0,0 +1,102 @@
+import time
+
+import mysql.connector
+from mysql.connector import errorcode
+
+from config.settings import THREAD_SUMMARY_MAX_TEXT_SIZE, DB_DEADLOCK_MAX_ATTEMPTS
+from lib import metrics
+from lib.db_utils import DBUtils
+from lib.logger_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+# From, To or Cc header of a message, for each of the rows (1 to 3) of the header join of SUMMARY_QUERY
+PARTICIPANT_EXPRESSION = "nullif(elt(header.number, email_attributes.`from`, email_attributes.`to`, " \
+                         "email_attributes.`cc`), '')"
+# Aggregates the stored messages of the threads. The participants are the distinct From, To and Cc headers of the
+# messages, and the labels the union of their labels.
+SUMMARY_QUERY = "select email.thread_id, count(distinct email.id), min(email_attributes.internal_timestamp), " \
+                "max(email_attributes.internal_timestamp), " \
+                f"group_concat(distinct {PARTICIPANT_EXPRESSION} order by {PARTICIPANT_EXPRESSION} separator ', '), " \
+                "group_concat(distinct message_label.label_id order by message_label.label_id) " \
+                "from email join email_attributes on email_attributes.message_id = email.id " \
+                "join (select 1 as number union all select 2 union all select 3) header " \
+                "left join message_label on message_label.message_id = email.id " \
+                "where email.thread_id in (%s) group by email.thread_id"
+
+
+class ThreadSummaryDAO(object):
+    """
+    Maintains the thread_summary table: the message count, the first and last timestamps, the participants and the
+    labels of each thread. The summaries of the threads of the saved, relabelled or deleted messages are recomputed
+    (from the messages of those threads only) once their changes are committed, in a short transaction of their
+    own, so that the writers of the messages do not hold locks on the summaries.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_thread_ids(self, message_ids):
+        """
+        :param message_ids: list of message ids (integers)
+        :return: list of the distinct thread ids of the messages
+        """
+        if not message_ids:
+            return []
+        cursor = self.connection.cursor()
+        DBUtils.process_statement(cursor, "select distinct thread_id from email where id in (%s)", (message_ids,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def _save_summaries(self, thread_ids):
+        cursor = self.connection.cursor()
+        cursor.execute("set session group_concat_max_len = %s", (THREAD_SUMMARY_MAX_TEXT_SIZE,))
+        # Aggregated with a plain (non locking) read, rather than with an insert ... select locking the messages
+        with metrics.timed('db_statement_seconds', statement='select_thread_summaries'):
+            DBUtils.process_statement(cursor, SUMMARY_QUERY, (thread_ids,))
+            rows = cursor.fetchall()
+        if rows:
+            query = "insert into thread_summary(`thread_id`, `message_count`, `first_timestamp`, `last_timestamp`, " \
+                    "`participants`, `label_ids`, `refreshed_on`) values " + \
+                    ", ".join(["(%s, %s, %s, %s, %s, %s, now())"] * len(rows)) + \
+                    " on duplicate key update message_count = values(message_count), " \
+                    "first_timestamp = values(first_timestamp), last_timestamp = values(last_timestamp), " \
+                    "participants = values(participants), label_ids = values(label_ids), refreshed_on = now()"
+            with metrics.timed('db_statement_seconds', statement='upsert_thread_summaries'):
+                cursor.execute(query, [value for row in rows for value in row])
+        # Threads left without stored messages lose their summary. Only existing rows are deleted (by primary key).
+        empty_ids = set(thread_ids) - {row[0] for row in rows}
+        if empty_ids:
+            DBUtils.process_statement(cursor, "select thread_id from thread_summary where thread_id in (%s)",
+                                      (sorted(empty_ids),))
+            stale_ids = [row[0] for row in cursor.fetchall()]
+            if stale_ids:
+                with metrics.timed('db_statement_seconds', statement='delete_thread_summaries'):
+                    DBUtils.process_statement(cursor, "delete from thread_summary where thread_id in (%s)",
+                                              (stale_ids,))
+        with metrics.timed('db_commit_seconds'):
+            self.connection.commit()
+
+    def refresh_threads(self, thread_ids, max_attempts=DB_DEADLOCK_MAX_ATTEMPTS):
+        """
+        :brief: Recomputes the summaries of the given threads and commits them. Threads without stored messages lose
+                theirs. Should be called outside of the transactions changing the messages (after their commit).
+                The transaction is retried when chosen as the victim of a deadlock.
+        :raises: mysql.connector.errors.Error when the summaries can not be saved
+        """
+        if not thread_ids:
+            return
+        # Sorted, so that concurrent refreshes lock the summaries in the same order
+        thread_ids = sorted(set(thread_ids))
+        for attempt in range(1, max_attempts + 1):
+            try:
+                self._save_summaries(thread_ids)
+                break
+            except mysql.connector.errors.Error as ex:
+                self.connection.rollback()
+                if ex.errno != errorcode.ER_LOCK_DEADLOCK or attempt == max_attempts:
+                    raise
+                metrics.increment('db_deadlock_retries_total', statement='refresh_thread_summaries')
+                LOGGER.warning(f"Deadlock while refreshing {len(thread_ids)} thread summaries "
+                               f"(attempt {attempt}). Retrying")
+                time.sleep(0.1 * attempt)
+        LOGGER.debug(f"Refreshed the summaries of {len(thread_ids)} threads")
@@ -0,0 +1,29 @@
+import argparse
+
+from config.settings import ARCHIVE_HOT_MONTHS, ARCHIVE_MONTHS_AHEAD, ARCHIVE_PARTITIONED_TABLES
+from businesslogic.archiver import Archiver
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='This script maintains the date partitions of the tables partitioned by date '
+                    f'({", ".join(ARCHIVE_PARTITIONED_TABLES)}).\nThe recent mail is kept in monthly partitions, '
+                    'created ahead of time, and the older months are compacted into yearly partitions.\n'
+                    'Run it after creating the tables and then monthly.',
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-m', nargs=1, type=int, metavar='hot_months',
+                        help=f'Specify the months of mail kept in monthly partitions (default: {ARCHIVE_HOT_MONTHS})')
+    parser.add_argument('-a', nargs=1, type=int, metavar='months_ahead',
+                        help=f'Specify the months of partitions created ahead of time '
+                             f'(default: {ARCHIVE_MONTHS_AHEAD})')
+    parser.add_argument('-d', action='store_true',
+                        help='Dry run: print the partitions that would be reorganized, without changing them')
+    args = parser.parse_args()
+    archiver = Archiver(args.m[0] if args.m else ARCHIVE_HOT_MONTHS, args.a[0] if args.a else ARCHIVE_MONTHS_AHEAD)
+    reorganizations = archiver.run(dry_run=args.d)
+    for table, table_reorganizations in reorganizations.items():
+        for partition_names, row_count, new_partitions in table_reorganizations:
+            print(f"{table}: {', '.join(partition_names)} (about {row_count} rows) -> "
+                  f"{', '.join(name for name, _ in new_partitions)}")
+    if not any(reorganizations.values()):
+        print("The partitions are up to date")
+    print("Done")
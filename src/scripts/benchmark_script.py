@@ -0,0 +1,213 @@
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+
+from config.settings import MYSQL_DB_CREDENTIALS, BENCHMARK_DB_NAME, BENCHMARK_SIZES, DOWNLOAD_FETCH_WORKERS, \
+    MESSAGE_FORMATS, MESSAGE_FORMAT_FULL, PYTHON_PATH, FAKE_MAILBOX_BODY_SIZE
+from businesslogic.email_processor import EmailProcessor
+from businesslogic.rules_processor import RulesProcessor
+from lib.db_utils import DBUtils
+from lib import metrics
+from lib.fake_gmail import FakeMailbox, get_fake_service_factory
+from lib.request_scheduler import GmailRequestScheduler
+from models.email import EmailDAO
+
+BENCHMARK_TABLES = ('message_part', 'message_label', 'email_headers', 'email_search', 'email_attributes', 'email',
+                    'thread_summary', 'label', 'sync_state')
+DEFAULT_RULE_SET_PATH = f'{PYTHON_PATH}/../resources/rule_set.json'
+
+
+class StageTimings(object):
+    """
+    Collects the duration of every call of the wrapped functions, by stage
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    def wrap(self, stage, function):
+        durations = self.durations.setdefault(stage, [])
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations.append(time.perf_counter() - start)
+
+        return timed_function
+
+    def wrap_generator(self, stage, function):
+        """
+        :brief: Wraps a generator function. The time taken to produce each item is recorded.
+        """
+        durations = self.durations.setdefault(stage, [])
+
+        @wraps(function)
+        def timed_generator(*args, **kwargs):
+            generator = function(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    durations.append(time.perf_counter() - start)
+                yield item
+
+        return timed_generator
+
+    def get_summary(self):
+        """
+        :return: dict of stage -> count, total seconds and the mean, p50, p95 and max milliseconds of the calls
+        """
+        summary = {}
+        for stage, durations in self.durations.items():
+            if not durations:
+                continue
+            durations = sorted(durations)
+            summary[stage] = {'count': len(durations),
+                              'total_seconds': round(sum(durations), 3),
+                              'mean_ms': round(sum(durations) / len(durations) * 1000, 2),
+                              'p50_ms': round(durations[len(durations) // 2] * 1000, 2),
+                              'p95_ms': round(durations[min(len(durations) - 1, len(durations) * 95 // 100)] * 1000,
+                                              2),
+                              'max_ms': round(durations[-1] * 1000, 2)}
+        return summary
+
+
+def clear_tables():
+    with DBUtils.pooled_connection() as connection:
+        cursor = connection.cursor()
+        for table in BENCHMARK_TABLES:
+            cursor.execute(f"delete from `{table}`")
+        connection.commit()
+
+
+def run_download(mailbox, options, timings):
+    """
+    :return: number of messages downloaded
+    """
+    email_processor = EmailProcessor(options['fetch_workers'],
+                                     service_factory=get_fake_service_factory(mailbox, options['latency'],
+                                                                              options['error_rate']))
+    email_processor.scheduler = GmailRequestScheduler(max_concurrency=options['fetch_workers'],
+                                                      units_per_second=options['quota'])
+    email_processor._list_messages = timings.wrap_generator('list', email_processor._list_messages)
+    email_processor._batch_get_email_details = timings.wrap('fetch', email_processor._batch_get_email_details)
+    email_processor._save_emails = timings.wrap('save', email_processor._save_emails)
+    EmailDAO.flush = timings.wrap('flush', EmailDAO.flush)
+    email_processor.download_emails_to_db(None, options['fetch_mode'])
+    return len(mailbox)
+
+
+def run_rules(mailbox, options, timings):
+    """
+    :return: number of messages modified by the rules
+    """
+    rules_processor = RulesProcessor(service_factory=get_fake_service_factory(mailbox, options['latency'],
+                                                                            options['error_rate']))
+    rules_processor.scheduler = GmailRequestScheduler(units_per_second=options['quota'])
+    modified_count = 0
+    apply_action = timings.wrap('apply_action', rules_processor._apply_action)
+
+    def count_modified(connection, message_ids, add_label_ids, remove_label_ids):
+        nonlocal modified_count
+        modified_count += len(message_ids)
+        return apply_action(connection, message_ids, add_label_ids, remove_label_ids)
+
+    rules_processor._apply_action = count_modified
+    EmailDAO.fetch_rule_matches = timings.wrap_generator('rule_query', EmailDAO.fetch_rule_matches)
+    rules_processor.process_rule_set(options['rule_set'])
+    return modified_count
+
+
+def run_benchmark(phase, size, options):
+    """
+    :brief: Runs a phase (download / rules) of the benchmark over a synthetic mailbox. Runs in a separate process,
+            so that the peak RSS is the one of the phase.
+    :return: dict of the results
+    """
+    MYSQL_DB_CREDENTIALS['database'] = options['database']
+    if phase == 'download':
+        clear_tables()
+    # The mailbox is generated the same way in both the phases (same seed)
+    mailbox = FakeMailbox(size, body_size=options['body_size'])
+    timings = StageTimings()
+    start = time.perf_counter()
+    message_count = run_download(mailbox, options, timings) if phase == 'download' else \
+        run_rules(mailbox, options, timings)
+    elapsed = time.perf_counter() - start
+    return {'phase': phase,
+            'size': size,
+            'messages': message_count,
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(message_count / elapsed, 1) if elapsed else None,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'stages': timings.get_summary(),
+            'metrics': metrics.get_registry().snapshot()}
+
+
+def print_result(result):
+    print(f"\n{result['phase']} of {result['size']} messages: {result['messages']} messages in {result['seconds']}s "
+          f"({result['messages_per_second']} messages/s), peak RSS {result['peak_rss_mb']} MB")
+    print(f"    {'stage':<14}{'count':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for stage, stats in result['stages'].items():
+        print(f"    {stage:<14}{stats['count']:>8}{stats['total_seconds']:>10}{stats['mean_ms']:>10}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['max_ms']:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='This script benchmarks the download and the rules processing against a local stand-in for '
+                    'the Gmail API,\nserving synthetic mailboxes of the given sizes. '
+                    'It reports the messages per second, the latency of each stage and the peak RSS.\n'
+                    f'The benchmark database (default: {BENCHMARK_DB_NAME}) is cleared before each run. '
+                    'Create it from schema.sql.',
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', nargs='+', type=int, metavar='sizes', default=list(BENCHMARK_SIZES),
+                        help=f'Specify the mailbox sizes (default: {" ".join(map(str, BENCHMARK_SIZES))})')
+    parser.add_argument('-f', metavar='fetch_mode', choices=MESSAGE_FORMATS, default=MESSAGE_FORMAT_FULL,
+                        help='Specify the fetch mode of the download (default: full)')
+    parser.add_argument('-w', type=int, metavar='fetch_workers', default=DOWNLOAD_FETCH_WORKERS,
+                        help=f'Specify the number of pages fetched concurrently (default: {DOWNLOAD_FETCH_WORKERS})')
+    parser.add_argument('-r', metavar='rules_file_path', default=DEFAULT_RULE_SET_PATH,
+                        help='Specify the rule set applied after the download (default: resources/rule_set.json)')
+    parser.add_argument('-d', metavar='database', default=BENCHMARK_DB_NAME,
+                        help='Specify the benchmark database. Its tables are cleared!')
+    parser.add_argument('-l', type=float, metavar='latency_ms', default=0,
+                        help='Specify the latency added to every HTTP round trip, in milliseconds (default: 0)')
+    parser.add_argument('-e', type=float, metavar='error_rate', default=0,
+                        help='Specify the fraction of API calls failing with rate limit errors (default: 0)')
+    parser.add_argument('-u', type=int, metavar='quota_units', default=None,
+                        help='Specify the client side quota, in units per second (default: no limit)')
+    parser.add_argument('-b', type=int, metavar='body_size', default=FAKE_MAILBOX_BODY_SIZE,
+                        help='Specify the approximate body size of the synthetic messages, in bytes '
+                             f'(default: {FAKE_MAILBOX_BODY_SIZE})')
+    parser.add_argument('-o', metavar='output_path', help='Save the results to a JSON file')
+    args = parser.parse_args()
+    if args.d == MYSQL_DB_CREDENTIALS['database']:
+        parser.error(f"The benchmark clears the tables of its database. Please use a database other than {args.d}")
+    with open(args.r, 'r') as file_obj:
+        rule_set = json.load(file_obj)
+    benchmark_options = {'database': args.d, 'fetch_mode': args.f, 'fetch_workers': args.w,
+                         'rule_set': rule_set if isinstance(rule_set, list) else [rule_set],
+                         'latency': args.l / 1000, 'error_rate': args.e, 'quota': args.u, 'body_size': args.b}
+    results = []
+    for mailbox_size in args.n:
+        for benchmark_phase in ('download', 'rules'):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+                benchmark_result = executor.submit(run_benchmark, benchmark_phase, mailbox_size,
+                                                   benchmark_options).result()
+            print_result(benchmark_result)
+            results.append(benchmark_result)
+    if args.o:
+        with open(args.o, 'w') as file_obj:
+            json.dump(results, file_obj, indent=4)
@@ -1,12 +1,23 @@
 import argparse
-from config.settings import MAX_EMAIL_LIMIT
+from config.settings import DOWNLOAD_FETCH_WORKERS, MESSAGE_FORMATS, MESSAGE_FORMAT_FULL, BACKFILL_SHARDS_PER_PROCESS, \
+    BACKFILL_START_DATE
 from businesslogic.email_processor import EmailProcessor
+from businesslogic.sharded_backfill import ShardedBackfill, get_date_shards, get_label_shards
+from lib.metrics import exported_metrics, profiled
 
 
 class Downloader(object):
     def __init__(self, arguments):
-        self.max_fetch_limit = arguments.m[0] if arguments.m else MAX_EMAIL_LIMIT
-        self.fetch_mode = arguments.f[0] if arguments.f else 'full'
+        self.max_fetch_limit = arguments.m[0] if arguments.m else None
+        self.fetch_mode = arguments.f[0] if arguments.f else MESSAGE_FORMAT_FULL
+        self.incremental = arguments.i
+        self.fetch_workers = arguments.w[0] if arguments.w else DOWNLOAD_FETCH_WORKERS
+        self.use_cache = arguments.c or arguments.r
+        self.rebuild_from_cache = arguments.r
+        self.processes = arguments.P[0] if arguments.P else None
+        self.shard_count = arguments.S[0] if arguments.S else None
+        self.start_date = arguments.a[0] if arguments.a else BACKFILL_START_DATE
+        self.resume = arguments.resume
         self.parameter_dict = dict()
         if arguments.l:
             self.parameter_dict['labelIds'] = arguments.l
@@ -15,9 +26,38 @@ class Downloader(object):
         if arguments.s:
             self.parameter_dict['maxResults'] = arguments.s[0]
 
+    def backfill(self):
+        query = self.parameter_dict.get('q')
+        if self.parameter_dict.get('labelIds'):
+            shards = get_label_shards(self.parameter_dict['labelIds'], query)
+        else:
+            shards = get_date_shards(self.shard_count or self.processes * BACKFILL_SHARDS_PER_PROCESS,
+                                     self.start_date, query)
+        if self.parameter_dict.get('maxResults'):
+            for _, parameters in shards:
+                parameters['maxResults'] = self.parameter_dict['maxResults']
+        is_mailbox_sync = not (query or self.parameter_dict.get('labelIds'))
+        ShardedBackfill(self.processes, self.fetch_mode, self.fetch_workers).run(shards, is_mailbox_sync)
+
     def download(self):
-        EmailProcessor().download_emails_to_db(self.max_fetch_limit, self.fetch_mode, **self.parameter_dict)
-        print("Done")
+        if self.processes:
+            self.backfill()
+            print("Done")
+            return
+        email_processor = EmailProcessor(self.fetch_workers, self.use_cache)
+        try:
+            if self.rebuild_from_cache:
+                email_processor.rebuild_db_from_cache()
+            elif self.resume and email_processor.resume_download():
+                print("Resumed the interrupted download")
+            else:
+                if self.resume:
+                    print("There is no interrupted download to resume. Starting a new one")
+                email_processor.download_emails_to_db(self.max_fetch_limit, self.fetch_mode, self.incremental,
+                                                      **self.parameter_dict)
+        finally:
+            email_processor.close()
+        print(f"Done. Saved {email_processor.message_count} messages")
 
 
 if __name__ == "__main__":
@@ -26,12 +66,14 @@ if __name__ == "__main__":
                     'Running this script without arguments would fetch all the emails '
                     'and save it to the MySQL database.',
         formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-f', nargs=1, metavar='fetch_mode', choices=['full', 'minimal'],
+    parser.add_argument('-f', nargs=1, metavar='fetch_mode', choices=MESSAGE_FORMATS,
                         help='Specify the fetch mode. '
                              '"full" is meant to be used for the first time synchronization or when '
-                             'fetching newer emails;\nTo update / refresh already stored emails, use "minimal"')
+                             'fetching newer emails;\n"metadata" fetches the same without the email body;'
+                             '\nTo update / refresh already stored emails, use "minimal"')
     parser.add_argument('-m', nargs=1, type=int, metavar='max_limit',
-                        help='Specify a maximum limit for the number of emails that should be fetched & saved.',
+                        help='Specify a maximum limit for the number of emails that should be fetched & saved.\n'
+                             'Does not apply to the incremental sync (-i)',
                         default=None)
     parser.add_argument('-s', nargs=1, type=int, metavar='page_size',
                         help='Specify the page size (when paging over a large result)', default=None)
@@ -40,6 +82,43 @@ if __name__ == "__main__":
                              'Refer https://support.google.com/mail/answer/7190?hl=en.')
     parser.add_argument('-l', nargs='+', metavar='labels',
                         help='Specify one (or more) labels that should be filtered')
+    parser.add_argument('-i', action='store_true',
+                        help='Synchronize only the changes since the last sync (added, deleted and relabelled emails).\n'
+                             'Falls back to a full sync when there is no valid checkpoint. Ignores -q and -l')
+    parser.add_argument('-w', nargs=1, type=int, metavar='fetch_workers',
+                        help=f'Specify the number of pages fetched concurrently (default: {DOWNLOAD_FETCH_WORKERS})')
+    parser.add_argument('-c', action='store_true',
+                        help='Use the on-disk message cache: only the labels of the cached emails are fetched '
+                             '(none with -i)\nand the emails fetched in full are added to the cache')
+    parser.add_argument('-r', action='store_true',
+                        help='Rebuild the database from the on-disk message cache, without calling the Gmail API')
+    parser.add_argument('-P', nargs=1, type=int, metavar='processes',
+                        help='Backfill the mailbox in parallel, with the given number of worker processes.\n'
+                             'The mailbox is split into date shards (or into one shard per label, with -l).\n'
+                             'An interrupted backfill is resumed by the next run with -P')
+    parser.add_argument('-S', nargs=1, type=int, metavar='shards',
+                        help=f'Specify the number of date shards of the backfill '
+                             f'(default: {BACKFILL_SHARDS_PER_PROCESS} per process)')
+    parser.add_argument('-a', nargs=1, metavar='start_date',
+                        help=f'Specify the end date (YYYY/MM/DD) of the first date shard, which holds all the older '
+                             f'emails (default: {BACKFILL_START_DATE})')
+    parser.add_argument('-R', '--resume', action='store_true',
+                        help='Resume the last download when it was interrupted, with its original arguments '
+                             '(-f, -m, -s, -q and -l are ignored).\nListing continues from its last checkpoint and '
+                             'the emails saved since it started are not fetched again.\n'
+                             'Runs a new download with the given arguments when there is none to resume')
+    parser.add_argument('-p', nargs=1, metavar='profile_path',
+                        help='Profile the run with cProfile (all threads) and save the stats to the given file')
+    parser.add_argument('-e', nargs=1, type=int, metavar='metrics_port',
+                        help='Serve the metrics (Prometheus text format) at http://<host>:<metrics_port>/metrics')
+    parser.add_argument('-j', nargs=1, metavar='metrics_json_path',
+                        help='Dump the metrics to the given JSON file periodically and at the end of the run')
 
     args = parser.parse_args()
-    Downloader(args).download()
+    if args.P and (args.m or args.i or args.c or args.r or args.resume):
+        parser.error("-P can not be combined with -m, -i, -c, -r or --resume")
+    if args.resume and (args.i or args.r):
+        parser.error("--resume can not be combined with -i or -r")
+    with exported_metrics(args.e[0] if args.e else None, args.j[0] if args.j else None), \
+            profiled(args.p[0] if args.p else None):
+        Downloader(args).download()
@@ -1,8 +1,13 @@
 import argparse
 import os.path
 import json
+import sys
 
+from config.settings import RULE_SNAPSHOT_PATH
 from businesslogic.rules_processor import RulesProcessor
+from businesslogic.rule_planner import RulePlanner
+from businesslogic.rule_snapshot import MessageSnapshot
+from lib.metrics import exported_metrics, profiled
 
 
 class VerifyAndSetPathAction(argparse.Action):
@@ -12,12 +17,38 @@ class VerifyAndSetPathAction(argparse.Action):
         try:
             with open(values[0], "r") as file_obj:
                 rules = json.load(file_obj)
-                setattr(namespace, self.dest, rules)
+                # A file may hold a single rule or a list of rules, which are processed together
+                setattr(namespace, self.dest, rules if isinstance(rules, list) else [rules])
                 print(f"\n\nINPUT RULE:\n\n{json.dumps(rules, indent=4)}")
         except Exception:
             raise ValueError("Please provide a file containing a valid JSON rule")
 
 
+def print_plan(plan):
+    print(f"\n\nDRY RUN\n\nEmails in the database: {plan['message_count']}, "
+          f"modified by the rules: {plan['modified_count']}")
+    for rule in plan['rules']:
+        print(f"\nRule #{rule['index']}: {rule['description'] or ''}")
+        print(f"    Condition: {rule['condition']}")
+        print(f"    Parameters: {rule['parameters']}")
+        print(f"    Matches: {rule['match_count']}. Sample ids: {', '.join(rule['sample_ids']) or '-'}")
+        for row in rule['explain']:
+            print(f"    EXPLAIN {row.get('select_type')} {row.get('table')}: type={row.get('type')}, "
+                  f"key={row.get('key')}, rows={row.get('rows')}, extra={row.get('Extra')}")
+        for warning in rule['warnings']:
+            print(f"    WARNING: {warning}")
+    print("\nActions:")
+    for action in plan['actions']:
+        print(f"    {action['message_count']} emails: add {action['addLabelIds'] or '-'}, "
+              f"remove {action['removeLabelIds'] or '-'}")
+    print(f"\nQuery: {plan['query']}\nArguments: {plan['arguments']}")
+    for row in plan['explain']:
+        print(f"EXPLAIN {row.get('select_type')} {row.get('table')}: type={row.get('type')}, key={row.get('key')}, "
+              f"rows={row.get('rows')}, extra={row.get('Extra')}")
+    for warning in plan['warnings']:
+        print(f"WARNING: {warning}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='This script runs the rules present in emailapp/resources/rules.json file '
@@ -25,6 +56,35 @@ if __name__ == "__main__":
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-r', nargs=1, metavar='rules_file_path', required=True,
                         help='Specify an absolute or relative path to an alternate .json file that contains '
-                             'rules in the same format as emailapp/resources/rules.json', action=VerifyAndSetPathAction)
+                             'rules in the same format as emailapp/resources/rules.json.\n'
+                             'The file may also contain a list of such rules (see emailapp/resources/rule_set.json)',
+                        action=VerifyAndSetPathAction)
+    parser.add_argument('-s', action='store_true',
+                        help='Evaluate the rules in memory, over a snapshot of the stored emails kept in '
+                             f'{RULE_SNAPSHOT_PATH}.\nThe snapshot is refreshed with the emails changed since the '
+                             'last run. Rules on the body are evaluated in the database')
+    parser.add_argument('-d', action='store_true',
+                        help='Dry run: report the emails matched by each rule (count and sample ids), the emails '
+                             'modified per action\nand the SQL query with its EXPLAIN output, flagging the full '
+                             'scans. Gmail and the database are not modified')
+    parser.add_argument('-p', nargs=1, metavar='profile_path',
+                        help='Profile the run with cProfile (all threads) and save the stats to the given file')
+    parser.add_argument('-e', nargs=1, type=int, metavar='metrics_port',
+                        help='Serve the metrics (Prometheus text format) at http://<host>:<metrics_port>/metrics')
+    parser.add_argument('-j', nargs=1, metavar='metrics_json_path',
+                        help='Dump the metrics to the given JSON file periodically and at the end of the run')
     args = parser.parse_args()
-    RulesProcessor().process_rules(args.r)
+    rules_processor = None
+    with exported_metrics(args.e[0] if args.e else None, args.j[0] if args.j else None), \
+            profiled(args.p[0] if args.p else None):
+        snapshot = MessageSnapshot.load(RULE_SNAPSHOT_PATH) if args.s else None
+        if args.d:
+            print_plan(RulePlanner(snapshot).plan(args.r))
+        else:
+            rules_processor = RulesProcessor(snapshot=snapshot)
+            rules_processor.process_rule_set(args.r)
+        if snapshot is not None:
+            snapshot.save(RULE_SNAPSHOT_PATH)
+    # Some of the matched messages could not be modified
+    if rules_processor is not None and rules_processor.failed_count:
+        sys.exit(1)
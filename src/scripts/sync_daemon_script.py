@@ -0,0 +1,57 @@
+import argparse
+import json
+import signal
+
+from config.settings import DOWNLOAD_FETCH_WORKERS, MESSAGE_FORMATS, MESSAGE_FORMAT_FULL, DAEMON_POLL_INTERVAL, \
+    RULE_SNAPSHOT_PATH
+from businesslogic.email_processor import EmailProcessor
+from businesslogic.rules_processor import RulesProcessor
+from businesslogic.rule_snapshot import MessageSnapshot
+from businesslogic.sync_daemon import SyncDaemon
+from lib.metrics import exported_metrics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='This script runs as a daemon, keeping the database in sync with your Gmail account.\n'
+                    'The changes of the mailbox are synchronized as they happen (checked every poll interval) '
+                    'and the rules,\nwhen given, are applied to the new and relabelled emails. '
+                    'Stop it with Ctrl+C or SIGTERM.',
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-r', nargs=1, metavar='rules_file_path',
+                        help='Specify the rules applied to the changed emails, in the format of '
+                             'emailapp/resources/rules.json\n(or a list of such rules, see '
+                             'emailapp/resources/rule_set.json)')
+    parser.add_argument('-t', nargs=1, type=int, metavar='poll_interval',
+                        help=f'Specify the seconds between two checks of the mailbox for changes '
+                             f'(default: {DAEMON_POLL_INTERVAL})')
+    parser.add_argument('-f', nargs=1, metavar='fetch_mode', choices=MESSAGE_FORMATS,
+                        help='Specify the fetch mode of the new emails (default: full)')
+    parser.add_argument('-w', nargs=1, type=int, metavar='fetch_workers',
+                        help=f'Specify the number of pages fetched concurrently (default: {DOWNLOAD_FETCH_WORKERS})')
+    parser.add_argument('-s', action='store_true',
+                        help='Evaluate the rules in memory, over a snapshot of the stored emails kept in '
+                             f'{RULE_SNAPSHOT_PATH}.\nThe snapshot is saved when the daemon stops')
+    parser.add_argument('-e', nargs=1, type=int, metavar='metrics_port',
+                        help='Serve the metrics (Prometheus text format) at http://<host>:<metrics_port>/metrics')
+    parser.add_argument('-j', nargs=1, metavar='metrics_json_path',
+                        help='Dump the metrics to the given JSON file periodically and when the daemon stops')
+    args = parser.parse_args()
+    if args.s and not args.r:
+        parser.error("-s requires rules (-r)")
+    rule_set = None
+    if args.r:
+        with open(args.r[0], 'r') as file_obj:
+            rule_set = json.load(file_obj)
+        # A file may hold a single rule or a list of rules, which are processed together
+        rule_set = rule_set if isinstance(rule_set, list) else [rule_set]
+    with exported_metrics(args.e[0] if args.e else None, args.j[0] if args.j else None):
+        snapshot = MessageSnapshot.load(RULE_SNAPSHOT_PATH) if args.s else None
+        daemon = SyncDaemon(EmailProcessor(args.w[0] if args.w else DOWNLOAD_FETCH_WORKERS),
+                            RulesProcessor(snapshot=snapshot) if rule_set else None, rule_set,
+                            args.f[0] if args.f else MESSAGE_FORMAT_FULL,
+                            args.t[0] if args.t else DAEMON_POLL_INTERVAL)
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: daemon.stop())
+        signal.signal(signal.SIGINT, lambda signal_number, frame: daemon.stop())
+        daemon.run()
+        if snapshot is not None:
+            snapshot.save(RULE_SNAPSHOT_PATH)
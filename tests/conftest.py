@@ -0,0 +1,177 @@
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+# The modules are imported from src, as the scripts do (see README.md)
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_PATH)
+os.environ.setdefault('PYTHONPATH', SRC_PATH)
+
+from businesslogic import email_processor as email_processor_module  # noqa: E402
+from businesslogic.email_processor import EmailProcessor  # noqa: E402
+from lib.db_utils import DBUtils  # noqa: E402
+from lib.fake_gmail import FakeMailbox, get_fake_service_factory  # noqa: E402
+from models.sync_state import SYNC_RUNNING  # noqa: E402
+
+
+class FakeDatabase(object):
+    """
+    In-memory stand-in for the tables used by EmailProcessor (label, email and its attributes, sync_state), so that
+    the downloads can be run against a FakeMailbox without a MySQL server.
+    Failures can be injected with fail_on: callable(operation, value) raising an exception.
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self.emails = {}  # hex message id -> dict of thread_id, label_ids, history_id, saved_on, has_parts
+        self.save_counts = {}  # hex message id -> number of times its attributes were saved
+        self.sync_state = {}
+        self.fail_on = None
+
+    # The changes are applied as they are made (see FakeEmailDAO)
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def check(self, operation, value=None):
+        if self.fail_on:
+            self.fail_on(operation, value)
+
+
+class FakeEmailDAO(object):
+    """
+    EmailDAO over a FakeDatabase. The changes are applied as soon as they are buffered.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def remove_all_labels(self):
+        self.connection.labels.clear()
+
+    def insert_label(self, label):
+        self.connection.labels[label['id']] = label
+
+    def bulk_insert_message_ids(self, messages):
+        self.connection.check('bulk_insert_message_ids', messages)
+        for message in messages:
+            self.connection.emails.setdefault(message['id'], {'thread_id': message['threadId'], 'label_ids': []})
+
+    def buffer_labels(self, body):
+        self.connection.emails.setdefault(body['id'], {})['label_ids'] = sorted(body.get('labelIds') or [])
+
+    def buffer_attributes_and_label(self, message, partial_headers=False):
+        self.connection.emails.setdefault(message['id'], {}).update(history_id=int(message['historyId']),
+                                                                    saved_on=datetime.now())
+        self.connection.save_counts[message['id']] = self.connection.save_counts.get(message['id'], 0) + 1
+        self.buffer_labels(message)
+
+    def buffer_parts(self, message):
+        self.connection.emails[message['id']]['has_parts'] = bool(message['payload'].get('parts'))
+
+    def flush(self):
+        pass
+
+    def delete_messages(self, message_ids):
+        for message_id in message_ids:
+            self.connection.emails.pop(message_id, None)
+
+    def fetch_existing_message_ids(self, message_ids):
+        return {message_id for message_id in message_ids if message_id in self.connection.emails}
+
+    def fetch_message_ids_saved_since(self, message_ids, since):
+        return {message_id for message_id in message_ids
+                if self.connection.emails.get(message_id, {}).get('saved_on', datetime.min) >= since}
+
+
+class FakeSyncStateDAO(object):
+    """
+    SyncStateDAO over a FakeDatabase
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def _get_entry(self, name):
+        return self.connection.sync_state.setdefault(
+            name, {'name': name, 'parameters': {}, 'status': None, 'page_token': None, 'last_batch': 0,
+                   'message_count': 0, 'history_id': None, 'started_on': None})
+
+    def get_history_id(self, name):
+        entry = self.connection.sync_state.get(name)
+        return entry['history_id'] if entry else None
+
+    def save_history_id(self, name, history_id):
+        self._get_entry(name)['history_id'] = history_id
+
+    def update_status(self, name, status, message_count=None, error=None):
+        entry = self._get_entry(name)
+        entry.update(status=status, error=error)
+        if message_count is not None:
+            entry['message_count'] = message_count
+        if status == SYNC_RUNNING and entry['started_on'] is None:
+            entry['started_on'] = datetime.now()
+
+    def get_checkpoint(self, name):
+        entry = self.connection.sync_state.get(name)
+        return dict(entry) if entry else None
+
+    def start_checkpoint(self, name, parameters, history_id=None):
+        self.connection.sync_state.pop(name, None)
+        self._get_entry(name).update(parameters=parameters, history_id=history_id, status=SYNC_RUNNING,
+                                     started_on=datetime.now())
+
+    def save_checkpoint(self, name, page_token, last_batch, message_count):
+        self.connection.check('save_checkpoint', last_batch)
+        self._get_entry(name).update(page_token=page_token, last_batch=last_batch, message_count=message_count)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """
+    :return: the FakeDatabase used by the EmailProcessor instances of the test
+    """
+    fake_database = FakeDatabase()
+
+    @contextmanager
+    def pooled_connection():
+        yield fake_database
+
+    monkeypatch.setattr(DBUtils, 'pooled_connection', staticmethod(pooled_connection))
+    monkeypatch.setattr(email_processor_module, 'EmailDAO', FakeEmailDAO)
+    monkeypatch.setattr(email_processor_module, 'SyncStateDAO', FakeSyncStateDAO)
+    return fake_database
+
+
+@pytest.fixture
+def mailbox():
+    return FakeMailbox(250, seed=1, body_size=64)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    """
+    :return: list of the attempts of the retries, which are run without waiting
+    """
+    attempts = []
+    monkeypatch.setattr(email_processor_module.GmailRequestScheduler, 'backoff',
+                        staticmethod(lambda attempt: attempts.append(attempt)))
+    return attempts
+
+
+@pytest.fixture
+def new_processor(mailbox):
+    """
+    :return: callable(error_rate=0) returning a new EmailProcessor downloading from the mailbox, without quota
+    """
+
+    def get_processor(error_rate=0):
+        return EmailProcessor(2, service_factory=get_fake_service_factory(mailbox, error_rate=error_rate),
+                              quota_units_per_second=None)
+
+    return get_processor
@@ -0,0 +1,131 @@
+import pytest
+
+from businesslogic import email_processor as email_processor_module
+from config.settings import MAILBOX_SYNC_NAME, DOWNLOAD_SYNC_NAME, MESSAGE_FORMAT_FULL
+from lib.fake_gmail import FAKE_INITIAL_HISTORY_ID
+from models.sync_state import SYNC_DONE, SYNC_FAILED
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+def get_mailbox_labels(mailbox):
+    """
+    :return: dict of the (sorted) labels of every message of the mailbox, by hex message id
+    """
+    return {mailbox.get_message_id(index): sorted(mailbox.get_labels(index)) for index in mailbox.iter_indexes()}
+
+
+def get_saved_labels(database):
+    return {message_id: email['label_ids'] for message_id, email in database.emails.items()}
+
+
+def test_full_sync_saves_the_mailbox_and_its_history_checkpoint(database, mailbox, new_processor):
+    processor = new_processor()
+    processor.download_emails_to_db(None, MESSAGE_FORMAT_FULL)
+
+    assert get_saved_labels(database) == get_mailbox_labels(mailbox)
+    assert all(email['has_parts'] for email in database.emails.values())
+    assert database.sync_state[MAILBOX_SYNC_NAME]['history_id'] == mailbox.history_id
+    assert database.sync_state[DOWNLOAD_SYNC_NAME]['status'] == SYNC_DONE
+    assert processor.changed_message_ids is None
+
+
+def test_incremental_sync_applies_the_changes_since_the_checkpoint(database, mailbox, new_processor):
+    new_processor().download_emails_to_db(None, MESSAGE_FORMAT_FULL)
+    message_ids = sorted(database.emails)
+    added_ids = mailbox.deliver(2)
+    mailbox.delete(message_ids[:3])
+    mailbox.modify(message_ids[3:5], add_label_ids=['STARRED'], remove_label_ids=['INBOX'])
+    # A change of a message delivered since the checkpoint
+    mailbox.modify(added_ids[:1], add_label_ids=['Label_1001'])
+
+    processor = new_processor()
+    processor.download_emails_to_db(None, MESSAGE_FORMAT_FULL, incremental=True)
+
+    assert get_saved_labels(database) == get_mailbox_labels(mailbox)
+    assert processor.changed_message_ids == set(added_ids) | set(message_ids[3:5])
+    assert 'Label_1001' in database.emails[added_ids[0]]['label_ids']
+    assert database.sync_state[MAILBOX_SYNC_NAME]['history_id'] == mailbox.history_id
+
+
+def test_incremental_sync_fetches_the_relabelled_messages_missing_in_the_database(database, mailbox, new_processor):
+    new_processor().download_emails_to_db(None, MESSAGE_FORMAT_FULL)
+    missing_id = sorted(database.emails)[0]
+    database.emails.pop(missing_id)
+    mailbox.modify([missing_id], add_label_ids=['STARRED'])
+
+    processor = new_processor()
+    processor.download_emails_to_db(None, MESSAGE_FORMAT_FULL, incremental=True)
+
+    assert database.emails[missing_id]['has_parts']
+    assert get_saved_labels(database) == get_mailbox_labels(mailbox)
+    assert processor.changed_message_ids == {missing_id}
+
+
+def test_incremental_sync_falls_back_to_a_full_sync_when_the_checkpoint_expired(database, mailbox, new_processor):
+    # The history of the mailbox starts at FAKE_INITIAL_HISTORY_ID: older checkpoints get a 404
+    database.sync_state[MAILBOX_SYNC_NAME] = {'history_id': FAKE_INITIAL_HISTORY_ID - 1}
+
+    processor = new_processor()
+    processor.download_emails_to_db(None, MESSAGE_FORMAT_FULL, incremental=True)
+
+    assert get_saved_labels(database) == get_mailbox_labels(mailbox)
+    assert database.sync_state[MAILBOX_SYNC_NAME]['history_id'] == mailbox.history_id
+    assert processor.changed_message_ids is None
+
+
+def test_incremental_sync_without_checkpoint_runs_a_full_sync(database, mailbox, new_processor):
+    new_processor().download_emails_to_db(None, MESSAGE_FORMAT_FULL, incremental=True)
+
+    assert get_saved_labels(database) == get_mailbox_labels(mailbox)
+    assert database.sync_state[MAILBOX_SYNC_NAME]['history_id'] == mailbox.history_id
+
+
+def test_full_sync_retries_the_rate_limited_requests(database, mailbox, new_processor, no_backoff):
+    new_processor(error_rate=0.2).download_emails_to_db(None, MESSAGE_FORMAT_FULL)
+
+    assert get_saved_labels(database) == get_mailbox_labels(mailbox)
+    assert no_backoff
+
+
+@pytest.mark.parametrize('failing_operation', ['bulk_insert_message_ids', 'save_checkpoint'])
+def test_interrupted_download_resumes_from_its_checkpoint(database, mailbox, new_processor, monkeypatch,
+                                                          failing_operation):
+    monkeypatch.setattr(email_processor_module, 'DOWNLOAD_CHECKPOINT_INTERVAL', 0)
+    calls = []
+
+    def fail_on_third_page(operation, value):
+        # Either the third page is not saved, or it is saved but not checkpointed
+        if operation == failing_operation:
+            calls.append(value)
+            if len(calls) == 3:
+                raise InjectedFailure()
+
+    database.fail_on = fail_on_third_page
+    history_id = mailbox.history_id
+    with pytest.raises(InjectedFailure):
+        new_processor().download_emails_to_db(None, MESSAGE_FORMAT_FULL, maxResults=50)
+    checkpoint = database.sync_state[DOWNLOAD_SYNC_NAME]
+    assert checkpoint['status'] == SYNC_FAILED
+    assert checkpoint['last_batch'] == 2
+    assert MAILBOX_SYNC_NAME not in database.sync_state
+    # Changes made meanwhile are left to the next incremental sync
+    mailbox.deliver(1)
+
+    database.fail_on = None
+    assert new_processor().resume_download()
+
+    mailbox_labels = get_mailbox_labels(mailbox)
+    assert database.save_counts == {message_id: 1 for message_id in database.emails}
+    assert len(database.emails) == len(mailbox_labels) - 1
+    assert database.sync_state[DOWNLOAD_SYNC_NAME]['status'] == SYNC_DONE
+    assert database.sync_state[DOWNLOAD_SYNC_NAME]['message_count'] == len(mailbox_labels) - 1
+    assert database.sync_state[MAILBOX_SYNC_NAME]['history_id'] == history_id
+
+
+def test_resume_without_interrupted_download(database, new_processor):
+    new_processor().download_emails_to_db(None, MESSAGE_FORMAT_FULL)
+
+    assert not new_processor().resume_download()
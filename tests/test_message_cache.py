@@ -0,0 +1,47 @@
+import os
+
+from lib.fake_gmail import FakeMailbox
+from lib.message_cache import MessageCache, INDEX_FILE_NAME, INDEX_RECORD
+
+
+def test_cache_returns_the_latest_response_of_each_message(tmp_path):
+    mailbox = FakeMailbox(3, seed=2, body_size=32)
+    cache = MessageCache(str(tmp_path), segment_size=1024)
+    messages = [mailbox.get_message(index) for index in range(3)]
+    for message in messages:
+        cache.put(message)
+    relabelled = dict(messages[0], labelIds=['STARRED'], historyId=str(int(messages[0]['historyId']) + 1))
+    cache.put(relabelled)
+    cache.close()
+
+    cache = MessageCache(str(tmp_path), segment_size=1024)
+    assert len(cache) == 3
+    assert cache.get(messages[0]['id']) == relabelled
+    assert cache.get_history_id(messages[0]['id']) == int(relabelled['historyId'])
+    assert cache.get('ffff') is None
+    assert sorted(message['id'] for message in cache.iter_messages()) == [message['id'] for message in messages]
+    cache.close()
+
+
+def test_cache_recovers_from_a_torn_index_record(tmp_path):
+    mailbox = FakeMailbox(4, seed=2, body_size=32)
+    cache = MessageCache(str(tmp_path))
+    for index in range(3):
+        cache.put(mailbox.get_message(index))
+    cache.close()
+    index_path = os.path.join(str(tmp_path), INDEX_FILE_NAME)
+    # A crash while the index record of a fourth message was written
+    with open(index_path, 'ab') as index_file:
+        index_file.write(b'\x01' * (INDEX_RECORD.size // 2))
+
+    cache = MessageCache(str(tmp_path))
+    assert len(cache) == 3
+    assert os.path.getsize(index_path) == 3 * INDEX_RECORD.size
+    cache.put(mailbox.get_message(3))
+    cache.close()
+
+    cache = MessageCache(str(tmp_path))
+    assert len(cache) == 4
+    for index in range(4):
+        assert cache.get(mailbox.get_message_id(index)) == mailbox.get_message(index)
+    cache.close()
@@ -0,0 +1,143 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from config.settings import GMAIL_BACKOFF_BASE_SECONDS, GMAIL_BACKOFF_MAX_SECONDS, GMAIL_MAX_RETRIES, \
+    GMAIL_MIN_BATCH_SIZE
+from lib import request_scheduler
+from lib.request_scheduler import QuotaLimiter, GmailRequestScheduler, CLEAN_BATCHES_BEFORE_INCREASE, is_retryable
+
+
+class FakeClock(object):
+    """
+    Stand-in for the time module: sleep advances monotonic instead of waiting
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeRequest(object):
+    """
+    Request failing with the given HTTP statuses before succeeding
+    """
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.executions = 0
+
+    def execute(self):
+        self.executions += 1
+        if self.statuses:
+            raise get_http_error(self.statuses.pop(0))
+        return {'ok': True}
+
+
+def get_http_error(status, reason='backendError'):
+    return HttpError(httplib2.Response({'status': status}), f'{{"error": {{"message": "{reason}"}}}}'.encode())
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(request_scheduler, 'time', fake_clock)
+    return fake_clock
+
+
+def test_quota_limiter_without_quota_does_not_wait(clock):
+    limiter = QuotaLimiter(None)
+    limiter.acquire(10 ** 6)
+
+    assert clock.sleeps == []
+
+
+def test_quota_limiter_waits_for_the_units_to_be_refilled(clock):
+    limiter = QuotaLimiter(100)
+    # Bursts of up to a second of quota
+    limiter.acquire(100)
+    assert clock.sleeps == []
+    limiter.acquire(50)
+    assert sum(clock.sleeps) == pytest.approx(0.5)
+    clock.now += 10
+    limiter.acquire(100)
+    assert sum(clock.sleeps) == pytest.approx(0.5)
+
+
+def test_quota_limiter_lets_a_request_larger_than_the_bucket_through_once_full(clock):
+    limiter = QuotaLimiter(100)
+    limiter.acquire(250)
+    limiter.acquire(100)
+
+    # The bucket went 150 units below zero: 2.5 seconds to get it full again
+    assert sum(clock.sleeps) == pytest.approx(2.5)
+
+
+def test_backoff_delays_grow_exponentially_up_to_the_cap(clock, monkeypatch):
+    monkeypatch.setattr(request_scheduler.random, 'uniform', lambda low, high: high)
+    for attempt in range(1, 10):
+        GmailRequestScheduler.backoff(attempt)
+
+    assert clock.sleeps == [min(GMAIL_BACKOFF_MAX_SECONDS, GMAIL_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+                            for attempt in range(1, 10)]
+
+
+def test_execute_retries_the_retryable_errors(clock):
+    scheduler = GmailRequestScheduler(units_per_second=None)
+    request = FakeRequest(429, 503)
+
+    assert scheduler.execute(request, 'labels.list') == {'ok': True}
+    assert request.executions == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_execute_raises_the_other_errors_without_retrying(clock):
+    scheduler = GmailRequestScheduler(units_per_second=None)
+    request = FakeRequest(404)
+
+    with pytest.raises(HttpError):
+        scheduler.execute(request, 'history.list')
+    assert request.executions == 1
+    assert clock.sleeps == []
+
+
+def test_execute_gives_up_after_the_maximum_retries(clock):
+    scheduler = GmailRequestScheduler(units_per_second=None)
+    request = FakeRequest(*[500] * (GMAIL_MAX_RETRIES + 1))
+
+    with pytest.raises(HttpError):
+        scheduler.execute(request, 'messages.list')
+    assert request.executions == GMAIL_MAX_RETRIES + 1
+
+
+def test_rate_limit_errors_are_retryable():
+    assert is_retryable(get_http_error(429))
+    assert is_retryable(get_http_error(403, 'userRateLimitExceeded'))
+    assert not is_retryable(get_http_error(403, 'insufficientPermissions'))
+    assert not is_retryable(get_http_error(400))
+    assert is_retryable(ConnectionResetError())
+
+
+def test_batch_size_and_concurrency_shrink_on_failures_and_grow_back():
+    scheduler = GmailRequestScheduler(max_concurrency=4, max_batch_size=50, units_per_second=None)
+    scheduler.record_batch(50, 3)
+    assert (scheduler.batch_size, scheduler.concurrency) == (25, 2)
+    for _ in range(10):
+        scheduler.record_batch(25, 1)
+    assert (scheduler.batch_size, scheduler.concurrency) == (GMAIL_MIN_BATCH_SIZE, 1)
+
+    for _ in range(CLEAN_BATCHES_BEFORE_INCREASE - 1):
+        scheduler.record_batch(GMAIL_MIN_BATCH_SIZE, 0)
+    assert (scheduler.batch_size, scheduler.concurrency) == (GMAIL_MIN_BATCH_SIZE, 1)
+    scheduler.record_batch(GMAIL_MIN_BATCH_SIZE, 0)
+    assert (scheduler.batch_size, scheduler.concurrency) == (2 * GMAIL_MIN_BATCH_SIZE, 2)
+    for _ in range(100 * CLEAN_BATCHES_BEFORE_INCREASE):
+        scheduler.record_batch(GMAIL_MIN_BATCH_SIZE, 0)
+    assert (scheduler.batch_size, scheduler.concurrency) == (50, 4)
@@ -0,0 +1,166 @@
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from businesslogic.rule_compiler import RuleCompiler, get_ngram_terms
+from businesslogic.rule_snapshot import MessageSnapshot, SENT_LABEL_ID
+from lib.fake_gmail import FakeMailbox
+
+# Texts of the edge cases: word starts, case, LIKE wildcards, regular expression characters, short words, NULL
+EDGE_CASE_TEXTS = ('Invoice 42', 'voice mail', 'INVOICE', 'Orkut <noreply@orkut.com>', 'orkutfan@example.org',
+                   '100% off_sale', '100 percent', 'a.b+c (test)', 'x', 'Fw: Ré: café', None)
+TEXT_VALUES = ('orkut', 'ork', 'voice', 'Invoice', 'in', 'x', '100%', 'off_sale', '@example.org', 'a.b+c (',
+               'fw: ré', 'café', 'bob <bob@example.net>')
+DATE_VALUES = ('1 day', '30 days', '6 months', '2 years')
+
+
+class SnapshotRows(object):
+    """
+    Stand-in for EmailDAO.fetch_snapshot_rows over a list of rows
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetch_snapshot_rows(self, changed_since=None):
+        yield self.rows
+
+
+def get_rows():
+    """
+    :return: the snapshot rows (see EmailDAO.fetch_snapshot_rows) of messages of a FakeMailbox, followed by the
+             edge cases
+    """
+    mailbox = FakeMailbox(120, seed=3, span_days=1000, body_size=16)
+    rows = []
+    for index in range(120):
+        message = mailbox.get_message(index)
+        headers = {header['name'].lower(): header['value'] for header in message['payload']['headers']}
+        rows.append((int(message['id'], 16), headers['from'], headers['to'], headers['subject'], headers.get('cc'),
+                     None, datetime.fromtimestamp(int(message['internalDate']) // 1000), message['labelIds']))
+    message_id = rows[-1][0]
+    for offset, text in enumerate(EDGE_CASE_TEXTS, 1):
+        labels = [SENT_LABEL_ID] if offset % 2 else ['INBOX']
+        rows.append((message_id + offset, text or '', text or '', text or '', text, text,
+                     datetime.now() - timedelta(days=offset * 40), labels))
+    return rows
+
+
+ROWS = get_rows()
+FIELD_POSITIONS = {'from': 1, 'to': 2, 'subject': 3, 'cc': 4, 'bcc': 5}
+
+
+def like_to_regex(pattern):
+    """
+    :return: the regular expression matching what the LIKE pattern (with \\ as escape character) matches
+    """
+    parts = []
+    characters = iter(pattern)
+    for character in characters:
+        if character == '\\':
+            parts.append(re.escape(next(characters)))
+        elif character == '%':
+            parts.append('.*')
+        elif character == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(character))
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+def get_indexed_ngrams(text):
+    """
+    :return: the (casefolded) tokens of the text in an ngram FULLTEXT index: every 2 characters without whitespace
+    """
+    ngrams = (text[start:start + 2] for start in range(len(text) - 1))
+    return {ngram.casefold() for ngram in ngrams if not re.search(r'\s', ngram)}
+
+
+def evaluate_text_condition(condition, parameters, text):
+    """
+    :brief: Evaluates a compiled text condition on a value as MySQL does: a FULLTEXT search in boolean mode of the
+            required terms, followed by a (case insensitive) LIKE, REGEXP or comparison
+    """
+    if text is None:
+        return False
+    parameters = list(parameters)
+    if 'against(%s in boolean mode)' in condition:
+        terms = {term.lstrip('+').casefold() for term in parameters.pop(0).split()}
+        if not terms <= get_indexed_ngrams(text):
+            return False
+    value, = parameters
+    if ' like %s' in condition:
+        return like_to_regex(value).fullmatch(text) is not None
+    if ' regexp %s' in condition:
+        return re.search(value, text, re.IGNORECASE) is not None
+    if ' != %s' in condition:
+        return text.casefold() != value.casefold()
+    return text.casefold() == value.casefold()
+
+
+def evaluate_date_condition(condition, parameters, row):
+    cutoff, = parameters
+    timestamp = row[6]
+    matched = timestamp > cutoff if '`internal_timestamp` > %s' in condition else timestamp < cutoff
+    is_sent = SENT_LABEL_ID in row[7]
+    return matched and (not is_sent if 'and not exists' in condition else is_sent)
+
+
+@pytest.fixture(scope='module')
+def snapshot():
+    message_snapshot = MessageSnapshot()
+    message_snapshot._load_rows(SnapshotRows(ROWS))
+    return message_snapshot
+
+
+def get_rule(field, predicate, value):
+    return {'predicate': 'all', 'rules': [{'field': field, 'predicate': predicate, 'value': value}],
+            'action': {'addLabelIds': ['STARRED']}}
+
+
+@pytest.mark.parametrize('field', sorted(FIELD_POSITIONS))
+@pytest.mark.parametrize('predicate', ['contains', 'contains word', 'equals', 'not equals'])
+@pytest.mark.parametrize('value', TEXT_VALUES)
+def test_text_predicates_match_the_same_messages_in_sql_and_in_the_snapshot(snapshot, field, predicate, value):
+    rules = get_rule(field, predicate, value)
+    condition, parameters = RuleCompiler.get_query_condition(rules)
+
+    expected = [evaluate_text_condition(condition, parameters, row[FIELD_POSITIONS[field]]) for row in ROWS]
+    assert MessageSnapshot.supports(rules)
+    assert snapshot.get_rule_mask(rules).tolist() == expected
+
+
+@pytest.mark.parametrize('field', ['date_received', 'date_sent'])
+@pytest.mark.parametrize('predicate', ['less than', 'more than'])
+@pytest.mark.parametrize('value', DATE_VALUES)
+def test_date_predicates_match_the_same_messages_in_sql_and_in_the_snapshot(snapshot, field, predicate, value):
+    rules = get_rule(field, predicate, value)
+    condition, parameters = RuleCompiler.get_query_condition(rules)
+
+    expected = [evaluate_date_condition(condition, parameters, row) for row in ROWS]
+    assert snapshot.get_rule_mask(rules).tolist() == expected
+
+
+@pytest.mark.parametrize('predicate, value, matched_texts', [
+    ('contains', 'voice', {'Invoice 42', 'voice mail', 'INVOICE'}),
+    ('contains word', 'voice', {'voice mail'}),
+    ('contains', 'ork', {'Orkut <noreply@orkut.com>', 'orkutfan@example.org'}),
+    ('contains word', 'ork', {'Orkut <noreply@orkut.com>', 'orkutfan@example.org'}),
+    ('contains word', 'kut', set()),
+    ('contains', '100%', {'100% off_sale'}),
+])
+def test_contains_matches_substrings_and_contains_word_matches_word_starts(snapshot, predicate, value,
+                                                                           matched_texts):
+    mask = snapshot.get_rule_mask(get_rule('bcc', predicate, value))
+    # The bcc of the messages of the mailbox is NULL: only the edge cases can match
+    assert {row[5] for row, matched in zip(ROWS, mask) if matched} == matched_texts
+
+
+def test_only_values_with_ngrams_use_the_fulltext_index():
+    assert get_ngram_terms('x') == []
+    assert get_ngram_terms('Orkut') == ['Or', 'rk', 'ku', 'ut']
+    indexed_condition, _ = RuleCompiler.get_query_condition(get_rule('body', 'contains', 'ork'))
+    scanned_condition, _ = RuleCompiler.get_query_condition(get_rule('body', 'contains', 'x'))
+    assert 'against(' in indexed_condition
+    assert 'against(' not in scanned_condition
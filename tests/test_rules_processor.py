@@ -0,0 +1,19 @@
+import pytest
+
+from businesslogic.rules_processor import RulesProcessor
+
+
+@pytest.mark.parametrize('actions, merged_action', [
+    ([], ((), ())),
+    ([{'addLabelIds': ['B', 'A']}], (('A', 'B'), ())),
+    ([{'addLabelIds': ['A']}, {'removeLabelIds': ['INBOX']}], (('A',), ('INBOX',))),
+    # The later rule takes precedence when the rules disagree on a label
+    ([{'addLabelIds': ['A']}, {'removeLabelIds': ['A']}], ((), ('A',))),
+    ([{'removeLabelIds': ['A']}, {'addLabelIds': ['A']}], (('A',), ())),
+    ([{'addLabelIds': ['A'], 'removeLabelIds': ['B']}, {'addLabelIds': ['B']}, {'removeLabelIds': ['C']}],
+     (('A', 'B'), ('C',))),
+    ([{'addLabelIds': None, 'removeLabelIds': ['A']}, {'addLabelIds': ['A'], 'removeLabelIds': None}],
+     (('A',), ())),
+])
+def test_merge_actions(actions, merged_action):
+    assert RulesProcessor._merge_actions(actions) == merged_action